@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...models import update_photo_visibility
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes which photos can be seen without authentication. This is "
+        "normally kept up to date as photos and albums change, but changes that "
+        "bypass Django's signals (like raw SQL, or QuerySet.update) aren't noticed."
+    )
+
+    def handle(self, *args, **options):
+        count = update_photo_visibility()
+        self.stdout.write(f"Updated {count} photos")
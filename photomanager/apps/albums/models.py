@@ -1,6 +1,9 @@
 import uuid
 
 from django.db import models
+from django.db.models import BooleanField, Case, Exists, OuterRef, QuerySet, When
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 
 from ..photos.models import Photo
 from ..users.models import User
@@ -61,3 +64,86 @@ class AlbumShareLink(models.Model):
     creation_time = models.DateTimeField(
         auto_now_add=True, help_text="Album share link creation time.", null=True
     )
+
+
+def update_photo_visibility(photos: QuerySet = None) -> int:
+    """
+    Recomputes Photo.effectively_public, in a single query: a photo can be
+    seen without authentication if it is publicly accessible, or if it is in
+    any publicly accessible album. The signal handlers below call this
+    whenever either changes, so access checks only need to read that field.
+
+    :param photos: The photos to update; all of them if not given
+    :return: The number of photos updated
+    """
+    if photos is None:
+        photos = Photo.objects.all()
+
+    return photos.update(
+        effectively_public=Case(
+            When(publicly_accessible=True, then=True),
+            When(
+                Exists(
+                    Album.objects.filter(
+                        photos=OuterRef("pk"), publicly_accessible=True
+                    )
+                ),
+                then=True,
+            ),
+            default=False,
+            output_field=BooleanField(),
+        )
+    )
+
+
+@receiver(post_save, sender=Photo)
+def photo_saved(sender, instance: Photo, created: bool, **kwargs) -> None:
+    # Photo.save sets effectively_public, or leaves it alone if the photo
+    # wasn't publicly accessible before either
+    if (
+        not created
+        and not instance.publicly_accessible
+        and getattr(instance, "_saved_publicly_accessible", None) is not False
+    ):
+        update_photo_visibility(Photo.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=Album)
+def album_saved(sender, instance: Album, created: bool, **kwargs) -> None:
+    # Its photos are added separately, which is handled by album_photos_changed
+    if not created:
+        update_photo_visibility(Photo.objects.filter(album=instance))
+
+
+@receiver(pre_delete, sender=Album)
+def album_deleting(sender, instance: Album, **kwargs) -> None:
+    instance.deleted_photo_ids = list(instance.photos.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Album)
+def album_deleted(sender, instance: Album, **kwargs) -> None:
+    if instance.publicly_accessible:
+        update_photo_visibility(Photo.objects.filter(id__in=instance.deleted_photo_ids))
+
+
+@receiver(m2m_changed, sender=Album.photos.through)
+def album_photos_changed(
+    sender, instance, action: str, reverse: bool, pk_set: set, **kwargs
+) -> None:
+    if reverse:
+        # Albums were added to or removed from a photo
+        if action in ("post_add", "post_remove", "post_clear"):
+            update_photo_visibility(Photo.objects.filter(pk=instance.pk))
+        return
+
+    # Photos in a private album aren't affected by it
+    if not instance.publicly_accessible:
+        return
+
+    if action == "pre_clear":
+        # The photos removed aren't passed along with post_clear
+        instance.cleared_photo_ids = list(instance.photos.values_list("id", flat=True))
+    elif action == "post_clear":
+        update_photo_visibility(Photo.objects.filter(id__in=instance.cleared_photo_ids))
+    elif action in ("post_add", "post_remove"):
+        update_photo_visibility(Photo.objects.filter(id__in=pk_set))
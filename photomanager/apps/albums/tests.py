@@ -1,9 +1,12 @@
+import os
 import uuid
 
 from django.conf import settings
+from django.core.management import call_command
 from django.urls import reverse_lazy
 
 from photomanager.apps.albums.models import Album, AlbumShareLink
+from photomanager.apps.photos.models import Photo
 from photomanager.test.photomanger_test import PhotomanagerTestCase
 
 
@@ -394,3 +397,94 @@ class AlbumsTestCase(PhotomanagerTestCase):
                 description=new_description, id=sharelink.id
             ).count(),
         )
+
+    def test_photo_visibility(self):
+        """
+        Tests that Photo.effectively_public follows the photo's albums,
+        and that it is used when checking access to photos.
+        """
+        user = self.login()
+        photo = Photo.objects.create(user=user, file="hello.jpeg")
+        other = Photo.objects.create(user=user, file="other.jpeg")
+
+        def is_public(photo: Photo) -> bool:
+            return Photo.objects.get(id=photo.id).effectively_public
+
+        album = Album.objects.create(name=uuid.uuid4(), owner=user)
+        album.photos.add(photo, other)
+        self.assertFalse(is_public(photo))
+
+        album.publicly_accessible = True
+        album.save()
+        self.assertTrue(is_public(photo))
+
+        # Photos saved with a stale value keep the right one, without
+        # recomputing it unless publicly_accessible changes
+        stale = Photo.objects.get(id=photo.id)
+        stale.effectively_public = False
+        with self.assertNumQueries(1):
+            stale.save()
+        self.assertTrue(is_public(photo))
+
+        self.client.logout()
+        response = self.client.get(
+            reverse_lazy("photos:view_single_photo", kwargs={"image_id": photo.id})
+        )
+        self.assertEqual(200, response.status_code)
+        response = self.client.get(reverse_lazy("index"))
+        self.assertEqual(
+            {photo.id, other.id},
+            {listed.id for listed in response.context["object_list"]},
+        )
+        # As are their tags and faces
+        tag = photo.tags.create(tag=str(uuid.uuid4()))
+        face = photo.faces.create(face_data="[]")
+        for url, items in [
+            (reverse_lazy("tags:list"), [tag]),
+            (reverse_lazy("faces:list"), [face]),
+        ]:
+            response = self.client.get(url)
+            self.assertEqual(items, list(response.context["object_list"]))
+        for url in [
+            reverse_lazy("tags:display", kwargs={"pk": tag.pk}),
+            reverse_lazy("faces:display", kwargs={"pk": face.pk}),
+        ]:
+            response = self.client.get(url)
+            self.assertEqual([photo], list(response.context["photos"]))
+
+        album.photos.remove(photo)
+        self.assertFalse(is_public(photo))
+        self.assertTrue(is_public(other))
+        response = self.client.get(
+            reverse_lazy("photos:view_single_photo", kwargs={"image_id": photo.id})
+        )
+        self.assertEqual(302, response.status_code)
+
+        photo.album_set.add(album)
+        self.assertTrue(is_public(photo))
+        album.photos.clear()
+        self.assertFalse(is_public(photo))
+        self.assertFalse(is_public(other))
+
+        # Photos that are publicly accessible themselves stay that way
+        other.publicly_accessible = True
+        other.save()
+        album.photos.add(photo, other)
+        album.delete()
+        self.assertFalse(is_public(photo))
+        self.assertTrue(is_public(other))
+        other.publicly_accessible = False
+        other.save()
+        self.assertFalse(is_public(other))
+        other.publicly_accessible = True
+        other.save()
+
+        # Changes that bypass signals are repaired by the command
+        album = Album.objects.create(
+            name=uuid.uuid4(), owner=user, publicly_accessible=True
+        )
+        album.photos.add(photo)
+        Photo.objects.update(effectively_public=False)
+        call_command("update_photo_visibility", stdout=open(os.devnull, "w"))
+        self.assertTrue(is_public(photo))
+        self.assertTrue(is_public(other))
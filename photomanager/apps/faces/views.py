@@ -15,7 +15,7 @@ class FacesListView(ListView):
         if not self.request.user.is_authenticated:
             # If the user is not authenticated, they can only see publicly accessible images
             return (
-                Face.objects.filter(photo__publicly_accessible=True)
+                Face.objects.filter(photo__effectively_public=True)
                 .distinct()
                 .order_by(Lower("user"), Lower("defined_name"), "id")
             )
@@ -48,13 +48,13 @@ class FaceDetailView(DetailView):
             context["photos"] = self.object.photo_set.filter(user=self.request.user)
         else:
             # If there are no publicly accessible images for this tag, we 404
-            if self.object.photo_set.filter(publicly_accessible=True).count() == 0:
+            if self.object.photo_set.filter(effectively_public=True).count() == 0:
                 raise Http404(
                     "No publicly accessible images exist for this face. Are you logged in?"
                 )
 
             # Otherwise, we show the publicly accessible images
-            context["photos"] = self.object.photo_set.filter(publicly_accessible=True)
+            context["photos"] = self.object.photo_set.filter(effectively_public=True)
 
         return context
 
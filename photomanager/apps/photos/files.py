@@ -0,0 +1,167 @@
+import array
+import io
+import json
+import os
+import socket
+import subprocess
+from typing import BinaryIO, List, NamedTuple, Optional
+
+from django.conf import settings
+
+READ_FILE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    "utils/files/read_file.py",
+)
+
+# Seconds to wait for the file reader before giving up
+READ_FILE_TIMEOUT = 60
+# Largest response header expected from the file reader, in bytes
+READ_FILE_HEADER_SIZE = 4096
+
+
+class OpenedFile(NamedTuple):
+    """A file opened by open_file."""
+
+    file: BinaryIO  # Must be closed by the caller
+    mime: str
+    size: int
+
+
+class FileContents(NamedTuple):
+    """Contents of a file read by read_file."""
+
+    data: bytes
+    mime: str
+    size: int  # Of the whole file, even if only part of it was read
+
+
+def open_file(path: str) -> OpenedFile:
+    """
+    Opens a file as root, without following symlinks out of its directory.
+
+    Files are opened by the file reader (utils/files/read_file_server.py)
+    listening on settings.FILE_READER_SOCKET, which passes back an open file
+    descriptor. If that isn't set or the reader isn't running, read_file.py
+    is run instead, which is much slower: it starts a new interpreter for
+    every file, and the whole file is read into memory.
+
+    :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+    :raises FileNotFoundError if the file doesn't exist (or goes through
+            a symlink), or OSError if it couldn't be read
+    :return: OpenedFile
+    """
+    if settings.FILE_READER_SOCKET:
+        opened = _open_file_from_server(path)
+        if opened is not None:
+            return opened
+
+    with _run_read_file(path) as process:
+        header = _parse_header(process.stdout.readline())
+        data = process.stdout.read()
+
+    return OpenedFile(io.BytesIO(data), header["mime"], header["size"])
+
+
+def read_file(path: str, offset: int = 0, length: int = None) -> FileContents:
+    """
+    Reads a file as root, like open_file; optionally, only part of it.
+
+    :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+    :param offset: Where to start reading, in bytes
+    :param length: The most bytes to read, or None to read to the end of the file
+    :raises The same exceptions as open_file
+    :return: FileContents, with fewer bytes than asked for if the file ends first
+    """
+    if settings.FILE_READER_SOCKET:
+        opened = _open_file_from_server(path)
+        if opened is not None:
+            with opened.file:
+                opened.file.seek(offset)
+                data = opened.file.read(-1 if length is None else length)
+            return FileContents(data, opened.mime, opened.size)
+
+    # read_file.py only sends the part asked for, so it isn't all piped through
+    arguments = ["--offset", str(offset)]
+    if length is not None:
+        arguments += ["--length", str(length)]
+    with _run_read_file(path, arguments) as process:
+        header = _parse_header(process.stdout.readline())
+        data = process.stdout.read()
+
+    return FileContents(data, header["mime"], header["size"])
+
+
+def _run_read_file(path: str, arguments: List[str] = ()) -> subprocess.Popen:
+    """
+    Runs read_file.py to read a file as root, printing its contents after a header.
+
+    :param path: Absolute path to the file
+    :param arguments: More arguments for read_file.py
+    :return: subprocess.Popen, with the output in its stdout
+    """
+    return subprocess.Popen(
+        (["sudo"] if os.getuid() != 0 else [])
+        + ["pipenv", "run", "python3", READ_FILE_PATH, str(path), "--binary"]
+        + list(arguments),  # sudo required for chroot
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def _open_file_from_server(path: str) -> Optional[OpenedFile]:
+    """
+    Opens a file through the file reader listening on settings.FILE_READER_SOCKET.
+
+    :param path: Absolute path to the file
+    :raises The same exceptions as open_file
+    :return: OpenedFile, or None if the file reader isn't running
+    """
+    fds = array.array("i")
+    response = b""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(READ_FILE_TIMEOUT)
+        try:
+            connection.connect(settings.FILE_READER_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        connection.sendall(json.dumps({"path": str(path)}).encode() + b"\n")
+
+        while not response.endswith(b"\n"):
+            data, ancillary, _, _ = connection.recvmsg(
+                READ_FILE_HEADER_SIZE,
+                socket.CMSG_SPACE(fds.itemsize),
+                socket.MSG_CMSG_CLOEXEC,
+            )
+            if not data:
+                raise ConnectionResetError("The file reader closed the connection")
+            response += data
+            for level, kind, fd_data in ancillary:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(fd_data[: len(fd_data) - len(fd_data) % fds.itemsize])
+
+    try:
+        header = _parse_header(response)
+        if len(fds) != 1:
+            raise OSError("The file reader didn't send a file descriptor")
+    except OSError:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+    return OpenedFile(os.fdopen(fds[0], "rb"), header["mime"], header["size"])
+
+
+def _parse_header(line: bytes) -> dict:
+    """
+    Parses the header sent by the file reader or read_file.py.
+
+    :param line: The header, a line of JSON
+    :raises FileNotFoundError or OSError if it is an error
+    :return: A dict with "mime" and "size" keys
+    """
+    header = json.loads(line or b'{"error": 500, "message": "No response"}')
+    if "error" in header:
+        if header["error"] == 404:
+            raise FileNotFoundError(header["message"])
+        raise OSError(header["message"])
+    return header
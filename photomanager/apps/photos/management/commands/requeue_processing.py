@@ -0,0 +1,93 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from ...models import Photo, ProcessingStage
+from ...tasks import (
+    STAGE_VERSIONS,
+    enabled_stages,
+    process_image,
+    queue_processing_stages,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Queues the stages of processing that have failed, or were run by an "
+        "older version (see tasks.STAGE_VERSIONS), or have never run, for "
+        "every photo. Only those stages are rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stage",
+            action="append",
+            choices=ProcessingStage.Stage.values,
+            help="Only requeue this stage; may be given more than once",
+        )
+        parser.add_argument(
+            "--unfinished",
+            action="store_true",
+            help="Also requeue stages that are still pending or running, "
+            "like after a crash. Only use this when no workers are running.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the stages that would be requeued",
+        )
+
+    def handle(self, *args, **options):
+        stages = [
+            stage
+            for stage in enabled_stages()
+            if not options["stage"] or stage in options["stage"]
+        ]
+
+        statuses = [ProcessingStage.Status.FAILED]
+        if options["unfinished"]:
+            statuses += [ProcessingStage.Status.PENDING, ProcessingStage.Status.RUNNING]
+
+        # Photo ID -> stages to requeue
+        photos = {}
+        for stage in stages:
+            records = ProcessingStage.objects.filter(stage=stage)
+            stale = records.filter(
+                Q(status__in=statuses) | ~Q(version=STAGE_VERSIONS[stage])
+            ).values_list("photo_id", flat=True)
+            missing = Photo.objects.exclude(
+                id__in=records.values("photo_id")
+            ).values_list("id", flat=True)
+
+            count = 0
+            for photo_id in stale.union(missing).iterator():
+                photos.setdefault(photo_id, set()).add(stage)
+                count += 1
+            self.stdout.write(f"{stage}: {count} photos")
+
+        if options["dry_run"]:
+            return
+
+        # Photos processed before content hashes were recorded don't have one;
+        # those without a thumbnail haven't been processed at all
+        unprocessed = {
+            photo.id
+            for photo in Photo.objects.filter(content_hash="").only("id")
+            if photo.id in photos and not os.path.exists(photo.thumbnail_path)
+        }
+        for photo_id, photo_stages in photos.items():
+            if photo_id in unprocessed:
+                # Processed in full, which queues every other stage
+                process_image.delay(str(photo_id))
+                continue
+
+            if ProcessingStage.Stage.METADATA in photo_stages:
+                # Queues the other stages itself, once the metadata is read
+                process_image.delay(
+                    str(photo_id), metadata_only=True, stages=sorted(photo_stages)
+                )
+            else:
+                queue_processing_stages(str(photo_id), photo_stages)
+
+        self.stdout.write(f"Requeued {len(photos)} photos")
@@ -0,0 +1,224 @@
+import errno
+import os
+import select
+import time
+from typing import Iterator, Tuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from photomanager.utils.files.inotify import (
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_DELETE_SELF,
+    IN_DONT_FOLLOW,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_ONLYDIR,
+    IN_Q_OVERFLOW,
+    Inotify,
+)
+
+from ...tasks import scan_all_dirs_for_changes, scan_files_for_changes, scan_rules
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+# How often, in seconds, to check for new users
+USER_REFRESH_INTERVAL = 5 * 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Watches the directories of all users for changes using inotify, "
+        "and queues new and changed files for processing."
+    )
+
+    def handle(self, *args, **options):
+        self.inotify = Inotify()
+        self.watches = {}  # Watch descriptor -> directory path
+        self.roots = {}  # Username -> directory
+        self.rules = {}  # Username -> ScanRules for their directory
+        self.pending = {}  # Username -> set of paths relative to their directory
+        self.first_event = None
+        self.last_event = None
+
+        debounce = settings.DIRECTORY_WATCHER_DEBOUNCE
+        next_refresh = 0
+
+        with self.inotify:
+            while True:
+                now = time.monotonic()
+                if now >= next_refresh:
+                    self.refresh_users()
+                    next_refresh = now + USER_REFRESH_INTERVAL
+
+                timeout = next_refresh - now
+                if self.last_event is not None:
+                    timeout = min(timeout, max(0, self.last_event + debounce - now))
+
+                readable, _, _ = select.select([self.inotify], [], [], timeout)
+                if readable:
+                    for event in self.inotify.read():
+                        self.handle_event(event)
+
+                # Wait for changes to settle before queueing them, but don't
+                # wait forever if a directory is constantly being written to
+                now = time.monotonic()
+                if self.last_event is not None and (
+                    now - self.last_event >= debounce
+                    or now - self.first_event >= debounce * 10
+                ):
+                    self.flush()
+
+    def refresh_users(self) -> None:
+        """
+        Starts watching the directories of any users that were not already watched.
+
+        :return: None
+        """
+        for user in get_user_model().objects.all():
+            if user.username not in self.roots:
+                self.roots[user.username] = user.root_directory
+                self.rules[user.username] = scan_rules(user.root_directory)
+                self.watch_tree(user.root_directory, mark_files=False)
+
+    def watch_tree(self, path: str, mark_files: bool = True) -> None:
+        """
+        Watches a directory and all the directories underneath it.
+        Symlinks are not followed, and directories that are
+        excluded from scanning are not watched.
+
+        :param path: Directory to watch
+        :param mark_files: Whether to queue the files found underneath this directory
+        :return: None
+        """
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [
+                dirname
+                for dirname in dirnames
+                if not self.is_excluded(os.path.join(dirpath, dirname), directory=True)
+            ]
+
+            try:
+                self.watches[self.inotify.add_watch(dirpath, WATCH_MASK)] = dirpath
+            except OSError as e:
+                self.stderr.write(
+                    self.style.WARNING(
+                        f"Could not watch {dirpath} ({e.strerror}); changes underneath "
+                        f"it will only be found by the reconciliation scan."
+                    )
+                )
+                if e.errno == errno.ENOSPC:
+                    # Out of watches; no point in trying the rest
+                    dirnames.clear()
+
+            if mark_files:
+                for filename in filenames:
+                    self.mark(os.path.join(dirpath, filename))
+
+    def handle_event(self, event) -> None:
+        """
+        Handles a single inotify event.
+
+        :param event: An InotifyEvent
+        :return: None
+        """
+        if event.mask & IN_Q_OVERFLOW:
+            # Events were dropped, so we have no idea what changed.
+            # Fall back to scanning everything.
+            self.stderr.write(
+                self.style.WARNING("inotify queue overflowed; rescanning everything.")
+            )
+            scan_all_dirs_for_changes.delay(force=True)
+            self.pending.clear()
+            self.first_event = self.last_event = None
+            return
+
+        if event.mask & IN_IGNORED:
+            # The watch was removed, for instance because the directory was deleted
+            self.watches.pop(event.wd, None)
+            return
+
+        directory = self.watches.get(event.wd)
+        if directory is None or not event.name:
+            return
+
+        path = os.path.join(directory, event.name)
+        if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+            # Files may have been written to this directory before we could watch it
+            self.watch_tree(path)
+
+        self.mark(path)
+
+    def relative_paths(self, path: str) -> Iterator[Tuple[str, str]]:
+        """
+        Finds the users whose directory a path is in.
+
+        :param path: Absolute path
+        :return: The username and path relative to their directory, for each
+        """
+        for username, root in self.roots.items():
+            relative_path = os.path.relpath(path, root)
+            # Not "..foo", which is a file named that in their directory
+            if relative_path != os.pardir and not relative_path.startswith(
+                os.pardir + os.sep
+            ):
+                yield username, relative_path
+
+    def is_excluded(self, path: str, directory: bool = False) -> bool:
+        """
+        Whether a path is excluded from scanning for every user whose
+        directory it is in.
+
+        :param path: Absolute path
+        :param directory: Whether the path is a directory
+        :return: True if the path is excluded
+        """
+        for username, relative_path in self.relative_paths(path):
+            rules = self.rules[username]
+            if directory and not rules.excludes_directory(relative_path):
+                return False
+            if not directory and not rules.excludes_path(relative_path):
+                return False
+        return True
+
+    def mark(self, path: str) -> None:
+        """
+        Marks a path as changed, to be queued once changes settle.
+
+        :param path: Absolute path that changed
+        :return: None
+        """
+        for username, relative_path in self.relative_paths(path):
+            if self.rules[username].excludes_path(relative_path):
+                continue
+            self.pending.setdefault(username, set()).add("/" + relative_path)
+
+        self.last_event = time.monotonic()
+        if self.first_event is None:
+            self.first_event = self.last_event
+
+    def flush(self) -> None:
+        """
+        Queues all the changed paths for processing.
+
+        :return: None
+        """
+        for username, files in self.pending.items():
+            scan_files_for_changes.delay(self.roots[username], username, sorted(files))
+
+        self.pending.clear()
+        self.first_event = self.last_event = None
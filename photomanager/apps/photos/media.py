@@ -0,0 +1,586 @@
+import asyncio
+import mimetypes
+import os
+import re
+import time
+import uuid
+import weakref
+from datetime import datetime
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseNotFound,
+    HttpResponseServerError,
+    StreamingHttpResponse,
+)
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+
+from .files import open_file
+from .thumbnails import RENDITION_FORMATS, THUMBNAIL_SIZE, can_save
+
+# Bytes read from a file at a time while sending it
+FILE_CHUNK_SIZE = 64 * 1024
+# Requests for more ranges than this are sent the whole file instead
+MAX_RANGES = 20
+
+# Variants of a photo that can be sent from a signed URL
+SIGNED_MEDIA_VARIANTS = ("thumbnail",)
+_SIGNED_MEDIA_SALT = "photomanager.apps.photos.media"
+
+# One semaphore per event loop, limiting the files read at once
+_read_semaphores = weakref.WeakKeyDictionary()
+# Jobs started by run_once, by event loop and key
+_jobs_in_flight = weakref.WeakKeyDictionary()
+
+_RANGE_PATTERN = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+# Older versions of Python don't know these
+for _rendition_format in RENDITION_FORMATS.values():
+    mimetypes.add_type(_rendition_format.mime, f".{_rendition_format.extension}")
+
+
+def sign_media_url(photo, variant: str = "thumbnail") -> str:
+    """
+    Creates a signed URL for a variant of a photo, which anyone can use until
+    it expires. It must only be created for users who can see the photo,
+    like while rendering a page that shows it.
+
+    The URL expires between SIGNED_MEDIA_URL_LIFETIME and twice that many
+    seconds from now. Expiry times are rounded, so the same URL is created
+    for every page rendered within that time and browsers can cache it.
+
+    :param photo: Photo object
+    :param variant: One of SIGNED_MEDIA_VARIANTS
+    :return: A URL, like "/photos/media/12345678-(...)/thumbnail/(...)"
+    """
+    lifetime = settings.SIGNED_MEDIA_URL_LIFETIME
+    expires = (int(time.time()) // lifetime + 2) * lifetime
+    version = photo.thumbnail_version
+    return reverse(
+        "photos:signed_media",
+        args=[
+            photo.id,
+            variant,
+            version,
+            expires,
+            _media_signature(photo.id, variant, version, expires),
+        ],
+    )
+
+
+def check_media_signature(
+    photo_id, variant: str, version: str, expires: int, signature: str
+) -> bool:
+    """
+    Checks a URL created by sign_media_url, without touching the database.
+
+    :param photo_id: ID (UUID) of the photo
+    :param variant: The variant of the photo
+    :param version: The photo's thumbnail version when the URL was created
+    :param expires: When the URL expires, in seconds since the epoch
+    :param signature: The signature from the URL
+    :return: Whether the URL was created by sign_media_url and hasn't expired
+    """
+    return (
+        variant in SIGNED_MEDIA_VARIANTS
+        and expires > time.time()
+        and constant_time_compare(
+            signature, _media_signature(photo_id, variant, version, expires)
+        )
+    )
+
+
+class Rendition(NamedTuple):
+    """One of a photo's thumbnails, picked by pick_rendition."""
+
+    path: str
+    name: str  # Tells renditions apart in ETags, like "512.webp"
+    size: Optional[int]  # None for the JPEG thumbnail
+    image_format: Optional[str]  # None for the JPEG thumbnail
+
+
+def pick_rendition(photo, width: Optional[int], accept: str) -> Rendition:
+    """
+    Picks which of a photo's thumbnails to send: the smallest rendition
+    that is at least width pixels on its longest side (or the largest one),
+    in the first of settings.THUMBNAIL_FORMATS that the browser accepts.
+    Browsers that don't accept any of them get the JPEG thumbnail.
+
+    :param photo: Photo object; only its ID is used
+    :param width: The size asked for, in pixels, or None for THUMBNAIL_SIZE
+    :param accept: The request's Accept header
+    :return: Rendition
+    """
+    for image_format in settings.THUMBNAIL_FORMATS:
+        if _accepts(accept, RENDITION_FORMATS[image_format].mime) and can_save(
+            image_format
+        ):
+            break
+    else:
+        return Rendition(photo.thumbnail_path, "thumbnail", None, None)
+
+    sizes = sorted(settings.THUMBNAIL_SIZES)
+    width = width or max(THUMBNAIL_SIZE)
+    size = next((size for size in sizes if size >= width), sizes[-1])
+    extension = RENDITION_FORMATS[image_format].extension
+    return Rendition(
+        photo.rendition_path(size, image_format),
+        f"{size}.{extension}",
+        size,
+        image_format,
+    )
+
+
+def _accepts(accept: str, mime: str) -> bool:
+    """
+    Checks whether an Accept header lists a MIME type explicitly. Wildcards
+    aren't enough, since browsers send "*/*" for formats they can't show.
+
+    :param accept: The Accept header
+    :param mime: A MIME type, like "image/webp"
+    :return: Whether it is listed, without "q=0"
+    """
+    for media_range in accept.split(","):
+        media_type, *parameters = media_range.split(";")
+        if media_type.strip().lower() != mime:
+            continue
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _media_signature(photo_id, variant: str, version: str, expires: int) -> str:
+    """
+    Signs the parts of a signed media URL with settings.SECRET_KEY.
+
+    :param photo_id: ID (UUID) of the photo
+    :param variant: The variant of the photo
+    :param version: The photo's thumbnail version
+    :param expires: When the URL expires, in seconds since the epoch
+    :return: The signature
+    """
+    return signing.Signer(salt=_SIGNED_MEDIA_SALT).signature(
+        f"{photo_id}:{variant}:{version}:{expires}"
+    )
+
+
+def serve_file(
+    request,
+    path: str,
+    trusted: bool = False,
+    etag: str = None,
+    last_modified: datetime = None,
+) -> HttpResponse:
+    """
+    Sends a file to the client, as configured by settings.MEDIA_SERVE_MODE.
+    Permissions must already have been checked.
+
+    If validators are given, conditional requests (If-None-Match,
+    If-Modified-Since and so on) are answered before the file is touched,
+    and If-Range is honoured.
+
+    With "file", the file is opened (by the file reader, unless it is
+    trusted) and streamed from its file descriptor, FILE_CHUNK_SIZE bytes
+    at a time; range requests are supported (see _file_response). With
+    "x-accel-redirect" or "x-sendfile", an empty response tells the web
+    server in front of photomanager to send the file itself (including
+    any ranges), so it never passes through Python.
+
+    :param request: Request object
+    :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+    :param trusted: Whether the file is in a directory that only photomanager
+                    writes to, like settings.IMAGE_THUMBS_DIR, so it can be
+                    opened directly if it is readable
+    :param etag: A strong ETag for the file, including quotes
+    :param last_modified: When the file was last modified
+    :return: HttpResponse
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    validators = [etag, http_date(timestamp) if timestamp is not None else None]
+
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        if_range = request.META.get("HTTP_IF_RANGE")
+        use_ranges = request.method == "GET" and (
+            if_range is None or if_range in filter(None, validators)
+        )
+        response = _serve_file(request, path, trusted, use_ranges)
+
+    if response.status_code in (200, 206, 304):
+        if etag:
+            response["ETag"] = etag
+        if timestamp is not None:
+            response["Last-Modified"] = validators[1]
+    return response
+
+
+async def serve_file_async(
+    request,
+    path: str,
+    trusted: bool = False,
+    etag: str = None,
+    last_modified: datetime = None,
+) -> HttpResponse:
+    """
+    Same as serve_file, for async views, without blocking the event loop.
+
+    The file is opened in a worker thread, and responses of up to
+    settings.MEDIA_BUFFER_SIZE bytes (like thumbnails) are read into memory
+    there too, so they are sent without a thread for every chunk. At most
+    settings.MEDIA_MAX_CONCURRENT_READS files are opened and read at once
+    by each process, so a burst of requests for files that aren't cached
+    doesn't flood the disk. Larger files are streamed, each chunk being
+    read in a worker thread by photomanager.handlers.ASGIHandler.
+
+    :param request: Request object
+    :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+    :param trusted: Whether the file can be opened directly; see serve_file
+    :param etag: A strong ETag for the file, including quotes
+    :param last_modified: When the file was last modified
+    :return: HttpResponse
+    """
+    async with _read_semaphore():
+        return await sync_to_async(_serve_buffered_file, thread_sensitive=False)(
+            request, path, trusted, etag, last_modified
+        )
+
+
+async def run_once(key: str, function: Callable, *args) -> Any:
+    """
+    Runs a blocking function in a worker thread, like serve_file_async reads
+    files. If it is already running with the same key in this process, its
+    result is awaited instead of running it again.
+
+    The function keeps running if the requests waiting for it go away,
+    so that it can't be interrupted halfway.
+
+    :param key: Identifies what the function does, like the path it writes to
+    :param function: The function
+    :param args: Arguments for the function
+    :return: What the function returns
+    """
+    loop = asyncio.get_event_loop()
+    jobs = _jobs_in_flight.setdefault(loop, {})
+    if key not in jobs:
+
+        async def job():
+            async with _read_semaphore():
+                return await sync_to_async(function, thread_sensitive=False)(*args)
+
+        jobs[key] = loop.create_task(job())
+        jobs[key].add_done_callback(lambda _: jobs.pop(key, None))
+    return await asyncio.shield(jobs[key])
+
+
+def _read_semaphore() -> asyncio.Semaphore:
+    """
+    Gets the semaphore limiting the files read at once by serve_file_async.
+
+    :return: asyncio.Semaphore, for the running event loop
+    """
+    loop = asyncio.get_event_loop()
+    if loop not in _read_semaphores:
+        _read_semaphores[loop] = asyncio.Semaphore(settings.MEDIA_MAX_CONCURRENT_READS)
+    return _read_semaphores[loop]
+
+
+def _serve_buffered_file(
+    request, path: str, trusted: bool, etag: str, last_modified: datetime
+) -> HttpResponse:
+    """
+    Sends a file to the client with serve_file, reading it into
+    memory if it is small enough; see serve_file_async.
+
+    :param request: Request object
+    :param path: Absolute path to the file
+    :param trusted: Whether the file can be opened directly
+    :param etag: A strong ETag for the file, including quotes
+    :param last_modified: When the file was last modified
+    :return: HttpResponse
+    """
+    response = serve_file(request, path, trusted, etag, last_modified)
+    if not response.streaming or request.method == "HEAD":
+        return response
+
+    length = response.get("Content-Length")
+    if length is None or int(length) > settings.MEDIA_BUFFER_SIZE:
+        return response
+
+    try:
+        buffered = HttpResponse(
+            b"".join(response.streaming_content), status=response.status_code
+        )
+    finally:
+        response.close()
+    for header, value in response.items():
+        buffered[header] = value
+    return buffered
+
+
+def _serve_file(request, path: str, trusted: bool, use_ranges: bool) -> HttpResponse:
+    """
+    Sends a file to the client; see serve_file.
+
+    :param request: Request object
+    :param path: Absolute path to the file
+    :param trusted: Whether the file can be opened directly
+    :param use_ranges: Whether to honour the request's Range header
+    :return: HttpResponse
+    """
+    mode = settings.MEDIA_SERVE_MODE
+    filename = os.path.basename(path)
+
+    if mode == "x-accel-redirect":
+        response = _redirect_response(filename)
+        response["X-Accel-Redirect"] = quote(_accel_redirect_location(path))
+        return response
+    elif mode == "x-sendfile":
+        response = _redirect_response(filename)
+        response["X-Sendfile"] = path
+        return response
+    elif mode != "file":
+        raise ImproperlyConfigured(f"Unknown MEDIA_SERVE_MODE {mode!r}")
+
+    if trusted:
+        try:
+            file = open(path, "rb")
+        except PermissionError:
+            # Only readable by root
+            pass
+        except FileNotFoundError:
+            return HttpResponseNotFound()
+        else:
+            content_type, _ = mimetypes.guess_type(filename)
+            return _file_response(
+                request,
+                file,
+                filename,
+                content_type or "application/octet-stream",
+                os.fstat(file.fileno()).st_size,
+                use_ranges,
+            )
+
+    try:
+        opened = open_file(path)
+    except FileNotFoundError:
+        return HttpResponseNotFound()
+    except OSError:
+        return HttpResponseServerError()
+
+    return _file_response(
+        request, opened.file, filename, opened.mime, opened.size, use_ranges
+    )
+
+
+def _file_response(
+    request,
+    file: BinaryIO,
+    filename: str,
+    content_type: str,
+    size: int,
+    use_ranges: bool,
+) -> HttpResponse:
+    """
+    Streams an open file to the client, and closes it once it has been sent.
+
+    If the request has a Range header that should be honoured, only the
+    ranges requested are sent, in a 206 response; several ranges are sent
+    as multipart/byteranges.
+
+    :param request: Request object
+    :param file: The file, open for reading
+    :param filename: Name of the file
+    :param content_type: MIME type of the file
+    :param size: Size of the file, in bytes
+    :param use_ranges: Whether to honour the request's Range header
+    :return: HttpResponse
+    """
+    ranges = None
+    if use_ranges:
+        ranges = _parse_ranges(request.META.get("HTTP_RANGE", ""), size)
+
+    if ranges is None:
+        response = FileResponse(file, filename=filename, content_type=content_type)
+        response.block_size = FILE_CHUNK_SIZE
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+    if not ranges:
+        file.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            _stream(file, ranges), status=206, content_type=content_type
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = end - start + 1
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, end in ranges:
+            parts.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n".encode()
+            )
+            parts.append((start, end))
+            parts.append(b"\r\n")
+        parts.append(f"--{boundary}--\r\n".encode())
+
+        response = StreamingHttpResponse(
+            _stream(file, parts),
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+        response["Content-Length"] = sum(
+            len(part) if isinstance(part, bytes) else part[1] - part[0] + 1
+            for part in parts
+        )
+
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _parse_ranges(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses the Range header of a request.
+
+    :param header: The header, like "bytes=0-499,1000-" (or "" if there isn't one)
+    :param size: Size of the file, in bytes
+    :return: A list of (first byte, last byte) tuples that can be satisfied,
+             which is empty if none can, or None if the whole file should
+             be sent instead (there is no header, or it is invalid)
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip() != "bytes" or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        match = _RANGE_PATTERN.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+
+        if not first:
+            # A suffix, like "-500" for the last 500 bytes
+            if not last:
+                return None
+            if int(last) == 0:
+                continue
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def _stream(
+    file: BinaryIO, parts: Iterable[Union[bytes, Tuple[int, int]]]
+) -> Iterable[bytes]:
+    """
+    Reads ranges of a file, FILE_CHUNK_SIZE bytes at a time,
+    and closes it once they have all been read.
+
+    :param file: The file, open for reading
+    :param parts: A list of (first byte, last byte) tuples to read, and bytes
+                  to send as is between them
+    :return: An iterator of bytes
+    """
+    try:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            start, end = part
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = file.read(min(FILE_CHUNK_SIZE, remaining))
+                if not data:
+                    # The file was truncated while it was being sent
+                    return
+                remaining -= len(data)
+                yield data
+    finally:
+        file.close()
+
+
+def _accel_redirect_location(path: str) -> str:
+    """
+    Gets the internal nginx location that a file is served from,
+    using settings.MEDIA_ACCEL_REDIRECT_LOCATIONS.
+
+    :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+    :raises ImproperlyConfigured if the file isn't in any of those directories
+    :return: A location, like "/protected/data/jdoe/hello.jpeg"
+    """
+    path = os.path.normpath(path)
+    for directory, location in settings.MEDIA_ACCEL_REDIRECT_LOCATIONS.items():
+        directory = directory.rstrip("/") + "/"
+        if path.startswith(directory):
+            return location.rstrip("/") + "/" + path[len(directory) :]
+
+    raise ImproperlyConfigured(f"No MEDIA_ACCEL_REDIRECT_LOCATIONS entry for {path}")
+
+
+def _redirect_response(filename: str) -> HttpResponse:
+    """
+    Creates an empty response for the web server to fill in with a file,
+    with the same headers as a FileResponse.
+
+    :param filename: Name of the file
+    :return: HttpResponse
+    """
+    response = HttpResponse()
+    content_type, _ = mimetypes.guess_type(filename)
+    if content_type:
+        response["Content-Type"] = content_type
+    else:
+        # Let the web server decide
+        del response["Content-Type"]
+
+    try:
+        filename.encode("ascii")
+        response["Content-Disposition"] = f'inline; filename="{filename}"'
+    except UnicodeEncodeError:
+        response["Content-Disposition"] = f"inline; filename*=utf-8''{quote(filename)}"
+    return response
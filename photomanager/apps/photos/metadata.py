@@ -0,0 +1,54 @@
+"""
+Finds the metadata at the start of image files, so that it can be
+refreshed without reading the rest of the file.
+
+In a JPEG file, metadata is kept in APPn segments (APP1 for EXIF and XMP)
+right after the start of image marker, before the image data itself.
+Each segment starts with a 0xFF marker byte, the segment type, and its
+length as a big-endian 16-bit integer (including the length itself).
+"""
+
+import struct
+
+_SOI = b"\xff\xd8"
+# APP0 to APP15, and comments
+_METADATA_SEGMENTS = set(range(0xE0, 0xF0)) | {0xFE}
+
+
+def is_jpeg(data: bytes) -> bool:
+    """
+    Checks whether data is the start of a JPEG file.
+
+    :param data: The start of the file
+    :return: Whether it starts with a JPEG start of image marker
+    """
+    return data.startswith(_SOI)
+
+
+def jpeg_metadata_length(data: bytes) -> int:
+    """
+    Finds how much of a JPEG file has to be read to get all of its metadata
+    segments, from the start of the file.
+
+    If data ends in the middle of the metadata, this is at least as long as
+    the segments that have already started; read that much and call this
+    again, until it is no longer than the data read.
+
+    :param data: The start of a JPEG file
+    :raises ValueError if data isn't the start of a JPEG file
+    :return: Where the last metadata segment ends, in bytes
+    """
+    if not is_jpeg(data):
+        raise ValueError("Not a JPEG file")
+
+    position = len(_SOI)
+    while True:
+        if position + 4 > len(data):
+            # The next segment's marker and length haven't been read yet
+            return position + 4
+
+        marker, segment, length = struct.unpack_from(">BBH", data, position)
+        if marker != 0xFF or segment not in _METADATA_SEGMENTS:
+            # The image itself (or something unexpected) starts here
+            return position
+        position += 2 + length
@@ -0,0 +1,77 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("photos", "0004_photo_file_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScannedFile",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "path",
+                    models.CharField(
+                        help_text="Path to this file, relative to the user's subdirectory.",
+                        max_length=4096,
+                    ),
+                ),
+                (
+                    "inode",
+                    models.PositiveBigIntegerField(
+                        help_text="Inode number of this file."
+                    ),
+                ),
+                (
+                    "size",
+                    models.PositiveBigIntegerField(
+                        help_text="Size of this file, in bytes."
+                    ),
+                ),
+                (
+                    "mtime",
+                    models.BigIntegerField(
+                        help_text="Modification time of this file, in nanoseconds since the epoch."
+                    ),
+                ),
+                (
+                    "mime",
+                    models.CharField(
+                        blank=True,
+                        help_text="MIME type of this file when it was last sniffed.",
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        help_text="The user that this file belongs to.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="scannedfile",
+            constraint=models.UniqueConstraint(
+                fields=("user", "path"), name="unique_scanned_file_path"
+            ),
+        ),
+    ]
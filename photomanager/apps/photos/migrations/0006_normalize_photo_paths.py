@@ -0,0 +1,63 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:11
+
+import os
+import posixpath
+
+from django.db import migrations, models
+
+
+def normalize_photo_paths(apps, schema_editor):
+    """
+    Makes Photo.file relative to the user's subdirectory and normalized,
+    and merges photos that turn out to be duplicates of each other.
+    """
+    Photo = apps.get_model("photos", "Photo")
+    Album = apps.get_model("albums", "Album")
+
+    kept = {}
+    for photo in Photo.objects.select_related("user").order_by("creation_time"):
+        root = os.path.normpath(os.path.join("/data", str(photo.user.subdirectory)))
+        path = str(photo.file)
+
+        # Paths chosen in the admin are absolute
+        if path.startswith(root.rstrip("/") + "/"):
+            path = path[len(root.rstrip("/")) :]
+        path = posixpath.normpath("/" + path).lstrip("/")
+
+        key = (photo.user_id, path)
+        if key in kept:
+            # Duplicate; merge it into the oldest photo for this path
+            original = kept[key]
+            original.tags.add(*photo.tags.all())
+            original.faces.add(*photo.faces.all())
+            for album in Album.objects.filter(photos=photo):
+                album.photos.add(original)
+            photo.delete()
+            continue
+
+        kept[key] = photo
+        if path != photo.file:
+            photo.file = path
+            photo.save(update_fields=["file"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("albums", "0007_auto_20201203_0108"),
+        ("photos", "0005_scannedfile"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="photo",
+            name="file",
+            field=models.FilePathField(
+                help_text="Path to the photo file, relative to the user's subdirectory.",
+                max_length=4096,
+                path="/data",
+                recursive=True,
+            ),
+        ),
+        migrations.RunPython(normalize_photo_paths, migrations.RunPython.noop),
+    ]
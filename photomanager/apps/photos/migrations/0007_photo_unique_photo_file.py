@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("photos", "0006_normalize_photo_paths"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="photo",
+            constraint=models.UniqueConstraint(
+                fields=("user", "file"), name="unique_photo_file"
+            ),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("photos", "0007_photo_unique_photo_file"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScannedDirectory",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "path",
+                    models.CharField(
+                        help_text="Path to this directory, relative to the user's subdirectory.",
+                        max_length=4096,
+                    ),
+                ),
+                (
+                    "mtime",
+                    models.BigIntegerField(
+                        help_text="Modification time of this directory, in nanoseconds since the epoch. Null if it was modified too recently to be trusted.",
+                        null=True,
+                    ),
+                ),
+                (
+                    "subdirectories",
+                    models.JSONField(
+                        default=list,
+                        help_text="Names of the directories within this directory.",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        help_text="The user that this directory belongs to.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="scanneddirectory",
+            constraint=models.UniqueConstraint(
+                fields=("user", "path"), name="unique_scanned_directory_path"
+            ),
+        ),
+    ]
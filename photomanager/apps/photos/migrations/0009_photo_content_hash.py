@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("photos", "0008_scanneddirectory"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                help_text="BLAKE2b hash of the image's contents, set once it has been processed.",
+                max_length=64,
+            ),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:32
+
+from django.db import migrations, models
+from django.db.models import BooleanField, Case, Exists, OuterRef, When
+
+
+def update_photo_visibility(apps, schema_editor):
+    """
+    Sets Photo.effectively_public for existing photos; see
+    albums.models.update_photo_visibility.
+    """
+    Photo = apps.get_model("photos", "Photo")
+    Album = apps.get_model("albums", "Album")
+
+    Photo.objects.update(
+        effectively_public=Case(
+            When(publicly_accessible=True, then=True),
+            When(
+                Exists(
+                    Album.objects.filter(
+                        photos=OuterRef("pk"), publicly_accessible=True
+                    )
+                ),
+                then=True,
+            ),
+            default=False,
+            output_field=BooleanField(),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("albums", "0007_auto_20201203_0108"),
+        ("photos", "0009_photo_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="effectively_public",
+            field=models.BooleanField(
+                db_index=True,
+                default=False,
+                editable=False,
+                help_text="Whether this photo can be seen without authentication, because it is publicly accessible or in a publicly accessible album. Kept up to date by albums.models.update_photo_visibility.",
+            ),
+        ),
+        migrations.RunPython(update_photo_visibility, migrations.RunPython.noop),
+    ]
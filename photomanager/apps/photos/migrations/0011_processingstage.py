@@ -0,0 +1,95 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("photos", "0010_photo_effectively_public"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProcessingStage",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "stage",
+                    models.CharField(
+                        choices=[
+                            ("metadata", "Metadata"),
+                            ("thumbnail", "Thumbnail"),
+                            ("tagging", "Tagging"),
+                            ("faces", "Faces"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("running", "Running"),
+                            ("done", "Done"),
+                            ("failed", "Failed"),
+                        ],
+                        default="pending",
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "version",
+                    models.CharField(
+                        blank=True,
+                        help_text="Version of the stage that last ran, or is running.",
+                        max_length=64,
+                    ),
+                ),
+                (
+                    "error",
+                    models.TextField(
+                        blank=True, help_text="Why the stage last failed."
+                    ),
+                ),
+                (
+                    "last_modified_time",
+                    models.DateTimeField(
+                        auto_now=True, help_text="When the status last changed."
+                    ),
+                ),
+                (
+                    "photo",
+                    models.ForeignKey(
+                        help_text="The photo being processed.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stages",
+                        to="photos.photo",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="processingstage",
+            index=models.Index(
+                fields=["stage", "status", "version"],
+                name="photos_proc_stage_224875_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="processingstage",
+            constraint=models.UniqueConstraint(
+                fields=("photo", "stage"), name="unique_processing_stage"
+            ),
+        ),
+    ]
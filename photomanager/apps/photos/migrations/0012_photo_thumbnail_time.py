@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("photos", "0011_processingstage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="photo",
+            name="thumbnail_time",
+            field=models.DateTimeField(
+                blank=True,
+                editable=False,
+                help_text="When the photo's thumbnail and renditions were last generated.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:12
+
+import os
+
+from django.conf import settings
+from django.db import migrations
+
+# The versions of the stages that photos were processed with before stages
+# were recorded (see tasks.STAGE_VERSIONS); all of them were run at once
+INITIAL_STAGE_VERSIONS = {
+    "metadata": "1",
+    "thumbnail": "1",
+    "tagging": "nasnetlarge-imagenet-1",
+    "faces": "face-recognition-cnn-1",
+}
+
+BATCH_SIZE = 1000
+
+
+def backfill_processing_stages(apps, schema_editor):
+    """
+    Records the stages of the photos that were processed before stages were
+    recorded as done, at the versions they were run with, so that
+    requeue_processing only reruns those that have changed since.
+    Processing ended with saving the thumbnail, so photos that have one
+    were processed; the others are left to be processed in full.
+    """
+    Photo = apps.get_model("photos", "Photo")
+    ProcessingStage = apps.get_model("photos", "ProcessingStage")
+
+    stages = []
+    for photo_id in list(
+        Photo.objects.filter(stages__isnull=True).values_list("id", flat=True)
+    ):
+        photo_id = str(photo_id)
+        thumbnail_path = os.path.join(
+            settings.IMAGE_THUMBS_DIR,
+            photo_id[0],
+            photo_id[1],
+            f"{photo_id}.thumb.jpeg",
+        )
+        if not os.path.exists(thumbnail_path):
+            continue
+
+        stages += [
+            ProcessingStage(
+                photo_id=photo_id, stage=stage, status="done", version=version
+            )
+            for stage, version in INITIAL_STAGE_VERSIONS.items()
+        ]
+        if len(stages) >= BATCH_SIZE:
+            ProcessingStage.objects.bulk_create(stages)
+            stages = []
+    ProcessingStage.objects.bulk_create(stages)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("photos", "0012_photo_thumbnail_time"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_processing_stages, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,19 @@
+import os
+import posixpath
 import uuid
 from fractions import Fraction
 from math import sqrt
+from typing import List
 
+from django.conf import settings
 from django.db import models
 
 from photomanager.apps.faces.models import Face
 from photomanager.apps.tags.models import PhotoTag
 from photomanager.apps.users.models import User
 
+from .thumbnails import RENDITION_FORMATS
+
 
 class Photo(models.Model):
     """
@@ -19,7 +25,8 @@ class Photo(models.Model):
         path="/data",
         null=False,
         blank=False,
-        help_text="Path to the photo file.",
+        max_length=4096,
+        help_text="Path to the photo file, relative to the user's subdirectory.",
         allow_files=True,
         allow_folders=False,
         recursive=True,
@@ -55,6 +62,18 @@ class Photo(models.Model):
     image_size = models.PositiveIntegerField(
         help_text="File size (on disk, in bytes) of the image", null=True
     )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        help_text="BLAKE2b hash of the image's contents, set once it has been processed.",
+    )
+    thumbnail_time = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="When the photo's thumbnail and renditions were last generated.",
+    )
 
     camera_make = models.CharField(max_length=150, blank=True)
     camera_model = models.CharField(max_length=150, blank=True)
@@ -139,9 +158,282 @@ class Photo(models.Model):
         help_text="Whether this photo is publicly accessible. If checked, this photo is "
         "listed on the front page and accessible without authentication.",
     )
+    effectively_public = models.BooleanField(
+        default=False,
+        db_index=True,
+        editable=False,
+        help_text="Whether this photo can be seen without authentication, because it "
+        "is publicly accessible or in a publicly accessible album. Kept up to date "
+        "by albums.models.update_photo_visibility.",
+    )
 
     # Tags; both automatically generated tags and user modifiable
     tags = models.ManyToManyField(PhotoTag, blank=True)
 
     # Faces; both automatically generated and user modifiable
     faces = models.ManyToManyField(Face, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "file"], name="unique_photo_file")
+        ]
+
+    @staticmethod
+    def normalize_path(path: str, root: str = None) -> str:
+        """
+        Normalizes a path relative to a user's subdirectory, so that
+        the same file is always stored the same way in Photo.file.
+
+        :param path: The path, like "/hello/./hello.jpeg"
+        :param root: The user's subdirectory (see User.root_directory). If given,
+                     absolute paths within it, like those chosen in the admin,
+                     are made relative to it.
+        :raises ValueError if the path is outside of the user's subdirectory
+        :return: The normalized path, like "hello/hello.jpeg"
+        """
+        path = str(path)
+        if root is not None and path.startswith(root.rstrip("/") + "/"):
+            path = path[len(root.rstrip("/")) :]
+        path = posixpath.normpath("/" + path).lstrip("/")
+        if path in ("", "."):
+            raise ValueError("Path must be a file within the user's subdirectory")
+        return path
+
+    @property
+    def absolute_path(self) -> str:
+        """
+        Absolute path to the photo file.
+
+        :return: A path, like "/data/jdoe/hello/hello.jpeg"
+        """
+        return os.path.join(self.user.root_directory, Photo.normalize_path(self.file))
+
+    @property
+    def thumbnail_path(self) -> str:
+        """
+        Absolute path to the photo's thumbnail. Thumbnails are kept under
+        settings.IMAGE_THUMBS_DIR, using the first two characters of the
+        photo's UUID as subdirectories.
+
+        :return: A path, like "/thumbs/1/2/12345678-(...).thumb.jpeg"
+        """
+        photo_id = str(self.id)
+        return os.path.join(
+            settings.IMAGE_THUMBS_DIR,
+            photo_id[0],
+            photo_id[1],
+            f"{photo_id}.thumb.jpeg",
+        )
+
+    def rendition_path(self, size: int, image_format: str) -> str:
+        """
+        Absolute path to one of the photo's renditions, next to its thumbnail
+        (see settings.THUMBNAIL_SIZES and settings.THUMBNAIL_FORMATS).
+
+        :param size: Largest width and height of the rendition, in pixels
+        :param image_format: A key of thumbnails.RENDITION_FORMATS
+        :return: A path, like "/thumbs/1/2/12345678-(...).512.webp"
+        """
+        extension = RENDITION_FORMATS[image_format].extension
+        return os.path.join(
+            os.path.dirname(self.thumbnail_path),
+            f"{self.id}.{size}.{extension}",
+        )
+
+    @property
+    def thumbnail_paths(self) -> List[str]:
+        """
+        Absolute paths to the photo's thumbnail and all of its renditions.
+
+        :return: A list of paths
+        """
+        return [self.thumbnail_path] + [
+            self.rendition_path(size, image_format)
+            for size in settings.THUMBNAIL_SIZES
+            for image_format in settings.THUMBNAIL_FORMATS
+        ]
+
+    @property
+    def thumbnail_version(self) -> str:
+        """
+        A version for the photo's thumbnail, used in its URL so that
+        browsers can cache it forever. It changes whenever the image
+        is processed with different contents, and whenever its thumbnail
+        is generated again, like after the thumbnail stage's version changes.
+
+        :return: A string, like "0123456789abcdef-1607472000000"
+        """
+        if self.content_hash:
+            if self.thumbnail_time:
+                milliseconds = int(self.thumbnail_time.timestamp() * 1000)
+                return f"{self.content_hash[:16]}-{milliseconds}"
+            return self.content_hash[:16]
+        if self.last_modified_time:
+            return str(int(self.last_modified_time.timestamp()))
+        return "0"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        photo = super(Photo, cls).from_db(db, field_names, values)
+        # To tell whether it changes (see save); None if it wasn't loaded
+        photo._saved_publicly_accessible = photo.__dict__.get("publicly_accessible")
+        return photo
+
+    def save(self, *args, **kwargs):
+        # Only absolute paths, from the admin, can be within the user's
+        # subdirectory; others are already relative to it
+        root = self.user.root_directory if str(self.file).startswith("/") else None
+        self.file = Photo.normalize_path(self.file, root)
+        if self.publicly_accessible or self._state.adding:
+            self.effectively_public = self.publicly_accessible
+        elif getattr(self, "_saved_publicly_accessible", None) is False:
+            # It depends on the photo's albums, which saving it doesn't
+            # change, and the value in memory may be out of date
+            update_fields = kwargs.get("update_fields")
+            if update_fields is None:
+                update_fields = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key
+                ]
+            kwargs["update_fields"] = [
+                field for field in update_fields if field != "effectively_public"
+            ]
+        # Otherwise, it is updated from the photo's albums once the photo has
+        # been saved (see albums.models.photo_saved)
+        super(Photo, self).save(*args, **kwargs)
+        self._saved_publicly_accessible = self.publicly_accessible
+
+
+class ScannedFile(models.Model):
+    """
+    Represents a file seen during a directory scan.
+
+    Together, these form a per-user manifest of the user's subdirectory,
+    so that subsequent scans only have to sniff and queue files whose
+    stat information (inode, size and modification time) has changed.
+    """
+
+    user = models.ForeignKey(
+        User, help_text="The user that this file belongs to.", on_delete=models.CASCADE
+    )
+    path = models.CharField(
+        max_length=4096,
+        help_text="Path to this file, relative to the user's subdirectory.",
+    )
+
+    inode = models.PositiveBigIntegerField(help_text="Inode number of this file.")
+    size = models.PositiveBigIntegerField(help_text="Size of this file, in bytes.")
+    mtime = models.BigIntegerField(
+        help_text="Modification time of this file, in nanoseconds since the epoch."
+    )
+    mime = models.CharField(
+        max_length=255,
+        blank=True,
+        help_text="MIME type of this file when it was last sniffed.",
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "path"], name="unique_scanned_file_path"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.path}"
+
+
+class ScannedDirectory(models.Model):
+    """
+    Represents a directory seen during a directory scan.
+
+    A directory's modification time changes whenever files are added
+    to, removed from or renamed within it. If it hasn't changed since
+    the last scan, the directory doesn't have to be listed again;
+    the scan only descends into the subdirectories recorded here.
+    """
+
+    user = models.ForeignKey(
+        User,
+        help_text="The user that this directory belongs to.",
+        on_delete=models.CASCADE,
+    )
+    path = models.CharField(
+        max_length=4096,
+        help_text="Path to this directory, relative to the user's subdirectory.",
+    )
+
+    mtime = models.BigIntegerField(
+        null=True,
+        help_text="Modification time of this directory, in nanoseconds since the epoch. "
+        "Null if it was modified too recently to be trusted.",
+    )
+    subdirectories = models.JSONField(
+        default=list, help_text="Names of the directories within this directory."
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "path"], name="unique_scanned_directory_path"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.path}"
+
+
+class ProcessingStage(models.Model):
+    """
+    Represents a stage of processing a photo (see tasks.process_image),
+    and whether it has run.
+
+    The version of the code or model that ran the stage is recorded, so
+    that only the stages that have changed are rerun after an upgrade
+    (see ./manage.py requeue_processing).
+    """
+
+    class Stage(models.TextChoices):
+        METADATA = "metadata", "Metadata"
+        THUMBNAIL = "thumbnail", "Thumbnail"
+        TAGGING = "tagging", "Tagging"
+        FACES = "faces", "Faces"
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    photo = models.ForeignKey(
+        Photo,
+        related_name="stages",
+        help_text="The photo being processed.",
+        on_delete=models.CASCADE,
+    )
+    stage = models.CharField(max_length=16, choices=Stage.choices)
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.PENDING
+    )
+    version = models.CharField(
+        max_length=64,
+        blank=True,
+        help_text="Version of the stage that last ran, or is running.",
+    )
+    error = models.TextField(blank=True, help_text="Why the stage last failed.")
+
+    last_modified_time = models.DateTimeField(
+        auto_now=True, help_text="When the status last changed."
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["photo", "stage"], name="unique_processing_stage"
+            )
+        ]
+        indexes = [models.Index(fields=["stage", "status", "version"])]
+
+    def __str__(self):
+        return f"{self.photo_id}: {self.stage} ({self.status})"
@@ -1,27 +1,43 @@
-import base64
+import functools
+import hashlib
 import io
 import json
 import multiprocessing
 import os
+import posixpath
+import shutil
 import subprocess
 import time
+import uuid
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
 
 import billiard
 import face_recognition
 import magic
 import pytz
-from celery import shared_task
+from celery import chain, group, shared_task
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
+from django.db.models import Count, Q
+from django.utils import timezone
 from exif import Image as exif_Image
 from PIL import Image as PIL_Image
 from PIL import ImageOps
 from timezonefinder import TimezoneFinder
 
+from photomanager.utils.files.rules import ScanRules, preset_excludes
+from photomanager.utils.files.walker import (
+    DirectoryCache,
+    open_beneath,
+    sniff_mime,
+    walk,
+)
+
 from ..faces.models import Face
 
 if settings.ENABLE_TENSORFLOW_TAGGING:
@@ -34,10 +50,67 @@ if settings.ENABLE_TENSORFLOW_TAGGING:
     from tensorflow.keras.preprocessing import image as keras_image
 
 from ..tags.models import PhotoTag
-from .models import Photo
+from .files import FileContents, read_file
+from .metadata import is_jpeg, jpeg_metadata_length
+from .models import Photo, ProcessingStage, ScannedDirectory, ScannedFile
+from .thumbnails import (
+    EXIF_ORIENTATION_TAG,
+    THUMBNAIL_SIZE,
+    TRANSPOSED_ORIENTATIONS,
+    can_save,
+    make_renditions,
+    save_rendition,
+)
 
 LOCK_EXPIRE = 60 * 10
 
+# Seconds before a scan lease expires if it is not renewed, and
+# how often it is renewed while a scan is running
+SCAN_LEASE_EXPIRE = 60 * 2
+SCAN_LEASE_HEARTBEAT = 30
+
+# Number of rows to write to the database at once during scans
+MANIFEST_BATCH_SIZE = 1000
+# Number of photos to process in a single task, queued at once during scans
+PROCESS_IMAGE_BATCH_SIZE = 50
+
+# Bytes read from the start of a photo to refresh its metadata, and the
+# most that are read if its metadata segments run further than that
+METADATA_READ_SIZE = 64 * 1024
+METADATA_MAX_READ_SIZE = 1024 * 1024
+
+# Seconds that a process may spend making a rendition on demand (see
+# make_rendition) before others stop waiting for it, and how often the
+# others check whether it is done
+RENDITION_LOCK_EXPIRE = 30
+RENDITION_POLL_INTERVAL = 0.1
+
+# Version of each stage of processing (see ProcessingStage). Change one
+# whenever that stage's results would change, like after upgrading the
+# model it uses, so that ./manage.py requeue_processing reruns only it.
+STAGE_VERSIONS = {
+    ProcessingStage.Stage.METADATA: "1",
+    ProcessingStage.Stage.THUMBNAIL: "2",
+    ProcessingStage.Stage.TAGGING: "nasnetlarge-imagenet-1",
+    ProcessingStage.Stage.FACES: "face-recognition-cnn-1",
+}
+
+# Fields set by process_image, which are the same for identical images
+PROCESSED_FIELDS = [
+    "photo_taken_time",
+    "image_height",
+    "image_width",
+    "image_size",
+    "camera_make",
+    "camera_model",
+    "aperture_value",
+    "shutter_speed_value",
+    "focal_length",
+    "iso",
+    "flash_fired",
+    "flash_mode",
+]
+
 
 @contextmanager
 def redis_lock(lock_id):
@@ -64,109 +137,881 @@ def redis_lock(lock_id):
             cache.delete(lock_id)
 
 
+@contextmanager
+def scan_lease(user_id: int):
+    """
+    Manages a lease on scanning a user's directory, so that
+    only one scan of a directory runs at a time.
+
+    The lease expires after SCAN_LEASE_EXPIRE seconds unless it is
+    renewed, so that a worker that crashed mid-scan doesn't hold on to
+    it forever. The scan must call the heartbeat function it is given
+    regularly; it only renews the lease every SCAN_LEASE_HEARTBEAT seconds.
+
+    :param user_id: The ID of the user whose directory is being scanned
+    :return: A heartbeat function if the lease was acquired, or None
+             if another scan of this directory holds it
+    """
+    lease_id = f"scan-lease-{user_id}"
+    token = str(uuid.uuid4())
+    acquired = cache.add(lease_id, token, timeout=SCAN_LEASE_EXPIRE)
+    last_renewal = time.monotonic()
+
+    def heartbeat() -> None:
+        nonlocal last_renewal
+        if time.monotonic() - last_renewal >= SCAN_LEASE_HEARTBEAT:
+            cache.touch(lease_id, SCAN_LEASE_EXPIRE)
+            last_renewal = time.monotonic()
+
+    try:
+        yield heartbeat if acquired else None
+    finally:
+        # Don't release the lease if it expired and someone else took it
+        if acquired and cache.get(lease_id) == token:
+            cache.delete(lease_id)
+
+
+def _schedule_next_scan(user_id: int, changed: bool) -> None:
+    """
+    Decides when a user's directory should next be scanned by
+    scan_all_dirs_for_changes.
+
+    Directories that change are scanned every DIRECTORY_SCAN_INTERVAL
+    seconds; each scan that finds nothing doubles the interval,
+    up to DIRECTORY_SCAN_MAX_INTERVAL seconds.
+
+    :param user_id: The ID of the user whose directory was scanned
+    :param changed: Whether the scan found any changes
+    :return: None
+    """
+    if changed:
+        interval = settings.DIRECTORY_SCAN_INTERVAL
+    else:
+        interval = min(
+            cache.get(f"scan-interval-{user_id}", settings.DIRECTORY_SCAN_INTERVAL) * 2,
+            settings.DIRECTORY_SCAN_MAX_INTERVAL,
+        )
+
+    cache.set(f"scan-interval-{user_id}", interval, timeout=None)
+    cache.set(f"scan-next-{user_id}", time.time() + interval, timeout=None)
+
+
+def scan_rules(directory: Path) -> ScanRules:
+    """
+    Gets the rules deciding which files in a directory are scanned,
+    from the DIRECTORY_SCAN_* settings.
+
+    :param directory: The directory being scanned
+    :return: ScanRules
+    """
+    return ScanRules(
+        includes=settings.DIRECTORY_SCAN_INCLUDE_GLOBS,
+        excludes=preset_excludes(settings.DIRECTORY_SCAN_PRESET, str(directory))
+        + list(settings.DIRECTORY_SCAN_EXCLUDE_GLOBS),
+    )
+
+
+def _load_manifest(user, paths: Iterable[str] = None) -> dict:
+    """
+    Loads the manifest of files seen during previous scans.
+
+    :param user: The user whose manifest to load
+    :param paths: If given, only load entries for these paths and
+                  for any files underneath them (if they are directories).
+    :return: A dict mapping paths to tuples of
+             (ScannedFile ID, [inode, size, mtime, mime])
+    """
+    entries = ScannedFile.objects.filter(user=user)
+    if paths is not None:
+        query = Q()
+        for path in paths:
+            query |= Q(path=path) | Q(path__startswith=path.rstrip("/") + "/")
+        entries = entries.filter(query)
+
+    return {
+        path: (entry_id, [inode, size, mtime, mime])
+        for path, entry_id, inode, size, mtime, mime in entries.values_list(
+            "path", "id", "inode", "size", "mtime", "mime"
+        )
+    }
+
+
+def _load_photos(user, paths: Iterable[str] = None) -> dict:
+    """
+    Loads the paths of a user's existing photos.
+
+    :param user: The user whose photos to load
+    :param paths: If given, only load photos for these paths
+                  (relative to the user's subdirectory, as in the manifest).
+    :return: A dict mapping the photos' file paths to their IDs
+    """
+    photos = Photo.objects.filter(user=user)
+    if paths is not None:
+        photos = photos.filter(file__in=[_photo_path(user, path) for path in paths])
+
+    return dict(photos.values_list("file", "id"))
+
+
+def _photo_path(user, path: str) -> str:
+    """
+    Gets the value of Photo.file for a file found during a scan.
+
+    :param user: The user that this file belongs to
+    :param path: The path of this file, relative to the user's subdirectory
+    :return: The value to use for Photo.file
+    """
+    return Photo.normalize_path(path)
+
+
+def _load_directories(user) -> dict:
+    """
+    Loads the directories seen during the previous scan.
+
+    :param user: The user whose directories to load
+    :return: A dict mapping paths to tuples of
+             (ScannedDirectory ID, mtime, [subdirectories])
+    """
+    return {
+        path: (entry_id, mtime, subdirectories)
+        for path, entry_id, mtime, subdirectories in ScannedDirectory.objects.filter(
+            user=user
+        ).values_list("path", "id", "mtime", "subdirectories")
+    }
+
+
+def _save_directories(user, known: dict, directories: DirectoryCache) -> None:
+    """
+    Saves the directories seen during a scan, replacing those
+    seen during the previous scan.
+
+    :param user: The user whose directories were scanned
+    :param known: The directories seen during the previous scan,
+                  as returned by _load_directories
+    :param directories: The directories seen during this scan
+    :return: None
+    """
+    new_entries = []
+    changed_entries = []
+    for path, (mtime, subdirectories) in directories.current.items():
+        entry_id, known_mtime, known_subdirectories = known.pop(
+            path, (None, None, None)
+        )
+        if entry_id is None:
+            new_entries.append(
+                ScannedDirectory(
+                    user=user, path=path, mtime=mtime, subdirectories=subdirectories
+                )
+            )
+        elif (known_mtime, known_subdirectories) != (mtime, subdirectories):
+            changed_entries.append(
+                ScannedDirectory(
+                    id=entry_id,
+                    user=user,
+                    path=path,
+                    mtime=mtime,
+                    subdirectories=subdirectories,
+                )
+            )
+
+    ScannedDirectory.objects.bulk_create(
+        new_entries, batch_size=MANIFEST_BATCH_SIZE, ignore_conflicts=True
+    )
+    ScannedDirectory.objects.bulk_update(
+        changed_entries, ["mtime", "subdirectories"], batch_size=MANIFEST_BATCH_SIZE
+    )
+
+    # Anything left was not seen during this scan
+    removed_ids = [entry_id for entry_id, _, _ in known.values()]
+    for i in range(0, len(removed_ids), MANIFEST_BATCH_SIZE):
+        ScannedDirectory.objects.filter(
+            id__in=removed_ids[i : i + MANIFEST_BATCH_SIZE]
+        ).delete()
+
+
+def _ingest_files(
+    user,
+    files: Iterable[Tuple[str, dict]],
+    manifest: dict,
+    photos: dict,
+    heartbeat: Callable[[], None] = None,
+) -> int:
+    """
+    Updates the manifest with the files given, and creates and queues
+    processing for any photos that are new or have changed.
+
+    Entries for the files given are removed from ``manifest``; whatever
+    remains afterwards was not seen. Files are consumed incrementally,
+    and database writes are made in batches of MANIFEST_BATCH_SIZE.
+
+    A new file with the same inode, size and modification time as a file in
+    the manifest may be that file, moved or renamed. These are held back until
+    every file has been seen; if the file in the manifest was not seen, it is
+    moved in place (see _move_files) instead of being treated as new.
+
+    :param user: The user that these files belong to
+    :param files: An iterable of (path, stat) tuples, where stat is a dict
+                  with "mime", "inode", "size" and "mtime" keys, as output
+                  by list_dir.py
+    :param manifest: The manifest, as returned by _load_manifest
+    :param photos: The user's existing photos, as returned by _load_photos
+    :param heartbeat: If given, called for every file (see scan_lease)
+    :return: The number of new, changed or moved files
+    """
+    batch = []
+    changed = 0
+
+    # Paths in the manifest, by their inode, size and modification time.
+    # Hard links share an inode, so they are ambiguous and left out.
+    moved_from = {}
+    for path, (_, known) in manifest.items():
+        key = tuple(known[:3])
+        moved_from[key] = None if key in moved_from else path
+    maybe_moved = []
+
+    for file, stat in files:
+        if heartbeat is not None:
+            heartbeat()
+
+        entry_id, known = manifest.pop(file, (None, None))
+        stat_list = [stat["inode"], stat["size"], stat["mtime"]]
+        if known is not None and known[:3] == stat_list:
+            # This file has not changed since the last scan
+            continue
+
+        changed += 1
+        if known is None and moved_from.get(tuple(stat_list)) is not None:
+            maybe_moved.append((file, stat))
+            continue
+
+        batch.append(_scanned_file(user, entry_id, file, stat))
+        if len(batch) >= MANIFEST_BATCH_SIZE:
+            _ingest_batch(user, batch, photos)
+            batch = []
+
+    moves = []
+    for file, stat in maybe_moved:
+        old_path = moved_from[(stat["inode"], stat["size"], stat["mtime"])]
+        if old_path in manifest and _photo_path(user, file) not in photos:
+            # The file in the manifest was not seen, so this is where it went
+            entry_id, _ = manifest.pop(old_path)
+            moves.append((old_path, _scanned_file(user, entry_id, file, stat)))
+        else:
+            batch.append(_scanned_file(user, None, file, stat))
+
+    _move_files(user, moves, photos)
+    for i in range(0, len(batch), MANIFEST_BATCH_SIZE):
+        _ingest_batch(user, batch[i : i + MANIFEST_BATCH_SIZE], photos)
+    return changed
+
+
+def _scanned_file(user, entry_id, path: str, stat: dict) -> ScannedFile:
+    """
+    Creates an unsaved manifest entry for a file.
+
+    :param user: The user that this file belongs to
+    :param entry_id: The ID of the file's existing entry, or None if it is new
+    :param path: The path of this file, relative to the user's subdirectory
+    :param stat: A dict with "mime", "inode", "size" and "mtime" keys
+    :return: An unsaved ScannedFile
+    """
+    return ScannedFile(
+        id=entry_id,
+        user=user,
+        path=path,
+        inode=stat["inode"],
+        size=stat["size"],
+        mtime=stat["mtime"],
+        mime=stat["mime"],
+    )
+
+
+def _move_files(user, moves: List[Tuple[str, ScannedFile]], photos: dict) -> None:
+    """
+    Moves files that were moved or renamed in the manifest, along with
+    their photos. Photos keep their tags, faces, albums and thumbnails,
+    and are not processed again.
+
+    :param user: The user that these files belong to
+    :param moves: A list of (old path, unsaved ScannedFile) tuples, where the
+                  ScannedFile has the ID of the old entry and the new path
+    :param photos: The user's existing photos, as returned by _load_photos;
+                   moved photos are updated in it
+    :return: None
+    """
+    # Not every photo is in photos when only some files are being checked
+    old_photos = dict(
+        Photo.objects.filter(
+            user=user, file__in=[_photo_path(user, path) for path, _ in moves]
+        ).values_list("file", "id")
+    )
+
+    moved_photos = []
+    for old_path, entry in moves:
+        photo_id = old_photos.get(_photo_path(user, old_path))
+        if photo_id is not None:
+            new_path = _photo_path(user, entry.path)
+            moved_photos.append(Photo(id=photo_id, user=user, file=new_path))
+            photos.pop(_photo_path(user, old_path), None)
+            photos[new_path] = photo_id
+
+    ScannedFile.objects.bulk_update(
+        [entry for _, entry in moves],
+        ["path", "inode", "size", "mtime", "mime"],
+        batch_size=MANIFEST_BATCH_SIZE,
+    )
+    Photo.objects.bulk_update(moved_photos, ["file"], batch_size=MANIFEST_BATCH_SIZE)
+
+
+def _ingest_batch(user, batch: List[ScannedFile], photos: dict) -> None:
+    """
+    Writes a batch of new or changed files to the manifest, creates
+    any new photos among them in bulk, and queues processing for new
+    and changed photos in batches of PROCESS_IMAGE_BATCH_SIZE.
+
+    :param user: The user that these files belong to
+    :param batch: A list of unsaved ScannedFiles; those with an ID
+                  already exist in the manifest and have changed
+    :param photos: The user's existing photos, as returned by _load_photos;
+                   photos that are created are added to it
+    :return: None
+    """
+    new_photos = []
+    photo_ids_to_process = []
+
+    for entry in batch:
+        if "image" in entry.mime:
+            actual_path = _photo_path(user, entry.path)
+            if actual_path not in photos:
+                photo = Photo(
+                    file=actual_path, file_type=Photo.FileTypes.IMAGE, user=user
+                )
+                new_photos.append(photo)
+                photos[actual_path] = photo.id
+                photo_ids_to_process.append(str(photo.id))
+            elif entry.id is not None:
+                # The file has changed since the last scan
+                photo_ids_to_process.append(str(photos[actual_path]))
+        elif "video" in entry.mime:
+            pass
+
+    # Another scan may have created some of these photos in the meantime,
+    # in which case our rows are not inserted. Those photos are left
+    # for the scan that created them to process.
+    Photo.objects.bulk_create(
+        new_photos, batch_size=MANIFEST_BATCH_SIZE, ignore_conflicts=True
+    )
+    if new_photos:
+        created_ids = set(
+            Photo.objects.filter(id__in=[photo.id for photo in new_photos]).values_list(
+                "id", flat=True
+            )
+        )
+        conflicting_photos = [
+            photo for photo in new_photos if photo.id not in created_ids
+        ]
+        for photo in conflicting_photos:
+            photo_ids_to_process.remove(str(photo.id))
+        photos.update(
+            Photo.objects.filter(
+                user=user, file__in=[photo.file for photo in conflicting_photos]
+            ).values_list("file", "id")
+        )
+
+    ScannedFile.objects.bulk_create(
+        [entry for entry in batch if entry.id is None],
+        batch_size=MANIFEST_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    ScannedFile.objects.bulk_update(
+        [entry for entry in batch if entry.id is not None],
+        ["inode", "size", "mtime", "mime"],
+        batch_size=MANIFEST_BATCH_SIZE,
+    )
+
+    for i in range(0, len(photo_ids_to_process), PROCESS_IMAGE_BATCH_SIZE):
+        process_images.delay(photo_ids_to_process[i : i + PROCESS_IMAGE_BATCH_SIZE])
+
+
+def _remove_files(user, manifest: dict) -> None:
+    """
+    Removes the files left in a manifest, which no longer exist, from the
+    database, along with their photos and the photos' thumbnails.
+
+    :param user: The user that these files belong to
+    :param manifest: The manifest, as returned by _load_manifest
+    :return: None
+    """
+    removed = list(manifest.items())
+    for i in range(0, len(removed), MANIFEST_BATCH_SIZE):
+        chunk = removed[i : i + MANIFEST_BATCH_SIZE]
+
+        removed_photos = list(
+            Photo.objects.filter(
+                user=user, file__in=[_photo_path(user, path) for path, _ in chunk]
+            ).only("id")
+        )
+        Photo.objects.filter(id__in=[photo.id for photo in removed_photos]).delete()
+        for photo in removed_photos:
+            for thumbnail_path in photo.thumbnail_paths:
+                try:
+                    os.remove(thumbnail_path)
+                except FileNotFoundError:
+                    pass
+
+        ScannedFile.objects.filter(
+            id__in=[entry_id for _, (entry_id, _) in chunk]
+        ).delete()
+
+
 @shared_task
-def scan_dir_for_changes(directory: Path, username: str) -> None:
+def scan_dir_for_changes(
+    directory: Path, username: str, coalesce: bool = True, full: bool = False
+) -> None:
     """
     Scans the directory given for new files.
-    Queues new tasks for any new files found.
+    Queues new tasks for any new or changed files found.
+
+    A manifest of the files seen during the previous scan is kept
+    (see ``ScannedFile``); files whose inode, size and modification
+    time have not changed are neither sniffed nor queued again.
+
+    When scanning in-process, directories whose modification time has not
+    changed since the previous scan are not listed again (see ``ScannedDirectory``).
+    Every DIRECTORY_FULL_SCAN_INTERVAL seconds, every directory is listed,
+    to pick up files that were modified in place.
+
+    Only one scan of a user's directory runs at a time (see scan_lease).
 
     :param directory: The directory to scan.
     :param username: Username that this directory corresponds to
+    :param coalesce: If another scan of this directory is already running,
+                     whether to have it scan again once it finishes.
+                     Otherwise, this scan is skipped.
+    :param full: List every directory, even those that haven't changed
     :return: None
     """
 
+    user = get_user_model().objects.get(username=username)
+
+    with scan_lease(user.id) as heartbeat:
+        if heartbeat is None:
+            # A full scan is requested over any other, but not the other way around
+            if coalesce and full:
+                cache.set(
+                    f"scan-requested-{user.id}", "full", timeout=SCAN_LEASE_EXPIRE
+                )
+            elif coalesce:
+                cache.add(
+                    f"scan-requested-{user.id}", "changed", timeout=SCAN_LEASE_EXPIRE
+                )
+            return
+
+        # Load the manifest from the previous scan
+        manifest = _load_manifest(user)
+        total = len(manifest)
+        photos = _load_photos(user)
+
+        directories = None
+        failed = set()
+        if settings.DIRECTORY_SCAN_IN_PROCESS:
+            known_directories = _load_directories(user)
+            full = full or time.time() >= cache.get(f"scan-full-next-{user.id}", 0)
+            directories = DirectoryCache(
+                None
+                if full
+                else {
+                    path: (mtime, subdirectories)
+                    for path, (_, mtime, subdirectories) in known_directories.items()
+                }
+            )
+            listing = _walk_dir(directory, manifest, scan_rules(directory), directories)
+        else:
+            listing = _list_dir(directory, manifest, failed)
+
+        changed = _ingest_files(user, listing, manifest, photos, heartbeat)
+
+        unchanged = set()
+        if directories is not None:
+            unchanged = directories.unchanged
+            failed = directories.failed
+        # Files in directories that weren't listed were not seen, but still
+        # exist, and those underneath directories that couldn't be listed
+        # (which may only be for a while) are kept as well
+        for path in [
+            path
+            for path in manifest
+            if posixpath.dirname(path) in unchanged or _is_beneath(path, failed)
+        ]:
+            del manifest[path]
+
+        if directories is not None:
+            _save_directories(user, known_directories, directories)
+            if full:
+                cache.set(
+                    f"scan-full-next-{user.id}",
+                    time.time() + settings.DIRECTORY_FULL_SCAN_INTERVAL,
+                    timeout=None,
+                )
+
+        # Anything left in the manifest was not seen during this scan.
+        # If nothing at all was seen, the directory is more likely to be
+        # unmounted than empty, so nothing is removed.
+        if len(manifest) < total:
+            _remove_files(user, manifest)
+
+        _schedule_next_scan(user.id, changed > 0 or len(manifest) > 0)
+
+    # Scans that were requested while this one was running are coalesced into one
+    requested = cache.get(f"scan-requested-{user.id}")
+    if cache.delete(f"scan-requested-{user.id}"):
+        scan_dir_for_changes.delay(directory, username, full=requested == "full")
+
+
+def _is_beneath(path: str, directories: Set[str]) -> bool:
+    """
+    Whether a path is underneath any of the directories given.
+
+    :param path: Path relative to a user's directory, like "/hello/hello.jpeg"
+    :param directories: Paths of directories in the same format, like "/hello"
+    :return: True if the path is underneath one of them, at any depth
+    """
+    if not directories:
+        return False
+    while path != "/":
+        path = posixpath.dirname(path)
+        if path in directories:
+            return True
+    return False
+
+
+def _walk_dir(
+    directory: Path,
+    manifest: dict,
+    rules: ScanRules,
+    directories: DirectoryCache = None,
+) -> Iterator[Tuple[str, dict]]:
+    """
+    Lists a directory in-process, using a symlink-safe walker.
+    Only files that have changed since the last scan are sniffed.
+
+    :param directory: The directory to list.
+    :param manifest: The manifest, as returned by _load_manifest
+    :param rules: Rules deciding which files are listed
+    :param directories: If given, directories that haven't changed
+                        since the previous scan are not listed
+    :return: An iterator of (path, stat) tuples, in the same format
+             as the output of list_dir.py
+    """
+    m = magic.Magic(mime=True)
+    for entry in walk(str(directory), rules, directories):
+        known = manifest.get(entry.path, (None, None))[1]
+        if known is not None and known[:3] == [entry.inode, entry.size, entry.mtime]:
+            mime = known[3]
+        else:
+            try:
+                fd = entry.open()
+            except OSError:
+                continue
+            try:
+                mime = sniff_mime(fd, m)
+            finally:
+                os.close(fd)
+
+        yield entry.path, {
+            "mime": mime,
+            "inode": entry.inode,
+            "size": entry.size,
+            "mtime": entry.mtime,
+        }
+
+
+def _list_dir(
+    directory: Path, manifest: dict, failed: Set[str] = None
+) -> Iterator[Tuple[str, dict]]:
+    """
+    Lists a directory by running list_dir.py as root, in a chroot.
+    Files are read from list_dir.py as they are found.
+
+    :param directory: The directory to list.
+    :param manifest: The manifest, as returned by _load_manifest
+    :param failed: If given, directories that couldn't be listed are added to it
+    :return: An iterator of (path, stat) tuples
+    """
     LIST_DIR_PATH = os.path.join(
         os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
         "utils/files/list_dir.py",
     )
 
-    # First, list the directory
     # sudo required for chroot
-    contents = subprocess.run(
-        ["sudo", "pipenv", "run", "python3", LIST_DIR_PATH, str(directory)],
-        capture_output=True,
+    with subprocess.Popen(
+        [
+            "sudo",
+            "pipenv",
+            "run",
+            "python3",
+            LIST_DIR_PATH,
+            str(directory),
+            "--manifest",
+            "-",
+            "--ndjson",
+        ]
+        + (
+            ["--preset", settings.DIRECTORY_SCAN_PRESET]
+            if settings.DIRECTORY_SCAN_PRESET
+            else []
+        )
+        + [f"--include={glob}" for glob in settings.DIRECTORY_SCAN_INCLUDE_GLOBS]
+        + [f"--exclude={glob}" for glob in settings.DIRECTORY_SCAN_EXCLUDE_GLOBS],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
         text=True,
-    )
+    ) as process:
+        # list_dir.py reads the entire manifest before it starts listing
+        json.dump({path: known for path, (_, known) in manifest.items()}, process.stdin)
+        process.stdin.close()
+
+        for line in process.stdout:
+            record = json.loads(line)
+            if "error" in record:
+                break
+            if "failed" in record:
+                if failed is not None:
+                    failed.add(record["failed"])
+                continue
+            yield record.pop("path"), record
 
-    if contents.returncode != 0:
+    if process.returncode != 0:
         raise Exception()
 
+
+@shared_task
+def scan_files_for_changes(directory: Path, username: str, files: List[str]) -> None:
+    """
+    Checks the files given for changes, without scanning the entire directory.
+    Used by the directory watcher (see the watch_directories management command).
+    Queues new tasks for any new or changed files found.
+
+    :param directory: The directory that the files are in.
+    :param username: Username that this directory corresponds to
+    :param files: Paths to check, relative to directory, like those output by
+                  list_dir.py. If a path is a directory that no longer exists,
+                  all files underneath it that were previously seen are removed.
+    :return: None
+    """
     user = get_user_model().objects.get(username=username)
 
-    for file, mime in json.loads(contents.stdout).items():
-        if "image" in mime:
-            # file must be prepended with user.subdirectory
-            actual_path = os.path.join("/data/", str(user.subdirectory), file)
-            photo = Photo.objects.get_or_create(
-                file=actual_path, file_type=Photo.FileTypes.IMAGE, user=user
+    manifest = _load_manifest(user, files)
+
+    rules = scan_rules(directory)
+    m = magic.Magic(mime=True)
+    listing = []
+    existing_directories = []
+    for file in files:
+        if rules.excludes_path(file):
+            continue
+
+        # Symlinks are not followed, so nothing outside of directory can be read
+        try:
+            fd = open_beneath(str(directory), file)
+        except OSError:
+            continue
+
+        try:
+            stat = os.fstat(fd)
+            if S_ISDIR(stat.st_mode):
+                # This directory still exists, so files underneath it that were
+                # not listed explicitly should not be treated as removed
+                existing_directories.append(file.rstrip("/") + "/")
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+
+            stat_list = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            known = manifest.get(file, (None, None))[1]
+            if known is not None and known[:3] == stat_list:
+                mime = known[3]
+            else:
+                mime = sniff_mime(fd, m)
+        finally:
+            os.close(fd)
+
+        listing.append(
+            (
+                file,
+                {
+                    "mime": mime,
+                    "inode": stat.st_ino,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                },
             )
-            if photo[1]:  # If this was just created by get_or_create
-                process_image.delay(photo[0].id)
-        elif "video" in mime:
-            pass
+        )
+
+    _ingest_files(user, listing, manifest, _load_photos(user, files))
+
+    # Anything else left in the manifest no longer exists
+    for path in [
+        path
+        for path in manifest
+        if any(path.startswith(prefix) for prefix in existing_directories)
+    ]:
+        del manifest[path]
+    _remove_files(user, manifest)
 
 
 @shared_task
-def scan_all_dirs_for_changes() -> None:
+def scan_all_dirs_for_changes(force: bool = False) -> None:
     """
     Scan all directories held by all users for changes.
     Queues new tasks for any new files found.
 
+    When the directory watcher is running, this acts as a
+    reconciliation scan, picking up anything the watcher missed.
+
+    Directories that rarely change are scanned less often
+    (see _schedule_next_scan), and directories that are
+    already being scanned are skipped.
+
+    :param force: Scan all directories, even those that aren't due yet
     :return: None
     """
     for user in get_user_model().objects.all():
-        scan_dir_for_changes.delay(user.subdirectory, user.username)
+        # Directories due before the next run are scanned now
+        next_scan = cache.get(f"scan-next-{user.id}", 0)
+        if force or time.time() + settings.DIRECTORY_SCAN_INTERVAL / 2 >= next_scan:
+            scan_dir_for_changes.delay(
+                user.root_directory, user.username, coalesce=force
+            )
 
 
 @shared_task
-def process_image(photo_id: str) -> None:
+def process_images(photo_ids: List[str]) -> None:
     """
-    Process an image.
+    Process a batch of images.
+    Used during scans, so that one task is queued per batch
+    instead of one per image.
 
-    :param photo_id: The UUID of a photo
+    :param photo_ids: The UUIDs of the photos
     :return: None
     """
-    photo = Photo.objects.get(id=photo_id)
+    error = None
+    for photo_id in photo_ids:
+        # A failure shouldn't stop the rest of the batch from being processed
+        try:
+            process_image(photo_id)
+        except Exception as e:
+            error = error or e
 
-    # Read this file
-    READ_FILE_PATH = os.path.join(
-        os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
-        "utils/files/read_file.py",
+    if error is not None:
+        raise error
+
+
+def _reuse_processed_photo(photo: Photo, original: Photo) -> bool:
+    """
+    Reuses the metadata, automatically generated tags, faces and thumbnail
+    of a photo that has already been processed, for an identical copy of it.
+
+    Tags that users added themselves are not reused, since the
+    original may belong to someone else. Faces can't be told apart
+    that way, so they are only reused if it doesn't; otherwise, they
+    are detected again.
+
+    :param photo: The photo being processed
+    :param original: A processed photo with the same contents
+    :return: Whether the original could be reused; it can't if
+             its thumbnail is missing
+    """
+    Path(os.path.dirname(photo.thumbnail_path)).mkdir(parents=True, exist_ok=True)
+    try:
+        shutil.copyfile(original.thumbnail_path, photo.thumbnail_path)
+    except FileNotFoundError:
+        return False
+    # Renditions the original doesn't have are made when it is reprocessed
+    for original_path, path in zip(original.thumbnail_paths, photo.thumbnail_paths):
+        try:
+            shutil.copyfile(original_path, path)
+        except FileNotFoundError:
+            pass
+
+    for field in PROCESSED_FIELDS:
+        setattr(photo, field, getattr(original, field))
+    photo.content_hash = original.content_hash
+    photo.thumbnail_time = timezone.now()
+    photo.save()
+
+    photo.tags.add(*original.tags.filter(is_auto_generated=True))
+    same_user = photo.user_id == original.user_id
+    if same_user:
+        photo.faces.add(*original.faces.all())
+
+    # The metadata stage is still running. Stages the original hasn't been
+    # through at their current versions are run for the copy.
+    reused = {
+        stage: version
+        for stage, version in original.stages.filter(status=ProcessingStage.Status.DONE)
+        .exclude(stage=ProcessingStage.Stage.METADATA)
+        .values_list("stage", "version")
+        if STAGE_VERSIONS.get(stage) == version
+        and (same_user or stage != ProcessingStage.Stage.FACES)
+    }
+    photo.stages.exclude(stage=ProcessingStage.Stage.METADATA).delete()
+    ProcessingStage.objects.bulk_create(
+        [
+            ProcessingStage(
+                photo=photo,
+                stage=stage,
+                status=ProcessingStage.Status.DONE,
+                version=version,
+            )
+            for stage, version in reused.items()
+        ]
     )
-    # TODO: find a better way to do this
-    file_path = "/data/" + str(photo.file).lstrip("/")
-    file_read: dict = json.loads(
-        subprocess.run(
-            [
-                "sudo",
-                "pipenv",
-                "run",
-                "python3",
-                READ_FILE_PATH,
-                file_path,
-            ],  # sudo required for chroot
-            capture_output=True,
-            text=True,
-        ).stdout
+    queue_processing_stages(
+        str(photo.id),
+        [stage for stage in enabled_stages() if stage not in reused],
     )
+    return True
 
-    if "error" in file_read.keys():
-        if file_read["error"] == 404:
-            raise Exception()
-        elif file_read["error"] == 500:
-            raise Exception()
 
-    assert "image" in file_read[file_path]["mime"], "Not an image"
+def _read_metadata(photo: Photo) -> Optional[FileContents]:
+    """
+    Reads the start of a JPEG photo, up to the end of its metadata
+    segments (EXIF and XMP), without reading the image itself.
 
-    image_data: bytes = base64.b64decode(file_read[file_path]["data"])
+    METADATA_READ_SIZE bytes are read first, which is usually enough;
+    if the metadata runs further, up to METADATA_MAX_READ_SIZE bytes are.
 
-    m = magic.Magic(mime=True)
-    assert "image" in m.from_buffer(image_data), "Not an image file"
+    :param photo: The photo
+    :raises The same exceptions as read_file
+    :return: FileContents, or None if the photo isn't a JPEG file
+    """
+    contents = read_file(photo.absolute_path, 0, METADATA_READ_SIZE)
+    assert "image" in contents.mime, "Not an image"
+    if not is_jpeg(contents.data):
+        return None
 
-    exif_image = exif_Image(image_data)
+    data = contents.data
+    length = jpeg_metadata_length(data)
+    while len(data) < length <= METADATA_MAX_READ_SIZE:
+        more = read_file(photo.absolute_path, len(data), length - len(data)).data
+        if not more:
+            # The file ends before its metadata does
+            break
+        data += more
+        length = jpeg_metadata_length(data)
 
-    # Update the photo's metadata
+    return contents._replace(data=data)
+
+
+def _update_metadata(photo: Photo, exif_image: exif_Image) -> None:
+    """
+    Sets a photo's metadata from its EXIF data, without saving it.
 
+    :param photo: The photo
+    :param exif_image: The photo's EXIF data
+    :return: None
+    """
     if "datetime" in dir(exif_image):
         # EXIF does not include timezones (WHY?!?) in timestamps.
         # Therefore, we use the GPS location to find the timezone of the image,
@@ -193,14 +1038,6 @@ def process_image(photo_id: str) -> None:
             exif_image.datetime, "%Y:%m:%d %H:%M:%S"
         ).replace(tzinfo=pytz.timezone(tz))
 
-    # Height and width are a property of every image
-    image_pillow = PIL_Image.open(io.BytesIO(image_data))
-    image_pillow = ImageOps.exif_transpose(image_pillow)
-    width, height = image_pillow.size
-    photo.image_width = width
-    photo.image_height = height
-    photo.image_size = file_read[file_path]["size"]
-
     if "make" in dir(exif_image):
         photo.camera_make = exif_image.make
     if "model" in dir(exif_image):
@@ -217,96 +1054,429 @@ def process_image(photo_id: str) -> None:
         photo.flash_fired = exif_image.flash.flash_fired
         photo.flash_mode = exif_image.flash.flash_mode
 
+
+def enabled_stages() -> List[str]:
+    """
+    Gets the stages of processing that are enabled.
+
+    :return: A list of ProcessingStage.Stage values, in the order they run
+    """
+    stages = [ProcessingStage.Stage.METADATA, ProcessingStage.Stage.THUMBNAIL]
     if settings.ENABLE_TENSORFLOW_TAGGING:
-        # We only want to run one tagging operation at a time since it is memory intensive
-        with redis_lock("tensorflow-tag"):
-            # We define get_predictions to allow for a timeout
-            # The queue is created to grab the return value
-            queue = multiprocessing.Queue()
-
-            def get_predictions(img_pillow: PIL_Image):
-                """
-                Helper function to determine tags of an image
-                :param img_pillow: Pillow.Image
-                :return: None (results appended to queue)
-                """
-                model = NASNetLarge(weights="imagenet")
-                image_tags = keras_image.img_to_array(
-                    img_pillow.resize((331, 331), PIL_Image.NEAREST)
-                )
-                image_tags = np.expand_dims(image_tags, axis=0)
-                image_tags = preprocess_input(image_tags)
-                predictions = model.predict(image_tags)
-                queue.put(decode_predictions(predictions)[0])
+        stages.append(ProcessingStage.Stage.TAGGING)
+    if settings.ENABLE_FACE_RECOGNITION:
+        stages.append(ProcessingStage.Stage.FACES)
+    return stages
+
+
+def processing_stage(stage: str) -> Callable:
+    """
+    Decorates the task for a stage of processing, so that whether it is
+    running, done or failed is recorded (see ProcessingStage), along with
+    its version (see STAGE_VERSIONS).
+
+    :param stage: A ProcessingStage.Stage value
+    :return: A decorator, for a function taking a photo ID first
+    """
 
-            process = billiard.context.Process(
-                target=get_predictions, kwargs={"img_pillow": image_pillow}
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(photo_id: str, *args, **kwargs):
+            ProcessingStage.objects.update_or_create(
+                photo_id=photo_id,
+                stage=stage,
+                defaults={
+                    "status": ProcessingStage.Status.RUNNING,
+                    "version": STAGE_VERSIONS[stage],
+                    "error": "",
+                },
             )
-            process.daemon = True
-            process.start()
-
-            process.join(60)  # 60 second (arbitrary) timeout
-            if process.is_alive():
-                process.terminate()
-                raise TimeoutError
-
-            decoded_predictions = queue.get()
-
-            for prediction in decoded_predictions:
-                if (
-                    prediction[2] > 0.20
-                ):  # If score greater than 0.20 (chosen arbitrarily)
-                    tag = PhotoTag.objects.get_or_create(tag=prediction[1])
-                    if tag[1]:  # If an object was created
-                        tag[0].is_auto_generated = True
-                        tag[0].save()
-                    photo.tags.add(tag[0])
+            stages = ProcessingStage.objects.filter(photo_id=photo_id, stage=stage)
+            try:
+                result = function(photo_id, *args, **kwargs)
+            except Exception as e:
+                stages.update(status=ProcessingStage.Status.FAILED, error=repr(e))
+                raise
+            stages.update(status=ProcessingStage.Status.DONE)
+            return result
 
-    if settings.ENABLE_FACE_RECOGNITION:
-        # We can only do one at a time to prevent duplicates
-        with redis_lock("face-recognition"):
-            # We now need to convert the image to a NumPy array in order to do anything with it
-            np_array = np.array(image_pillow)
-
-            # Now, get the face encodings for the face(s) in this image
-            encodings = face_recognition.face_encodings(np_array, model="cnn")
-
-            # Loop over all the encodings detected
-
-            # First, we have to query the database
-            faces = list(Face.objects.all())
-            faces_data = [json.loads(s.face_data) for s in faces]
-            for encoding in encodings:
-                # Now, we compare to the list of faces in the database
-                # TODO: This needs to be more efficient
-                compare = face_recognition.compare_faces(faces_data, encoding)
-
-                # If a face already exists, then it should have a True value in that array,
-                # corresponding to the faces list
-                # TODO: Deduplicate somehow?
-                if any(compare):
-                    # Find the indices that are True, and take the same index in the faces list
-                    for i in range(len(compare)):
-                        if compare[i]:
-                            photo.faces.add(faces[i])
+        return wrapper
 
-                # If no face exists, then add one
-                face = Face.objects.create(face_data=json.dumps(encoding.tolist()))
-                photo.faces.add(face)
+    return decorator
 
-    # We will need to make a thumbnail of this image
-    image_pillow.thumbnail((1024, 1024))
 
-    # Save the thumbnail in a directory
-    # This directory is under settings.IMAGE_THUMBS_DIR, and
-    # we use the first two characters of the photo's UUID as subdirectories
-    # to save images under
+def queue_processing_stages(photo_id: str, stages: Iterable[str] = None) -> None:
+    """
+    Queues the stages of processing a photo that follow process_image:
+    generate_thumbnail, then tag_image and detect_faces (if enabled)
+    at the same time. The stages queued are recorded as pending.
+
+    Each stage saves its results before the next one starts, and has a
+    queue of its own (see settings.CELERY_TASK_ROUTES), so that the slow
+    ones can be given their own workers, or paused.
+
+    :param photo_id: The UUID of a photo
+    :param stages: The stages to queue; all of those enabled, if not given.
+                   The metadata stage is never queued by this.
+    :return: None
+    """
+    stages = [
+        stage
+        for stage in enabled_stages()
+        if stage != ProcessingStage.Stage.METADATA
+        and (stages is None or stage in stages)
+    ]
+    if not stages:
+        return
 
-    path = os.path.join(settings.IMAGE_THUMBS_DIR, photo_id[0], photo_id[1])
-    Path(os.path.join(settings.IMAGE_THUMBS_DIR, photo_id[0], photo_id[1])).mkdir(
-        parents=True, exist_ok=True
+    ProcessingStage.objects.filter(photo_id=photo_id, stage__in=stages).update(
+        status=ProcessingStage.Status.PENDING
+    )
+    ProcessingStage.objects.bulk_create(
+        [ProcessingStage(photo_id=photo_id, stage=stage) for stage in stages],
+        ignore_conflicts=True,
     )
 
-    image_pillow.save(os.path.join(path, f"{photo_id}.thumb.jpeg"))
+    tasks = {
+        ProcessingStage.Stage.TAGGING: tag_image,
+        ProcessingStage.Stage.FACES: detect_faces,
+    }
+    after = [tasks[stage].si(photo_id) for stage in stages if stage in tasks]
+    if ProcessingStage.Stage.THUMBNAIL not in stages:
+        group(after).delay()
+    elif after:
+        chain(generate_thumbnail.si(photo_id), group(after)).delay()
+    else:
+        generate_thumbnail.delay(photo_id)
+
+
+@shared_task
+@processing_stage(ProcessingStage.Stage.METADATA)
+def process_image(
+    photo_id: str, metadata_only: bool = False, stages: List[str] = None
+) -> None:
+    """
+    Process an image. This is the first stage of processing, which
+    reads the image's metadata, then queues the rest
+    (see queue_processing_stages).
+
+    If another photo with the same contents has already been processed
+    (for instance, a copy in a shared folder), its results are reused
+    instead (see _reuse_processed_photo).
+
+    :param photo_id: The UUID of a photo
+    :param metadata_only: Whether to only refresh the metadata of a photo that
+                          has already been processed; only the start of the
+                          file is read (see _read_metadata). Photos that aren't
+                          JPEG files, or haven't been processed, are processed
+                          in full.
+    :param stages: The stages to queue once this one is done (see
+                   queue_processing_stages); all of those enabled, if not
+                   given, or none when only the metadata is refreshed.
+    :return: None
+    """
+    photo = Photo.objects.get(id=photo_id)
+
+    if metadata_only and photo.content_hash:
+        contents = _read_metadata(photo)
+        if contents is not None:
+            _update_metadata(photo, exif_Image(contents.data))
+            photo.image_size = contents.size
+            photo.save()
+            if stages is not None:
+                queue_processing_stages(str(photo.id), stages)
+            return
+
+    # Read this file
+    contents = read_file(photo.absolute_path)
+    assert "image" in contents.mime, "Not an image"
 
+    m = magic.Magic(mime=True)
+    assert "image" in m.from_buffer(contents.data), "Not an image file"
+
+    content_hash = hashlib.blake2b(contents.data, digest_size=32).hexdigest()
+    # Preferably one that has been through every stage already
+    current_stages = Q()
+    for stage, version in STAGE_VERSIONS.items():
+        current_stages |= Q(stages__stage=stage, stages__version=version)
+    original = (
+        Photo.objects.filter(content_hash=content_hash)
+        .exclude(id=photo.id)
+        .annotate(
+            current_stages=Count(
+                "stages",
+                filter=Q(stages__status=ProcessingStage.Status.DONE) & current_stages,
+            )
+        )
+        .order_by("-current_stages")
+        .first()
+    )
+    if original is not None and _reuse_processed_photo(photo, original):
+        return
+
+    # Update the photo's metadata
+    _update_metadata(photo, exif_Image(contents.data))
+
+    # Height and width are a property of every image. Only the image's
+    # header is read here; it is decoded by generate_thumbnail.
+    image_pillow = PIL_Image.open(io.BytesIO(contents.data))
+    width, height = image_pillow.size
+    if image_pillow.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+        # Rotated by 90 degrees (see ImageOps.exif_transpose)
+        width, height = height, width
+    photo.image_width = width
+    photo.image_height = height
+    photo.image_size = contents.size
+
+    photo.content_hash = content_hash
     photo.save()
+
+    queue_processing_stages(str(photo.id), stages)
+
+
+@shared_task
+@processing_stage(ProcessingStage.Stage.THUMBNAIL)
+def generate_thumbnail(photo_id: str) -> None:
+    """
+    Generates the thumbnail of an image that has been through process_image,
+    and its renditions at settings.THUMBNAIL_EAGER_SIZES, and saves them
+    (see Photo.thumbnail_path and Photo.rendition_path). Other renditions
+    are removed, and made again the first time they are asked for (see
+    make_rendition).
+
+    :param photo_id: The UUID of a photo
+    :return: None
+    """
+    photo = Photo.objects.select_related("user").get(id=photo_id)
+    contents = read_file(photo.absolute_path)
+    _save_thumbnails(
+        photo,
+        contents.data,
+        settings.THUMBNAIL_EAGER_SIZES,
+        settings.THUMBNAIL_FORMATS,
+        thumbnail=True,
+    )
+
+    # Other renditions may have been made from older contents
+    for size in set(settings.THUMBNAIL_SIZES) - set(settings.THUMBNAIL_EAGER_SIZES):
+        for image_format in settings.THUMBNAIL_FORMATS:
+            try:
+                os.remove(photo.rendition_path(size, image_format))
+            except FileNotFoundError:
+                pass
+
+    # Gives the thumbnails new URLs (see Photo.thumbnail_version)
+    Photo.objects.filter(id=photo.id).update(thumbnail_time=timezone.now())
+
+
+def make_rendition(
+    photo: Photo, size: Optional[int] = None, image_format: Optional[str] = None
+) -> bool:
+    """
+    Makes one of a photo's renditions, or its thumbnail, that is missing
+    while a request waits for it. The database isn't used, so this can
+    run in any thread.
+
+    Only one process makes it at a time; the others wait until it has been
+    saved, for up to RENDITION_LOCK_EXPIRE seconds, rather than decoding
+    the photo again themselves.
+
+    :param photo: Photo object, with its user already loaded
+    :param size: Size of the rendition (see settings.THUMBNAIL_SIZES),
+                 or None for the thumbnail
+    :param image_format: Format of the rendition, or None for the thumbnail
+    :return: Whether it exists now; it can't be made if the photo can't be read
+    """
+    if size is None:
+        path = photo.thumbnail_path
+    else:
+        path = photo.rendition_path(size, image_format)
+
+    lock_id = f"rendition-{path}"
+    token = str(uuid.uuid4())
+    deadline = time.monotonic() + RENDITION_LOCK_EXPIRE
+    while not os.path.exists(path):
+        if cache.add(lock_id, token, timeout=RENDITION_LOCK_EXPIRE):
+            try:
+                # It may have been saved while this was checking the lock
+                if not os.path.exists(path):
+                    contents = read_file(photo.absolute_path)
+                    if size is None:
+                        _save_thumbnails(photo, contents.data, (), (), thumbnail=True)
+                    else:
+                        _save_thumbnails(photo, contents.data, (size,), (image_format,))
+            except OSError:
+                return False
+            finally:
+                if cache.get(lock_id) == token:
+                    cache.delete(lock_id)
+            break
+
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(RENDITION_POLL_INTERVAL)
+
+    return os.path.exists(path)
+
+
+def _save_thumbnails(
+    photo: Photo,
+    data: bytes,
+    sizes: Iterable[int],
+    image_formats: Iterable[str],
+    thumbnail: bool = False,
+) -> None:
+    """
+    Saves a photo's renditions, and optionally its thumbnail, decoding it once.
+
+    :param photo: Photo object
+    :param data: The photo file's contents
+    :param sizes: Sizes of the renditions to save
+    :param image_formats: Formats to save each of them in; formats that
+                          Pillow can't save are skipped
+    :param thumbnail: Whether to save its thumbnail too
+    :return: None
+    """
+    image_formats = [
+        image_format for image_format in image_formats if can_save(image_format)
+    ]
+    rendition_sizes = set(sizes) if image_formats else set()
+    decoded_sizes = rendition_sizes | ({max(THUMBNAIL_SIZE)} if thumbnail else set())
+    if not decoded_sizes:
+        return
+
+    # Save the thumbnails in a directory (see Photo.thumbnail_path)
+    Path(os.path.dirname(photo.thumbnail_path)).mkdir(parents=True, exist_ok=True)
+
+    # Decoded once at a reduced scale, and only rotated once it is small
+    for size, image_pillow in make_renditions(data, decoded_sizes):
+        if thumbnail and size == max(THUMBNAIL_SIZE):
+            save_rendition(image_pillow, photo.thumbnail_path, "jpeg")
+        if size in rendition_sizes:
+            for image_format in image_formats:
+                save_rendition(
+                    image_pillow, photo.rendition_path(size, image_format), image_format
+                )
+
+
+def _open_image(photo: Photo, thumbnail: bool = False) -> PIL_Image.Image:
+    """
+    Opens a photo's image to be analyzed, the right way up.
+
+    :param photo: A photo
+    :param thumbnail: Whether to open its thumbnail (see generate_thumbnail)
+        instead, which is much faster to decode. The photo itself is opened
+        if the thumbnail has been removed.
+    :return: The image, in RGB
+    """
+    if thumbnail:
+        try:
+            return PIL_Image.open(photo.thumbnail_path).convert("RGB")
+        except FileNotFoundError:
+            pass
+
+    image_pillow = PIL_Image.open(io.BytesIO(read_file(photo.absolute_path).data))
+    return ImageOps.exif_transpose(image_pillow).convert("RGB")
+
+
+@shared_task
+@processing_stage(ProcessingStage.Stage.TAGGING)
+def tag_image(photo_id: str) -> None:
+    """
+    Tags an image automatically with NASNet, from its thumbnail if it has
+    one; NASNet only looks at 331x331 pixels anyway.
+
+    :param photo_id: The UUID of a photo
+    :return: None
+    """
+    photo = Photo.objects.get(id=photo_id)
+    image_pillow = _open_image(photo, thumbnail=True)
+
+    # We only want to run one tagging operation at a time since it is memory intensive
+    with redis_lock("tensorflow-tag"):
+        # We define get_predictions to allow for a timeout
+        # The queue is created to grab the return value
+        queue = multiprocessing.Queue()
+
+        def get_predictions(img_pillow: PIL_Image):
+            """
+            Helper function to determine tags of an image
+            :param img_pillow: Pillow.Image
+            :return: None (results appended to queue)
+            """
+            model = NASNetLarge(weights="imagenet")
+            image_tags = keras_image.img_to_array(
+                img_pillow.resize((331, 331), PIL_Image.NEAREST)
+            )
+            image_tags = np.expand_dims(image_tags, axis=0)
+            image_tags = preprocess_input(image_tags)
+            predictions = model.predict(image_tags)
+            queue.put(decode_predictions(predictions)[0])
+
+        process = billiard.context.Process(
+            target=get_predictions, kwargs={"img_pillow": image_pillow}
+        )
+        process.daemon = True
+        process.start()
+
+        process.join(60)  # 60 second (arbitrary) timeout
+        if process.is_alive():
+            process.terminate()
+            raise TimeoutError
+
+        decoded_predictions = queue.get()
+
+        for prediction in decoded_predictions:
+            if prediction[2] > 0.20:  # If score greater than 0.20 (chosen arbitrarily)
+                tag = PhotoTag.objects.get_or_create(tag=prediction[1])
+                if tag[1]:  # If an object was created
+                    tag[0].is_auto_generated = True
+                    tag[0].save()
+                photo.tags.add(tag[0])
+
+
+@shared_task
+@processing_stage(ProcessingStage.Stage.FACES)
+def detect_faces(photo_id: str) -> None:
+    """
+    Finds the faces in an image and matches them with the faces already
+    known. The full image is used, not its thumbnail: small faces would be
+    missed in a thumbnail, and the encodings of the others wouldn't match
+    the ones already saved.
+
+    :param photo_id: The UUID of a photo
+    :return: None
+    """
+    photo = Photo.objects.get(id=photo_id)
+    image_pillow = _open_image(photo)
+
+    # We can only do one at a time to prevent duplicates
+    with redis_lock("face-recognition"):
+        # We now need to convert the image to a NumPy array in order to do anything with it
+        np_array = np.array(image_pillow)
+
+        # Now, get the face encodings for the face(s) in this image
+        encodings = face_recognition.face_encodings(np_array, model="cnn")
+
+        # Loop over all the encodings detected
+
+        # First, we have to query the database
+        faces = list(Face.objects.all())
+        faces_data = [json.loads(s.face_data) for s in faces]
+        for encoding in encodings:
+            # Now, we compare to the list of faces in the database
+            # TODO: This needs to be more efficient
+            compare = face_recognition.compare_faces(faces_data, encoding)
+
+            # If a face already exists, then it should have a True value in that array,
+            # corresponding to the faces list. This includes the faces found when this
+            # stage last ran for this photo, so running it again doesn't duplicate them.
+            if any(compare):
+                # Find the indices that are True, and take the same index in the faces list
+                for i in range(len(compare)):
+                    if compare[i]:
+                        photo.faces.add(faces[i])
+            else:
+                # If no face exists, then add one
+                face = Face.objects.create(face_data=json.dumps(encoding.tolist()))
+                photo.faces.add(face)
@@ -0,0 +1,45 @@
+from django import template
+from django.conf import settings
+
+from ..media import sign_media_url
+
+register = template.Library()
+
+
+@register.simple_tag
+def thumbnail_url(photo) -> str:
+    """
+    Gets a signed URL for a photo's thumbnail; see media.sign_media_url.
+    Only use this for photos that the page is allowed to show.
+
+    :param photo: Photo object
+    :return: A URL
+    """
+    return sign_media_url(photo, "thumbnail")
+
+
+@register.simple_tag
+def thumbnail_srcset(photo) -> str:
+    """
+    Gets a srcset listing a photo's renditions (see settings.THUMBNAIL_SIZES),
+    with signed URLs; only use this for photos that the page is allowed to show.
+
+    Sizes past the photo's own size would all be the same image, so only
+    the first of them is listed.
+
+    :param photo: Photo object
+    :return: A srcset, like "/photos/media/(...)?width=256 256w, (...)"
+    """
+    url = sign_media_url(photo, "thumbnail")
+    longest = 0
+    if photo.image_width and photo.image_height:
+        longest = max(photo.image_width, photo.image_height)
+
+    candidates = []
+    for size in sorted(settings.THUMBNAIL_SIZES):
+        # Renditions keep the photo's aspect ratio, so can be narrower than this
+        width = round(photo.image_width * min(size / longest, 1)) if longest else size
+        candidates.append(f"{url}?width={size} {width}w")
+        if longest and size >= longest:
+            break
+    return ", ".join(candidates)
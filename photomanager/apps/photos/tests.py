@@ -0,0 +1,1307 @@
+import asyncio
+import io
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory
+from django.urls import reverse
+from PIL import Image as PIL_Image
+
+from photomanager.celery import app as celery_app
+from photomanager.handlers import ASGIHandler
+from photomanager.test.photomanger_test import PhotomanagerTestCase
+from photomanager.utils.files.read_file_server import ReadFileServer
+
+from .files import open_file
+from .management.commands.watch_directories import Command as WatchDirectoriesCommand
+from .media import (
+    _read_semaphore,
+    run_once,
+    serve_file,
+    serve_file_async,
+    sign_media_url,
+)
+from .metadata import jpeg_metadata_length
+from .models import Photo, ScannedDirectory, ScannedFile
+from .tasks import (
+    STAGE_VERSIONS,
+    _open_image,
+    _reuse_processed_photo,
+    make_rendition,
+    process_image,
+    scan_dir_for_changes,
+    scan_files_for_changes,
+    scan_lease,
+)
+from .thumbnails import make_thumbnail
+
+
+class PhotoTestCase(PhotomanagerTestCase):
+    """Tests the Photo model."""
+
+    def test_normalize_path(self):
+        """
+        Tests that photo paths are normalized relative to the user's subdirectory.
+
+        :return: None
+        """
+        self.assertEqual("a/b.jpg", Photo.normalize_path("/a/b.jpg"))
+        self.assertEqual("a/b.jpg", Photo.normalize_path("a//./c/../b.jpg"))
+        self.assertEqual("b.jpg", Photo.normalize_path("/../../b.jpg"))
+        with self.assertRaises(ValueError):
+            Photo.normalize_path("/")
+
+        user = self.login()
+        user.subdirectory = "/data/jdoe"
+        user.save()
+
+        photo = Photo.objects.create(file="/a/./b.jpg", user=user)
+        self.assertEqual("a/b.jpg", Photo.objects.get(id=photo.id).file)
+        self.assertEqual("/data/jdoe/a/b.jpg", photo.absolute_path)
+
+        # The admin offers absolute paths
+        self.assertEqual(
+            "c.jpg", Photo.normalize_path("/data/jdoe/c.jpg", "/data/jdoe")
+        )
+        self.assertEqual(
+            "data/jdoe/c.jpg", Photo.normalize_path("/data/jdoe/c.jpg", "/data/jd")
+        )
+        photo = Photo.objects.create(file="/data/jdoe/c/./d.jpg", user=user)
+        self.assertEqual("c/d.jpg", Photo.objects.get(id=photo.id).file)
+        self.assertEqual("/data/jdoe/c/d.jpg", photo.absolute_path)
+
+    def test_unique_file(self):
+        """
+        Tests that a user can't have two photos for the same file.
+
+        :return: None
+        """
+        user = self.login()
+        Photo.objects.create(file="a/b.jpg", user=user)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Photo.objects.create(file="/a/b.jpg", user=user)
+
+        # A different user can have a photo with the same path
+        Photo.objects.create(file="a/b.jpg", user=self.login("user2"))
+
+        # Conflicting rows are ignored when creating photos in bulk
+        Photo.objects.bulk_create(
+            [Photo(file="a/b.jpg", user=user)], ignore_conflicts=True
+        )
+        self.assertEqual(1, Photo.objects.filter(user=user).count())
+
+
+class OpenFileTestCase(PhotomanagerTestCase):
+    def test_open_file_from_server(self):
+        """
+        Tests that open_file opens files through the file reader.
+
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hello.txt")
+            with open(path, "w") as file:
+                file.write("hello")
+
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    opened = open_file(path)
+                    with self.assertRaises(FileNotFoundError):
+                        open_file(os.path.join(directory, "nonexistent.txt"))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            with opened.file:
+                self.assertEqual(b"hello", opened.file.read())
+            self.assertEqual(("text/plain", 5), (opened.mime, opened.size))
+
+
+class ServeFileTestCase(PhotomanagerTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_serve_file(self):
+        """
+        Tests sending files in each MEDIA_SERVE_MODE.
+
+        :return: None
+        """
+        request = self.factory.get("/")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hello world.jpeg")
+            with open(path, "w") as file:
+                file.write("hello")
+
+            response = serve_file(request, path, trusted=True)
+            self.assertEqual(b"hello", b"".join(response.streaming_content))
+            self.assertEqual("bytes", response["Accept-Ranges"])
+            response.close()
+            self.assertEqual(
+                404,
+                serve_file(request, path + ".nonexistent", trusted=True).status_code,
+            )
+
+            with self.settings(
+                MEDIA_SERVE_MODE="x-accel-redirect",
+                MEDIA_ACCEL_REDIRECT_LOCATIONS={directory: "/protected/"},
+            ):
+                response = serve_file(request, path)
+                self.assertEqual(
+                    "/protected/hello%20world.jpeg", response["X-Accel-Redirect"]
+                )
+                self.assertEqual("image/jpeg", response["Content-Type"])
+                self.assertEqual(b"", response.content)
+
+                with self.assertRaises(ImproperlyConfigured):
+                    serve_file(request, "/elsewhere/hello.jpeg")
+
+            with self.settings(MEDIA_SERVE_MODE="x-sendfile"):
+                self.assertEqual(path, serve_file(request, path)["X-Sendfile"])
+
+    def test_serve_file_ranges(self):
+        """
+        Tests that range requests are answered with only the ranges requested.
+
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hello.jpeg")
+            with open(path, "wb") as file:
+                file.write(b"0123456789")
+
+            def get(header: str):
+                response = serve_file(
+                    self.factory.get("/", HTTP_RANGE=header), path, trusted=True
+                )
+                content = b"".join(response.streaming_content)
+                response.close()
+                return response, content
+
+            for header, content_range, expected in [
+                ("bytes=2-4", "bytes 2-4/10", b"234"),
+                ("bytes=7-", "bytes 7-9/10", b"789"),
+                ("bytes=-3", "bytes 7-9/10", b"789"),
+                ("bytes=8-100", "bytes 8-9/10", b"89"),
+            ]:
+                response, content = get(header)
+                self.assertEqual(206, response.status_code)
+                self.assertEqual(content_range, response["Content-Range"])
+                self.assertEqual(str(len(expected)), response["Content-Length"])
+                self.assertEqual(expected, content)
+
+            response, content = get("bytes=0-1, 5-6")
+            self.assertEqual(206, response.status_code)
+            self.assertEqual(str(len(content)), response["Content-Length"])
+            boundary = response["Content-Type"].split("boundary=")[1]
+            self.assertEqual(
+                f"--{boundary}\r\n"
+                "Content-Type: image/jpeg\r\n"
+                "Content-Range: bytes 0-1/10\r\n\r\n"
+                "01\r\n"
+                f"--{boundary}\r\n"
+                "Content-Type: image/jpeg\r\n"
+                "Content-Range: bytes 5-6/10\r\n\r\n"
+                "56\r\n"
+                f"--{boundary}--\r\n",
+                content.decode(),
+            )
+
+            response = serve_file(
+                self.factory.get("/", HTTP_RANGE="bytes=10-"), path, trusted=True
+            )
+            self.assertEqual(416, response.status_code)
+            self.assertEqual("bytes */10", response["Content-Range"])
+
+            # Invalid ranges are ignored
+            response, content = get("bytes=5-2")
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b"0123456789", content)
+
+            # Ranges are only sent if If-Range matches
+            for if_range, status_code in [('"hello"', 206), ('"goodbye"', 200)]:
+                response = serve_file(
+                    self.factory.get(
+                        "/", HTTP_RANGE="bytes=2-4", HTTP_IF_RANGE=if_range
+                    ),
+                    path,
+                    trusted=True,
+                    etag='"hello"',
+                )
+                self.assertEqual(status_code, response.status_code)
+                response.close()
+
+    def test_serve_file_async(self):
+        """
+        Tests that small files are read into memory off the event loop,
+        and that the number of files read at once is limited.
+
+        :return: None
+        """
+        request = self.factory.get("/")
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            MEDIA_MAX_CONCURRENT_READS=1
+        ):
+            path = os.path.join(directory, "hello.jpeg")
+            with open(path, "w") as file:
+                file.write("hello")
+
+            async def serve():
+                # Wait for the file being read to finish
+                semaphore = _read_semaphore()
+                async with semaphore:
+                    task = asyncio.ensure_future(
+                        serve_file_async(request, path, trusted=True)
+                    )
+                    await asyncio.sleep(0.1)
+                    self.assertFalse(task.done())
+                return await task
+
+            response = async_to_sync(serve)()
+            self.assertFalse(response.streaming)
+            self.assertEqual(b"hello", response.content)
+            self.assertEqual("5", response["Content-Length"])
+            self.assertEqual("bytes", response["Accept-Ranges"])
+
+            # Larger files are still streamed
+            with self.settings(MEDIA_BUFFER_SIZE=4):
+                response = async_to_sync(serve_file_async)(request, path, trusted=True)
+                self.assertEqual(b"hello", b"".join(response.streaming_content))
+                response.close()
+
+    def test_stream_off_event_loop(self):
+        """
+        Tests that streaming responses are read in worker
+        threads, rather than on the event loop.
+
+        :return: None
+        """
+        threads = []
+
+        def content():
+            for part in (b"hel", b"lo"):
+                threads.append(threading.current_thread())
+                yield part
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def serve():
+            await ASGIHandler().send_response(StreamingHttpResponse(content()), send)
+            return threading.current_thread()
+
+        event_loop_thread = async_to_sync(serve)()
+        self.assertEqual(2, len(threads))
+        self.assertNotIn(event_loop_thread, threads)
+        self.assertEqual(200, messages[0]["status"])
+        self.assertEqual(
+            b"hello", b"".join(message.get("body", b"") for message in messages[1:])
+        )
+        self.assertFalse(messages[-1].get("more_body", False))
+
+    def test_run_once(self):
+        """
+        Tests that a function run with run_once is only run once at a time
+        for each key, with every caller getting its result.
+
+        :return: None
+        """
+        calls = []
+        release = threading.Event()
+
+        def work(number: int) -> int:
+            calls.append(number)
+            release.wait(5)
+            return number
+
+        async def run():
+            jobs = [
+                asyncio.ensure_future(run_once("a", work, 1)),
+                asyncio.ensure_future(run_once("a", work, 2)),
+                asyncio.ensure_future(run_once("b", work, 3)),
+            ]
+            await asyncio.sleep(0.1)
+            release.set()
+            return await asyncio.gather(*jobs)
+
+        self.assertEqual([1, 1, 3], async_to_sync(run)())
+        self.assertEqual([1, 3], sorted(calls))
+
+        # Once it is done, it is run again
+        self.assertEqual(4, async_to_sync(run_once)("a", work, 4))
+
+
+class RawImageTestCase(PhotomanagerTestCase):
+    def test_thumbnail_caching(self):
+        """
+        Tests that thumbnails are sent with validators, that conditional
+        requests are answered with 304s, and that versioned thumbnail
+        URLs are cached forever.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory
+        ):
+            photo = Photo.objects.create(
+                user=user, file="hello.jpeg", content_hash="0123456789abcdef" * 4
+            )
+            os.makedirs(os.path.dirname(photo.thumbnail_path))
+            with open(photo.thumbnail_path, "w") as file:
+                file.write("thumbnail")
+
+            url = reverse("photos:thumbnail", args=[photo.id, photo.thumbnail_version])
+            self.assertEqual(f"/photos/thumbnail/{photo.id}/0123456789abcdef", url)
+
+            response = self.client.get(url)
+            self.assertEqual(b"thumbnail", response.content)
+            self.assertEqual('"0123456789abcdef-thumbnail"', response["ETag"])
+            self.assertIn("immutable", response["Cache-Control"])
+            self.assertIn("private", response["Cache-Control"])
+            response.close()
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(304, response.status_code)
+            response = self.client.get(
+                url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+            )
+            self.assertEqual(304, response.status_code)
+
+            # Old versions are still sent, but have to be revalidated
+            response = self.client.get(
+                reverse("photos:thumbnail", args=[photo.id, "old"])
+            )
+            self.assertEqual(b"thumbnail", response.content)
+            self.assertIn("no-cache", response["Cache-Control"])
+            last_modified = response["Last-Modified"]
+            response.close()
+
+            # Regenerated thumbnails are modified, even if the photo isn't
+            Photo.objects.filter(id=photo.id).update(
+                thumbnail_time=photo.last_modified_time + timedelta(hours=1)
+            )
+            response = self.client.get(
+                reverse("photos:thumbnail", args=[photo.id, "old"]),
+                HTTP_IF_MODIFIED_SINCE=last_modified,
+            )
+            self.assertEqual(200, response.status_code)
+            self.assertNotEqual(last_modified, response["Last-Modified"])
+            response.close()
+
+    def test_signed_thumbnail(self):
+        """
+        Tests that signed thumbnail URLs are sent without touching the
+        database, and are refused once tampered with or expired.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory
+        ):
+            photo = Photo.objects.create(
+                user=user, file="hello.jpeg", content_hash="0123456789abcdef" * 4
+            )
+            os.makedirs(os.path.dirname(photo.thumbnail_path))
+            with open(photo.thumbnail_path, "w") as file:
+                file.write("thumbnail")
+
+            url = sign_media_url(photo)
+            # The same URL is used for every page rendered for a while
+            self.assertEqual(url, sign_media_url(photo))
+
+            self.client.logout()
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(b"thumbnail", response.content)
+            self.assertEqual('"0123456789abcdef-thumbnail"', response["ETag"])
+            self.assertIn("immutable", response["Cache-Control"])
+            self.assertIn("private", response["Cache-Control"])
+
+            # As served under ASGI
+            response = async_to_sync(self.async_client.get)(url)
+            self.assertEqual(b"thumbnail", response.content)
+
+            prefix, expires, signature = url.rsplit("/", 2)
+            for tampered in (
+                url.replace(str(photo.id), str(uuid.uuid4())),
+                url.replace("/thumbnail/", "/original/"),
+                f"{prefix}/{int(expires) + 1}/{signature}",
+                f"{prefix}/{expires}/{signature[:-1]}",
+            ):
+                self.assertEqual(403, self.client.get(tampered).status_code)
+
+            with self.settings(SIGNED_MEDIA_URL_LIFETIME=-1):
+                self.assertEqual(
+                    403, self.client.get(sign_media_url(photo)).status_code
+                )
+
+    def test_thumbnail_renditions(self):
+        """
+        Tests that signed thumbnail URLs send the smallest rendition that
+        is large enough, in a format the browser accepts, and that srcsets
+        list the renditions.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory,
+            THUMBNAIL_SIZES=(256, 512, 1024, 2048),
+            THUMBNAIL_FORMATS=("webp",),
+        ):
+            photo = Photo.objects.create(
+                user=user,
+                file="hello.jpeg",
+                content_hash="0123456789abcdef" * 4,
+                image_width=600,
+                image_height=1200,
+            )
+            os.makedirs(os.path.dirname(photo.thumbnail_path))
+            for path in photo.thumbnail_paths:
+                with open(path, "w") as file:
+                    file.write(os.path.basename(path))
+
+            url = sign_media_url(photo)
+            self.assertEqual(
+                f"{url}?width=256 128w, {url}?width=512 256w, "
+                f"{url}?width=1024 512w, {url}?width=2048 600w",
+                Template("{% load photo_media %}{% thumbnail_srcset photo %}").render(
+                    Context({"photo": photo})
+                ),
+            )
+
+            webp = "image/avif,image/webp,image/apng,*/*;q=0.8"
+            for query, accept, rendition in [
+                ("?width=300", webp, "512.webp"),
+                ("?width=256", webp, "256.webp"),
+                ("", webp, "1024.webp"),
+                ("?width=5000", webp, "2048.webp"),
+                ("?width=wide", webp, "1024.webp"),
+                ("?width=300", "image/webp;q=0, */*", "thumbnail"),
+                ("?width=300", "*/*", "thumbnail"),
+            ]:
+                response = self.client.get(url + query, HTTP_ACCEPT=accept)
+                self.assertEqual(
+                    os.path.basename(photo.thumbnail_path)
+                    if rendition == "thumbnail"
+                    else f"{photo.id}.{rendition}",
+                    response.content.decode(),
+                )
+                self.assertEqual(f'"0123456789abcdef-{rendition}"', response["ETag"])
+                self.assertIn("Accept", response["Vary"])
+                self.assertEqual(
+                    "image/jpeg" if rendition == "thumbnail" else "image/webp",
+                    response["Content-Type"],
+                )
+
+    def test_lazy_thumbnails(self):
+        """
+        Tests that thumbnails and renditions that are missing are made
+        when they are asked for, and saved.
+
+        :return: None
+        """
+        user = self.login()
+        image = io.BytesIO()
+        PIL_Image.new("RGB", (3000, 1500)).save(image, "JPEG")
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory,
+            THUMBNAIL_SIZES=(256, 512, 1024, 2048),
+            THUMBNAIL_FORMATS=("webp",),
+        ):
+            user.subdirectory = directory
+            user.save()
+            with open(os.path.join(directory, "hello.jpeg"), "wb") as file:
+                file.write(image.getvalue())
+            photo = Photo.objects.create(user=user, file="hello.jpeg")
+            missing = Photo.objects.create(user=user, file="missing.jpeg")
+
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    response = self.client.get(
+                        sign_media_url(photo) + "?width=2048",
+                        HTTP_ACCEPT="image/webp",
+                    )
+                    self.assertEqual(200, response.status_code)
+                    with PIL_Image.open(io.BytesIO(response.content)) as rendition:
+                        self.assertEqual(
+                            ("WEBP", (2048, 1024)), (rendition.format, rendition.size)
+                        )
+                    self.assertTrue(os.path.exists(photo.rendition_path(2048, "webp")))
+                    # Only the rendition asked for is made
+                    self.assertFalse(os.path.exists(photo.rendition_path(512, "webp")))
+                    self.assertFalse(os.path.exists(photo.thumbnail_path))
+
+                    response = self.client.get(
+                        reverse(
+                            "photos:thumbnail",
+                            args=[photo.id, photo.thumbnail_version],
+                        )
+                    )
+                    self.assertEqual(200, response.status_code)
+                    with PIL_Image.open(io.BytesIO(response.content)) as thumbnail:
+                        self.assertEqual((1024, 512), thumbnail.size)
+
+                    response = self.client.get(sign_media_url(missing))
+                    self.assertEqual(404, response.status_code)
+
+                    # Processes waiting for another one to make a rendition
+                    # don't make it themselves
+                    path = photo.rendition_path(256, "webp")
+                    cache.add(f"rendition-{path}", "other", timeout=10)
+
+                    def make():
+                        time.sleep(0.2)
+                        with open(path, "w") as file:
+                            file.write("made elsewhere")
+
+                    threading.Thread(target=make).start()
+                    self.assertTrue(make_rendition(photo, 256, "webp"))
+                    with open(path) as file:
+                        self.assertEqual("made elsewhere", file.read())
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+class ProcessImageTestCase(PhotomanagerTestCase):
+    """Tests processing images."""
+
+    def test_reuse_processed_photo(self):
+        """
+        Tests that a copy of a photo that was already processed reuses
+        its metadata, automatically generated tags, faces and thumbnail,
+        and that the stages the original hasn't been through are queued.
+
+        :return: None
+        """
+        user = self.login()
+        image = io.BytesIO()
+        PIL_Image.new("RGB", (640, 480)).save(image, "JPEG")
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory,
+            THUMBNAIL_FORMATS=(),
+            ENABLE_TENSORFLOW_TAGGING=False,
+            ENABLE_FACE_RECOGNITION=False,
+        ):
+            user.subdirectory = directory
+            user.save()
+            with open(os.path.join(directory, "copy.jpeg"), "wb") as file:
+                file.write(image.getvalue())
+            original = Photo.objects.create(
+                user=user,
+                file="original.jpeg",
+                image_width=640,
+                image_height=480,
+                camera_make="Hello",
+                content_hash="0" * 64,
+            )
+            original.tags.create(tag="auto", is_auto_generated=True)
+            original.tags.create(tag="manual")
+            original.faces.create(face_data="[]")
+            original.stages.create(
+                stage="thumbnail", status="done", version=STAGE_VERSIONS["thumbnail"]
+            )
+
+            copy = Photo.objects.create(user=user, file="copy.jpeg")
+
+            # Without a thumbnail, the copy has to be processed from scratch
+            self.assertFalse(_reuse_processed_photo(copy, original))
+
+            os.makedirs(os.path.dirname(original.thumbnail_path))
+            with open(original.thumbnail_path, "w") as file:
+                file.write("thumbnail")
+            self.assertTrue(_reuse_processed_photo(copy, original))
+
+            copy.refresh_from_db()
+            self.assertEqual((640, 480), (copy.image_width, copy.image_height))
+            self.assertEqual("Hello", copy.camera_make)
+            self.assertEqual("0" * 64, copy.content_hash)
+            self.assertEqual(["auto"], [tag.tag for tag in copy.tags.all()])
+            self.assertEqual(1, copy.faces.count())
+            with open(copy.thumbnail_path) as file:
+                self.assertEqual("thumbnail", file.read())
+            self.assertEqual(
+                {("thumbnail", "done", STAGE_VERSIONS["thumbnail"])},
+                set(copy.stages.values_list("stage", "status", "version")),
+            )
+
+            # Faces may have been named by the original's owner
+            other_user = get_user_model().objects.create(username=str(uuid.uuid4()))
+            other_copy = Photo.objects.create(user=other_user, file="copy.jpeg")
+            self.assertTrue(_reuse_processed_photo(other_copy, original))
+            self.assertEqual(["auto"], [tag.tag for tag in other_copy.tags.all()])
+            self.assertEqual(0, other_copy.faces.count())
+
+            # The original's thumbnail is out of date, so the copy's is remade
+            original.stages.update(version="0")
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            celery_app.conf.task_always_eager = True
+            celery_app.conf.task_eager_propagates = True
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    self.assertTrue(_reuse_processed_photo(copy, original))
+            finally:
+                celery_app.conf.task_always_eager = False
+                celery_app.conf.task_eager_propagates = False
+                server.shutdown()
+                server.server_close()
+            self.assertEqual(
+                {("thumbnail", "done", STAGE_VERSIONS["thumbnail"])},
+                set(copy.stages.values_list("stage", "status", "version")),
+            )
+            with PIL_Image.open(copy.thumbnail_path) as thumbnail:
+                self.assertEqual((640, 480), thumbnail.size)
+
+    def test_requeue_photos_processed_before_stages(self):
+        """
+        Tests that photos processed before stages were recorded only have
+        the stages that changed since rerun, unless they were never processed.
+
+        :return: None
+        """
+        user = self.login()
+        image = io.BytesIO()
+        PIL_Image.new("RGB", (640, 480)).save(image, "JPEG")
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory,
+            THUMBNAIL_FORMATS=(),
+            ENABLE_TENSORFLOW_TAGGING=False,
+            ENABLE_FACE_RECOGNITION=False,
+        ):
+            user.subdirectory = directory
+            user.save()
+            for name in ["old.jpeg", "new.jpeg"]:
+                with open(os.path.join(directory, name), "wb") as file:
+                    file.write(image.getvalue())
+
+            # As recorded by migration 0013 for photos that have a thumbnail
+            old = Photo.objects.create(user=user, file="old.jpeg")
+            os.makedirs(os.path.dirname(old.thumbnail_path))
+            with open(old.thumbnail_path, "w") as file:
+                file.write("thumbnail")
+            for stage, version in [("metadata", "1"), ("thumbnail", "1")]:
+                old.stages.create(stage=stage, status="done", version=version)
+            new = Photo.objects.create(user=user, file="new.jpeg")
+
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            celery_app.conf.task_always_eager = True
+            celery_app.conf.task_eager_propagates = True
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    call_command("requeue_processing", stdout=io.StringIO())
+            finally:
+                celery_app.conf.task_always_eager = False
+                celery_app.conf.task_eager_propagates = False
+                server.shutdown()
+                server.server_close()
+
+            old.refresh_from_db()
+            new.refresh_from_db()
+            # Only the thumbnail stage has changed since
+            self.assertEqual("", old.content_hash)
+            with PIL_Image.open(old.thumbnail_path) as thumbnail:
+                self.assertEqual((640, 480), thumbnail.size)
+            self.assertEqual(
+                {
+                    ("metadata", "done", "1"),
+                    ("thumbnail", "done", STAGE_VERSIONS["thumbnail"]),
+                },
+                set(old.stages.values_list("stage", "status", "version")),
+            )
+            self.assertTrue(new.content_hash)
+            self.assertTrue(os.path.exists(new.thumbnail_path))
+
+    def test_open_image(self):
+        """
+        Tests that images are analyzed from their thumbnails only when
+        asked to, and from the photos themselves if thumbnails are missing.
+
+        :return: None
+        """
+        user = self.login()
+        image = io.BytesIO()
+        PIL_Image.new("RGB", (2048, 1024)).save(image, "JPEG")
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory
+        ):
+            user.subdirectory = directory
+            user.save()
+            with open(os.path.join(directory, "hello.jpeg"), "wb") as file:
+                file.write(image.getvalue())
+            photo = Photo.objects.create(user=user, file="hello.jpeg")
+            os.makedirs(os.path.dirname(photo.thumbnail_path))
+            PIL_Image.new("L", (1024, 512)).save(photo.thumbnail_path, "JPEG")
+
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    image_pillow = _open_image(photo)
+                    self.assertEqual(
+                        ("RGB", (2048, 1024)), (image_pillow.mode, image_pillow.size)
+                    )
+                    image_pillow = _open_image(photo, thumbnail=True)
+                    self.assertEqual(
+                        ("RGB", (1024, 512)), (image_pillow.mode, image_pillow.size)
+                    )
+
+                    os.remove(photo.thumbnail_path)
+                    image_pillow = _open_image(photo, thumbnail=True)
+                    self.assertEqual((2048, 1024), image_pillow.size)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_process_image_stages(self):
+        """
+        Tests that processing an image saves its metadata, then
+        generates its thumbnail in a stage of its own, and that
+        only the stages that need to be are requeued.
+
+        :return: None
+        """
+        user = self.login()
+        image = io.BytesIO()
+        PIL_Image.new("RGB", (2048, 1024)).save(image, "JPEG")
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory,
+            THUMBNAIL_SIZES=(256, 512, 1024),
+            THUMBNAIL_FORMATS=("webp",),
+            THUMBNAIL_EAGER_SIZES=(256, 512),
+            ENABLE_TENSORFLOW_TAGGING=False,
+            ENABLE_FACE_RECOGNITION=False,
+        ):
+            user.subdirectory = directory
+            user.save()
+            with open(os.path.join(directory, "hello.jpeg"), "wb") as file:
+                file.write(image.getvalue())
+            photo = Photo.objects.create(user=user, file="hello.jpeg")
+            # Made on demand from the photo's old contents
+            stale_path = photo.rendition_path(1024, "webp")
+            os.makedirs(os.path.dirname(stale_path))
+            with open(stale_path, "w") as file:
+                file.write("stale")
+
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            # Run the stages queued right away, instead of through the broker
+            celery_app.conf.task_always_eager = True
+            celery_app.conf.task_eager_propagates = True
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    process_image(photo.id)
+
+                    photo.refresh_from_db()
+                    self.assertEqual(
+                        (2048, 1024), (photo.image_width, photo.image_height)
+                    )
+                    self.assertEqual(len(image.getvalue()), photo.image_size)
+                    self.assertTrue(photo.content_hash)
+                    with PIL_Image.open(photo.thumbnail_path) as thumbnail:
+                        self.assertEqual((1024, 512), thumbnail.size)
+                    with PIL_Image.open(photo.rendition_path(512, "webp")) as rendition:
+                        self.assertEqual(
+                            ("WEBP", (512, 256)), (rendition.format, rendition.size)
+                        )
+                    self.assertFalse(os.path.exists(stale_path))
+                    self.assertEqual(
+                        {
+                            ("metadata", "done", STAGE_VERSIONS["metadata"]),
+                            ("thumbnail", "done", STAGE_VERSIONS["thumbnail"]),
+                        },
+                        set(photo.stages.values_list("stage", "status", "version")),
+                    )
+
+                    # Only stages that are out of date or failed are rerun
+                    metadata = photo.stages.get(stage="metadata")
+                    photo.stages.filter(stage="thumbnail").update(version="0")
+                    os.remove(photo.thumbnail_path)
+                    thumbnail_url = sign_media_url(photo)
+                    output = io.StringIO()
+                    call_command("requeue_processing", stdout=output)
+                    self.assertIn("metadata: 0 photos", output.getvalue())
+                    self.assertIn("thumbnail: 1 photos", output.getvalue())
+                    self.assertTrue(os.path.exists(photo.thumbnail_path))
+                    # Regenerated thumbnails get new URLs, since browsers cache them
+                    photo.refresh_from_db()
+                    self.assertNotEqual(thumbnail_url, sign_media_url(photo))
+                    self.assertEqual(
+                        metadata.last_modified_time,
+                        photo.stages.get(stage="metadata").last_modified_time,
+                    )
+                    self.assertEqual(
+                        STAGE_VERSIONS["thumbnail"],
+                        photo.stages.get(stage="thumbnail").version,
+                    )
+
+                    # Stages that follow the metadata are queued once it is read
+                    photo.stages.update(version="0")
+                    os.remove(photo.thumbnail_path)
+                    output = io.StringIO()
+                    call_command("requeue_processing", stdout=output)
+                    self.assertIn("metadata: 1 photos", output.getvalue())
+                    self.assertIn("thumbnail: 1 photos", output.getvalue())
+                    self.assertTrue(os.path.exists(photo.thumbnail_path))
+                    self.assertEqual(
+                        {
+                            ("metadata", "done", STAGE_VERSIONS["metadata"]),
+                            ("thumbnail", "done", STAGE_VERSIONS["thumbnail"]),
+                        },
+                        set(photo.stages.values_list("stage", "status", "version")),
+                    )
+            finally:
+                celery_app.conf.task_always_eager = False
+                celery_app.conf.task_eager_propagates = False
+                server.shutdown()
+                server.server_close()
+
+            # Failures are recorded
+            os.remove(os.path.join(directory, "hello.jpeg"))
+            with self.assertRaises(OSError):
+                process_image(photo.id)
+            self.assertEqual("failed", photo.stages.get(stage="metadata").status)
+
+    def test_process_image_metadata_only(self):
+        """
+        Tests that refreshing a photo's metadata only reads
+        the metadata segments at the start of the file.
+
+        :return: None
+        """
+        user = self.login()
+        exif = PIL_Image.Exif()
+        exif[0x010F] = "Canon"  # Make
+        exif[0x0110] = "EOS 5D"  # Model
+        image = io.BytesIO()
+        PIL_Image.new("RGB", (64, 48)).save(image, "JPEG", exif=exif.tobytes())
+
+        # EXIF comes after other metadata, past the first METADATA_READ_SIZE bytes
+        padding = b"\xff\xe2" + struct.pack(">H", 60000) + bytes(59998)
+        header = b"\xff\xd8" + padding * 2 + image.getvalue()[2:]
+        length = jpeg_metadata_length(header)
+        self.assertEqual(length, jpeg_metadata_length(header[: length + 4]))
+        self.assertLess(10, jpeg_metadata_length(header[:10]))
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=directory
+        ):
+            user.subdirectory = directory
+            user.save()
+            # The image data itself is never read, past the marker that starts it
+            with open(os.path.join(directory, "hello.jpeg"), "wb") as file:
+                file.write(header[: length + 4] + b"not an image" * 1000)
+            photo = Photo.objects.create(
+                user=user, file="hello.jpeg", content_hash="0" * 64
+            )
+
+            socket_path = os.path.join(directory, "read_file.sock")
+            server = ReadFileServer(socket_path, [directory])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with self.settings(FILE_READER_SOCKET=socket_path):
+                    process_image(photo.id, metadata_only=True)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            photo.refresh_from_db()
+            self.assertEqual(
+                ("Canon", "EOS 5D"), (photo.camera_make, photo.camera_model)
+            )
+            self.assertEqual(length + 4 + 12000, photo.image_size)
+            self.assertFalse(os.path.exists(photo.thumbnail_path))
+
+
+class ThumbnailTestCase(PhotomanagerTestCase):
+    """Tests making thumbnails."""
+
+    def test_make_thumbnail(self):
+        """
+        Tests that thumbnails are rotated to match their EXIF orientation
+        after being shrunk, whether or not they are JPEG files.
+
+        :return: None
+        """
+        exif = PIL_Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees clockwise for display
+        original = PIL_Image.new("RGB", (4000, 2000), "blue")
+        original.paste("red", (0, 0, 400, 400))
+
+        for image_format in ("JPEG", "PNG"):
+            image = io.BytesIO()
+            original.save(image, image_format, exif=exif.tobytes())
+
+            thumbnail = make_thumbnail(image.getvalue())
+            self.assertEqual((512, 1024), thumbnail.size)
+            self.assertEqual("RGB", thumbnail.mode)
+            # The top left corner is now the top right corner
+            red, _, blue = thumbnail.getpixel((thumbnail.width - 10, 10))
+            self.assertGreater(red, 200)
+            self.assertLess(blue, 50)
+            red, _, blue = thumbnail.getpixel((10, 10))
+            self.assertLess(red, 50)
+            self.assertGreater(blue, 200)
+
+        # Small images are left as they are
+        image = io.BytesIO()
+        PIL_Image.new("RGBA", (300, 100)).save(image, "PNG")
+        thumbnail = make_thumbnail(image.getvalue())
+        self.assertEqual((300, 100), thumbnail.size)
+        self.assertEqual("RGB", thumbnail.mode)
+
+
+class ScanTestCase(PhotomanagerTestCase):
+    """Tests scanning directories for changes."""
+
+    def setUp(self):
+        # Scan leases and intervals are kept in the cache
+        cache.clear()
+
+    def test_scan_files_for_changes(self):
+        """
+        Tests scan_files_for_changes, which is used by the directory watcher.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "notes"))
+            for name in ["a.txt", "b.txt"]:
+                with open(os.path.join(directory, "notes", name), "w") as file:
+                    file.write("hello")
+
+            scan_files_for_changes(
+                directory, user.username, ["/notes/a.txt", "/notes/b.txt"]
+            )
+            self.assertSetEqual(
+                {"/notes/a.txt", "/notes/b.txt"},
+                set(
+                    ScannedFile.objects.filter(user=user).values_list("path", flat=True)
+                ),
+            )
+            entry = ScannedFile.objects.get(user=user, path="/notes/a.txt")
+            self.assertEqual("text/plain", entry.mime)
+            self.assertEqual(5, entry.size)
+
+            # Passing a directory that still exists should not remove
+            # the files underneath it
+            scan_files_for_changes(directory, user.username, ["/notes"])
+            self.assertEqual(2, ScannedFile.objects.filter(user=user).count())
+
+            # Modified files are updated
+            with open(os.path.join(directory, "notes", "a.txt"), "a") as file:
+                file.write(" there")
+            scan_files_for_changes(directory, user.username, ["/notes/a.txt"])
+            entry = ScannedFile.objects.get(user=user, path="/notes/a.txt")
+            self.assertEqual(11, entry.size)
+
+            # Removed files are removed from the manifest
+            os.remove(os.path.join(directory, "notes", "b.txt"))
+            scan_files_for_changes(directory, user.username, ["/notes/b.txt"])
+            self.assertFalse(
+                ScannedFile.objects.filter(user=user, path="/notes/b.txt").exists()
+            )
+
+            # As are files underneath removed directories
+            os.remove(os.path.join(directory, "notes", "a.txt"))
+            os.rmdir(os.path.join(directory, "notes"))
+            scan_files_for_changes(directory, user.username, ["/notes"])
+            self.assertEqual(0, ScannedFile.objects.filter(user=user).count())
+
+    def test_watcher_relative_paths(self):
+        """
+        Tests that the directory watcher finds the users whose directory
+        a path is in, including paths starting with "..".
+
+        :return: None
+        """
+        watcher = WatchDirectoriesCommand()
+        watcher.roots = {"alice": "/data/alice", "bob": "/data/bob"}
+        self.assertEqual(
+            [("alice", "..hello/world.jpeg")],
+            list(watcher.relative_paths("/data/alice/..hello/world.jpeg")),
+        )
+        self.assertEqual([], list(watcher.relative_paths("/data/carol/hello.jpeg")))
+        self.assertEqual([], list(watcher.relative_paths("/data")))
+
+    def test_scan_dir_for_changes(self):
+        """
+        Tests scan_dir_for_changes with the in-process directory walker.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "notes", "old"))
+            for name in ["notes/a.txt", "notes/old/b.txt"]:
+                with open(os.path.join(directory, name), "w") as file:
+                    file.write("hello")
+            os.symlink("/etc", os.path.join(directory, "etc"))
+
+            scan_dir_for_changes(directory, user.username)
+            self.assertSetEqual(
+                {"/notes/a.txt", "/notes/old/b.txt"},
+                set(
+                    ScannedFile.objects.filter(user=user).values_list("path", flat=True)
+                ),
+            )
+
+            os.remove(os.path.join(directory, "notes", "old", "b.txt"))
+            scan_dir_for_changes(directory, user.username)
+            self.assertSetEqual(
+                {"/notes/a.txt"},
+                set(
+                    ScannedFile.objects.filter(user=user).values_list("path", flat=True)
+                ),
+            )
+
+    def test_scan_dir_for_changes_unchanged_directories(self):
+        """
+        Tests that scan_dir_for_changes doesn't treat files in directories
+        that haven't changed (and so aren't listed) as removed.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "notes", "old"))
+            for name in ["top.txt", "notes/a.txt", "notes/old/b.txt"]:
+                with open(os.path.join(directory, name), "w") as file:
+                    file.write("hello")
+            for path in ["", "notes", "notes/old"]:
+                os.utime(os.path.join(directory, path), ns=(10 ** 18, 10 ** 18))
+
+            scan_dir_for_changes(directory, user.username)
+            self.assertEqual(
+                [["notes"], ["old"]],
+                [
+                    ScannedDirectory.objects.get(user=user, path=path).subdirectories
+                    for path in ["/", "/notes"]
+                ],
+            )
+
+            os.remove(os.path.join(directory, "notes", "a.txt"))
+            scan_dir_for_changes(directory, user.username)
+            self.assertSetEqual(
+                {"/top.txt", "/notes/old/b.txt"},
+                set(
+                    ScannedFile.objects.filter(user=user).values_list("path", flat=True)
+                ),
+            )
+
+            # A full scan lists every directory, even those that haven't changed
+            os.remove(os.path.join(directory, "notes", "old", "b.txt"))
+            os.utime(os.path.join(directory, "notes", "old"), ns=(10 ** 18, 10 ** 18))
+            scan_dir_for_changes(directory, user.username)
+            self.assertEqual(2, ScannedFile.objects.filter(user=user).count())
+            scan_dir_for_changes(directory, user.username, full=True)
+            self.assertEqual(1, ScannedFile.objects.filter(user=user).count())
+
+    @unittest.skipIf(os.geteuid() == 0, "Root can list unreadable directories")
+    def test_scan_dir_for_changes_unreadable_directories(self):
+        """
+        Tests that scan_dir_for_changes doesn't remove the photos in
+        directories that it couldn't list, which may only be for a while.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "album", "2020"))
+            for name in ["top.txt", "album/2020/a.txt"]:
+                with open(os.path.join(directory, name), "w") as file:
+                    file.write("hello")
+            scan_dir_for_changes(directory, user.username)
+            photo = Photo.objects.create(user=user, file="album/2020/a.txt")
+
+            os.chmod(os.path.join(directory, "album"), 0)
+            try:
+                scan_dir_for_changes(directory, user.username, full=True)
+            finally:
+                os.chmod(os.path.join(directory, "album"), 0o755)
+            self.assertTrue(Photo.objects.filter(id=photo.id).exists())
+            self.assertTrue(
+                ScannedFile.objects.filter(user=user, path="/album/2020/a.txt").exists()
+            )
+
+    def test_scan_dir_for_changes_moves(self):
+        """
+        Tests that scan_dir_for_changes moves photos whose files were moved
+        or renamed, and removes photos whose files were removed.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            IMAGE_THUMBS_DIR=os.path.join(directory, "thumbs")
+        ):
+            root = os.path.join(directory, "root")
+            os.makedirs(os.path.join(root, "old"))
+            for name in ["old/a.txt", "old/b.txt", "c.txt"]:
+                with open(os.path.join(root, name), "w") as file:
+                    file.write(name)
+            scan_dir_for_changes(root, user.username)
+
+            # Not really photos, since processing images needs a worker
+            photo_a = Photo.objects.create(user=user, file="old/a.txt")
+            photo_a.tags.create(tag="hello")
+            photo_b = Photo.objects.create(user=user, file="old/b.txt")
+            os.makedirs(os.path.dirname(photo_b.thumbnail_path))
+            with open(photo_b.thumbnail_path, "w") as file:
+                file.write("thumbnail")
+
+            os.rename(os.path.join(root, "old"), os.path.join(root, "new"))
+            os.rename(
+                os.path.join(root, "new", "a.txt"), os.path.join(root, "new", "d.txt")
+            )
+            os.remove(os.path.join(root, "new", "b.txt"))
+            scan_dir_for_changes(root, user.username)
+
+            self.assertSetEqual(
+                {"/new/d.txt", "/c.txt"},
+                set(
+                    ScannedFile.objects.filter(user=user).values_list("path", flat=True)
+                ),
+            )
+            photo_a.refresh_from_db()
+            self.assertEqual("new/d.txt", photo_a.file)
+            self.assertEqual(["hello"], [tag.tag for tag in photo_a.tags.all()])
+            self.assertFalse(Photo.objects.filter(id=photo_b.id).exists())
+            self.assertFalse(os.path.exists(photo_b.thumbnail_path))
+
+            # If nothing is left, the directory was probably unmounted
+            for name in ["new/d.txt", "c.txt"]:
+                os.remove(os.path.join(root, name))
+            scan_dir_for_changes(root, user.username)
+            self.assertEqual(2, ScannedFile.objects.filter(user=user).count())
+
+    def test_scan_lease(self):
+        """
+        Tests that only one scan of a directory runs at a time, and that
+        scans requested in the meantime are coalesced.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "a.txt"), "w") as file:
+                file.write("hello")
+
+            with scan_lease(user.id) as heartbeat:
+                self.assertIsNotNone(heartbeat)
+
+                # The lease can't be acquired twice
+                with scan_lease(user.id) as other_heartbeat:
+                    self.assertIsNone(other_heartbeat)
+
+                # So this scan is skipped, but requested again
+                scan_dir_for_changes(directory, user.username)
+                self.assertEqual(0, ScannedFile.objects.filter(user=user).count())
+                self.assertTrue(cache.get(f"scan-requested-{user.id}"))
+
+                # Unless it shouldn't be coalesced
+                cache.delete(f"scan-requested-{user.id}")
+                scan_dir_for_changes(directory, user.username, coalesce=False)
+                self.assertIsNone(cache.get(f"scan-requested-{user.id}"))
+
+                # Full scans requested in the meantime stay full
+                scan_dir_for_changes(directory, user.username, full=True)
+                scan_dir_for_changes(directory, user.username)
+                self.assertEqual("full", cache.get(f"scan-requested-{user.id}"))
+
+            # The lease was released, and the requested scan runs afterwards
+            next_full_scan = time.time() + 10 ** 6
+            cache.set(f"scan-full-next-{user.id}", next_full_scan)
+            celery_app.conf.task_always_eager = True
+            try:
+                scan_dir_for_changes(directory, user.username)
+            finally:
+                celery_app.conf.task_always_eager = False
+            self.assertEqual(1, ScannedFile.objects.filter(user=user).count())
+            self.assertIsNone(cache.get(f"scan-requested-{user.id}"))
+            self.assertLess(cache.get(f"scan-full-next-{user.id}"), next_full_scan)
+
+    def test_adaptive_scan_interval(self):
+        """
+        Tests that directories that don't change are scanned less often.
+
+        :return: None
+        """
+        user = self.login()
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "a.txt"), "w") as file:
+                file.write("hello")
+
+            scan_dir_for_changes(directory, user.username)
+            self.assertEqual(
+                settings.DIRECTORY_SCAN_INTERVAL,
+                cache.get(f"scan-interval-{user.id}"),
+            )
+
+            # Nothing changed
+            scan_dir_for_changes(directory, user.username)
+            self.assertEqual(
+                settings.DIRECTORY_SCAN_INTERVAL * 2,
+                cache.get(f"scan-interval-{user.id}"),
+            )
+            scan_dir_for_changes(directory, user.username)
+            self.assertEqual(
+                settings.DIRECTORY_SCAN_INTERVAL * 4,
+                cache.get(f"scan-interval-{user.id}"),
+            )
+
+            # Something changed
+            os.remove(os.path.join(directory, "a.txt"))
+            scan_dir_for_changes(directory, user.username)
+            self.assertEqual(
+                settings.DIRECTORY_SCAN_INTERVAL,
+                cache.get(f"scan-interval-{user.id}"),
+            )
@@ -0,0 +1,150 @@
+"""
+Makes thumbnails without decoding images at full resolution.
+
+JPEG files can be decoded at 1/2, 1/4 or 1/8 of their size directly from
+their DCT coefficients (see Image.draft), which is much faster and uses
+a fraction of the memory. Other images are shrunk by an integer factor
+(see Image.reduce) before being resized properly. Either way, the image
+is only rotated to match its EXIF orientation once it is small.
+
+Renditions of a photo at several sizes are all made from one decoded
+image, shrinking it a little further for each size.
+"""
+
+import io
+import os
+import uuid
+from typing import Iterable, Iterator, NamedTuple, Tuple
+
+from PIL import Image, ImageOps
+
+# Largest width and height of a thumbnail, in pixels
+THUMBNAIL_SIZE = (1024, 1024)
+
+# EXIF tag for the orientation of an image
+EXIF_ORIENTATION_TAG = 0x0112
+# Orientations that rotate an image by 90 degrees, swapping its width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class RenditionFormat(NamedTuple):
+    """A format that renditions of photos are saved in."""
+
+    pillow_format: str
+    mime: str
+    extension: str
+    options: dict  # For Image.save
+
+
+RENDITION_FORMATS = {
+    # Pillow's default quality, which thumbnails have always been saved with
+    "jpeg": RenditionFormat("JPEG", "image/jpeg", "jpeg", {}),
+    "webp": RenditionFormat("WEBP", "image/webp", "webp", {"quality": 80, "method": 4}),
+    "avif": RenditionFormat("AVIF", "image/avif", "avif", {"quality": 60, "speed": 8}),
+}
+
+
+def make_thumbnail(data: bytes, size: tuple = THUMBNAIL_SIZE) -> Image.Image:
+    """
+    Makes a thumbnail of an image.
+
+    :param data: The image file's contents
+    :param size: Largest width and height of the thumbnail, after it is rotated
+    :return: The thumbnail, in RGB or L mode, rotated to match its EXIF orientation
+    """
+    image = Image.open(io.BytesIO(data))
+
+    # The size is for the image as displayed, but it is decoded before rotating
+    width, height = size
+    if image.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+
+    # The thumbnail keeps the image's aspect ratio, so only needs to be this large
+    scale = min(width / image.width, height / image.height, 1)
+    width = max(round(image.width * scale), 1)
+    height = max(round(image.height * scale), 1)
+
+    if image.format == "JPEG":
+        # Decoded at the smallest scale that is still at least this large
+        image.draft("RGB", (width, height))
+    else:
+        factor = min(image.width // width, image.height // height)
+        if factor > 1:
+            image = _reduce(image, factor)
+
+    image.thumbnail((width, height), Image.LANCZOS)
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image
+
+
+def _reduce(image: Image.Image, factor: int) -> Image.Image:
+    """
+    Shrinks an image by an integer factor, keeping its EXIF data.
+
+    :param image: The image
+    :param factor: How many times smaller to make it
+    :return: The smaller image
+    """
+    if image.mode == "P":
+        # reduce() doesn't support palettes
+        image = image.convert("RGBA")
+    reduced = image.reduce(factor)
+    reduced.info = image.info
+    return reduced
+
+
+def make_renditions(
+    data: bytes, sizes: Iterable[int]
+) -> Iterator[Tuple[int, Image.Image]]:
+    """
+    Makes thumbnails of an image at several sizes, only decoding it once.
+
+    :param data: The image file's contents
+    :param sizes: Largest width and height of each thumbnail
+    :return: An iterator of (size, thumbnail) tuples, from the largest size
+             to the smallest; see make_thumbnail
+    """
+    sizes = sorted(set(sizes), reverse=True)
+    image = make_thumbnail(data, (sizes[0], sizes[0]))
+    for size in sizes:
+        if max(image.size) > size:
+            image = image.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+        yield size, image
+
+
+def can_save(image_format: str) -> bool:
+    """
+    Checks whether Pillow was built with support for saving a format;
+    AVIF in particular needs libavif.
+
+    :param image_format: A key of RENDITION_FORMATS
+    :return: Whether renditions can be saved in that format
+    """
+    Image.init()
+    return RENDITION_FORMATS[image_format].pillow_format in Image.SAVE
+
+
+def save_rendition(image: Image.Image, path: str, image_format: str) -> None:
+    """
+    Saves a thumbnail in one of RENDITION_FORMATS. It is written to a
+    temporary file first, so it is never read before it is complete.
+
+    :param image: The thumbnail
+    :param path: Where to save it
+    :param image_format: A key of RENDITION_FORMATS
+    :return: None
+    """
+    rendition_format = RENDITION_FORMATS[image_format]
+    temporary_path = f"{path}.{uuid.uuid4()}.tmp"
+    try:
+        image.save(
+            temporary_path, rendition_format.pillow_format, **rendition_format.options
+        )
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
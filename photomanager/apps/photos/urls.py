@@ -13,6 +13,23 @@ urlpatterns = [
         views.get_raw_image_album_share,
         name="raw_image_album_share",
     ),
+    path(
+        "thumbnail/<uuid:image_id>/<str:version>",
+        views.get_raw_image,
+        {"thumbnail": True},
+        name="thumbnail",
+    ),
+    path(
+        "thumbnail/<uuid:image_id>/<str:version>/album_share/<uuid:album_share_id>",
+        views.get_raw_image_album_share,
+        {"thumbnail": True},
+        name="thumbnail_album_share",
+    ),
+    path(
+        "media/<uuid:image_id>/<str:variant>/<str:version>/<int:expires>/<str:signature>",
+        views.get_signed_media,
+        name="signed_media",
+    ),
     path("<uuid:image_id>", views.view_single_photo, name="view_single_photo"),
     path(
         "<uuid:image_id>/album_share/<uuid:album_share_id>",
@@ -1,31 +1,31 @@
-import base64
-import io
-import json
 import os
-import subprocess
-from pathlib import Path
+from datetime import datetime
+from typing import Optional, Union
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.http import (
-    FileResponse,
-    HttpResponse,
-    HttpResponseForbidden,
-    HttpResponseNotFound,
-    HttpResponseServerError,
-)
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.views.decorators.http import require_POST
 from django.views.generic import ListView
 from django.views.generic.edit import UpdateView
 from hurry.filesize import size
 
 from ..albums.models import Album, AlbumShareLink
+from .media import (
+    Rendition,
+    check_media_signature,
+    pick_rendition,
+    run_once,
+    serve_file_async,
+)
 from .models import Photo
-from .tasks import process_image, scan_dir_for_changes
+from .tasks import make_rendition, process_image, scan_dir_for_changes
 
 
 @login_required
@@ -36,7 +36,9 @@ def rescan_directory(request) -> HttpResponse:
     :param request: Request object
     :return: HttpResponse
     """
-    scan_dir_for_changes.delay(request.user.subdirectory, request.user.username)
+    scan_dir_for_changes.delay(
+        request.user.root_directory, request.user.username, full=True
+    )
 
     # TODO: return a redirect
     return HttpResponse("OK")
@@ -58,108 +60,258 @@ def reprocess_file(request, image_id):
     if photo.user != request.user:
         return HttpResponseForbidden()
 
-    process_image.delay(photo.id)
+    # Only the start of the file is read, unless it has never been processed
+    process_image.delay(photo.id, metadata_only=True)
     messages.success(request, "EXIF metadata refresh queued.")
     return redirect(
         reverse_lazy("photos:view_single_photo", kwargs={"image_id": photo.id})
     )
 
 
-def _get_raw_image(request, photo: Photo) -> FileResponse:
+def _in_album(photo: Photo, album_id) -> bool:
     """
-    Backend method for getting a raw image.
+    Checks whether a photo is in an album, with a single indexed lookup.
 
-    :param request: Request object
     :param photo: Photo object
-    :return: FileResponse
+    :param album_id: ID (UUID) of the album
+    :return: Whether the photo is in the album
+    """
+    return Album.photos.through.objects.filter(
+        album_id=album_id, photo_id=photo.id
+    ).exists()
+
+
+@sync_to_async
+def _get_photo(photo_id) -> Optional[Photo]:
+    """
+    Gets a photo along with its user.
+
+    :param photo_id: ID (UUID) of the photo
+    :return: Photo object, or None if it doesn't exist
     """
-    # Read file
-    READ_FILE_PATH = os.path.join(
-        os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
-        "utils/files/read_file.py",
+    return Photo.objects.select_related("user").filter(id=photo_id).first()
+
+
+async def _serve_thumbnail(
+    request,
+    photo: Photo,
+    rendition: Rendition,
+    etag: str,
+    last_modified: datetime = None,
+) -> HttpResponse:
+    """
+    Sends one of a photo's thumbnails, making it first if it is missing,
+    like when the photo hasn't been processed yet or the rendition isn't
+    made in advance (see tasks.make_rendition). Requests for the same
+    thumbnail wait for it to be made once.
+
+    :param request: Request object
+    :param photo: Photo object; if its user isn't loaded, it is
+                  loaded again when the thumbnail has to be made
+    :param rendition: The thumbnail, from media.pick_rendition
+    :param etag: A strong ETag for the thumbnail, including quotes
+    :param last_modified: When the photo was last modified
+    :return: HttpResponse (see serve_file)
+    """
+    if not await sync_to_async(os.path.exists, thread_sensitive=False)(rendition.path):
+        if not Photo.user.is_cached(photo):
+            photo = await _get_photo(photo.id)
+        made = photo is not None and await run_once(
+            rendition.path,
+            make_rendition,
+            photo,
+            rendition.size,
+            rendition.image_format,
+        )
+        if not made:
+            return HttpResponseNotFound()
+
+    return await serve_file_async(
+        request, rendition.path, trusted=True, etag=etag, last_modified=last_modified
     )
 
+
+async def _get_raw_image(
+    request, photo: Photo, thumbnail: bool = False, version: str = None
+) -> HttpResponse:
+    """
+    Backend method for getting a raw image.
+
+    Responses have validators, so browsers can revalidate them cheaply.
+    Thumbnails requested with their current version (see
+    Photo.thumbnail_version) never change, so they are cached for a year.
+
+    :param request: Request object
+    :param photo: Photo object, with its user already loaded
+    :param thumbnail: Whether to get the photo's thumbnail
+    :param version: The thumbnail version requested, if any
+    :return: HttpResponse (see serve_file)
+    """
+    last_modified = photo.last_modified_time
+
     # If this is a thumbnail we are reading, we will want to use a
     # different file path than if we are reading the actual file
 
-    if request.GET.get("thumbnail"):
-        file_to_read = os.path.join(
-            settings.IMAGE_THUMBS_DIR,
-            str(photo.id)[0],
-            str(photo.id)[1],
-            f"{str(photo.id)}.thumb.jpeg",
+    if thumbnail or request.GET.get("thumbnail"):
+        # Thumbnails are generated again without the photo itself changing
+        if photo.thumbnail_time is not None:
+            last_modified = max(last_modified, photo.thumbnail_time)
+        response = await _serve_thumbnail(
+            request,
+            photo,
+            Rendition(photo.thumbnail_path, "thumbnail", None, None),
+            etag=f'"{photo.thumbnail_version}-thumbnail"',
+            last_modified=last_modified,
         )
+        immutable = version == photo.thumbnail_version
     else:
-        # TODO: find a better way to do this
-        file_to_read = "/data/" + str(photo.file).lstrip("/")
-
-    file_read: dict = json.loads(
-        subprocess.run(
-            (["sudo"] if os.getuid() != 0 else [])
-            + [
-                "pipenv",
-                "run",
-                "python3",
-                READ_FILE_PATH,
-                file_to_read,
-            ],  # sudo required for chroot
-            capture_output=True,
-            text=True,
-        ).stdout
-    )
+        response = await serve_file_async(
+            request,
+            photo.absolute_path,
+            etag=f'"{photo.content_hash}"' if photo.content_hash else None,
+            last_modified=last_modified,
+        )
+        immutable = False
 
-    if "error" in file_read.keys():
-        if file_read["error"] == 404:
-            return HttpResponseNotFound()
-        elif file_read["error"] == 500:
-            return HttpResponseServerError()
+    if response.status_code in (200, 206, 304):
+        if immutable:
+            patch_cache_control(response, max_age=60 * 60 * 24 * 365, immutable=True)
+        else:
+            patch_cache_control(response, no_cache=True)
+        # Shared caches may only keep photos that anyone can see
+        if photo.effectively_public:
+            patch_cache_control(response, public=True)
+        else:
+            patch_cache_control(response, private=True)
+    return response
 
-    return FileResponse(
-        io.BytesIO(base64.b64decode(file_read[file_to_read]["data"])),
-        filename=Path(file_to_read).name,
-        content_type=file_read[file_to_read]["mime"],
-    )
 
+@sync_to_async
+def _get_raw_image_photo(request, image_id) -> Union[Photo, HttpResponse]:
+    """
+    Gets the photo requested from get_raw_image, if the user may see it.
+
+    :param request: Request object
+    :param image_id: ID (UUID) for an image
+    :return: Photo object, or HttpResponse for 403s
+    """
+    photo = get_object_or_404(Photo.objects.select_related("user"), id=image_id)
+
+    # Publicly accessible, or in a publicly accessible album
+    if not photo.effectively_public:
+        if not request.user.is_authenticated:
+            return redirect(settings.LOGIN_URL)
+
+        if photo.user_id != request.user.id:
+            return HttpResponseForbidden()
 
-def get_raw_image(request, image_id) -> HttpResponse:
+    return photo
+
+
+async def get_raw_image(
+    request, image_id, version: str = None, thumbnail: bool = False
+) -> HttpResponse:
     """
     Returns the image specified by image_id
 
     :param request: Django request
     :param image_id: Image ID to request
+    :param version: Thumbnail version requested, if any
+    :param thumbnail: Whether to return the image's thumbnail
     :return: FileResponse, or HttpResponse for 403s
     """
+    photo = await _get_raw_image_photo(request, image_id)
+    if isinstance(photo, HttpResponse):
+        return photo
 
-    photo = get_object_or_404(Photo, id=image_id)
+    return await _get_raw_image(request, photo, thumbnail, version)
 
-    if not photo.publicly_accessible:
-        # Check if this photo is a part of any publicly visible albums.
-        if Album.objects.filter(photos=photo, publicly_accessible=True).count() == 0:
-            if not request.user.is_authenticated:
-                return redirect(settings.LOGIN_URL)
 
-            if photo.user != request.user:
-                return HttpResponseForbidden()
+@sync_to_async
+def _get_raw_image_album_share_photo(
+    request, image_id, album_share_id
+) -> Union[Photo, HttpResponse]:
+    """
+    Gets the photo requested from get_raw_image_album_share,
+    if it is in the album shared.
 
-    return _get_raw_image(request, photo)
+    :param request: Request object
+    :param image_id: ID (UUID) for an image
+    :param album_share_id: Album share ID (UUID)
+    :return: Photo object, or HttpResponse for 403s
+    """
+    photo = get_object_or_404(Photo.objects.select_related("user"), id=image_id)
+    album_share_link = get_object_or_404(AlbumShareLink, id=album_share_id)
 
+    if not _in_album(photo, album_share_link.album_id):
+        return HttpResponseForbidden()
+
+    return photo
 
-def get_raw_image_album_share(request, image_id, album_share_id) -> HttpResponse:
+
+async def get_raw_image_album_share(
+    request, image_id, album_share_id, version: str = None, thumbnail: bool = False
+) -> HttpResponse:
     """
     Returns the image specified, but authenticated with an album share ID
 
     :param request: Request object
     :param image_id: ID (UUID) for an image
     :param album_share_id: Album share ID (UUID)
+    :param version: Thumbnail version requested, if any
+    :param thumbnail: Whether to return the image's thumbnail
     :return: FileResponse, or HttpResponse for 403s
     """
-    photo = get_object_or_404(Photo, id=image_id)
-    album_share_link = get_object_or_404(AlbumShareLink, id=album_share_id)
+    photo = await _get_raw_image_album_share_photo(request, image_id, album_share_id)
+    if isinstance(photo, HttpResponse):
+        return photo
+
+    return await _get_raw_image(request, photo, thumbnail, version)
 
-    if photo not in album_share_link.album.photos.all():
+
+async def get_signed_media(
+    request, image_id, variant: str, version: str, expires: int, signature: str
+) -> HttpResponse:
+    """
+    Returns a variant of an image from a URL created by media.sign_media_url.
+    The signature stands in for the permission checks, so the database
+    isn't touched at all, unless the thumbnail has to be made first.
+
+    Thumbnails are sent as one of the photo's renditions, picked from the
+    "width" query parameter (which srcset URLs have) and the Accept header;
+    see media.pick_rendition.
+
+    :param request: Request object
+    :param image_id: ID (UUID) for an image
+    :param variant: The variant of the image, like "thumbnail"
+    :param version: The image's thumbnail version when the URL was created
+    :param expires: When the URL expires, in seconds since the epoch
+    :param signature: Signature of the URL
+    :return: FileResponse, or HttpResponse for 403s
+    """
+    if not check_media_signature(image_id, variant, version, expires, signature):
         return HttpResponseForbidden()
 
-    return _get_raw_image(request, photo)
+    try:
+        width = int(request.GET["width"])
+    except (KeyError, ValueError):
+        width = None
+
+    # Only used to find the thumbnail's path; never saved or loaded
+    photo = Photo(id=image_id)
+    rendition = pick_rendition(photo, width, request.META.get("HTTP_ACCEPT", ""))
+    response = await _serve_thumbnail(
+        request, photo, rendition, etag=f'"{version}-{rendition.name}"'
+    )
+
+    # The format depends on the Accept header
+    patch_vary_headers(response, ["Accept"])
+    if response.status_code in (200, 206, 304):
+        # A new version gets a new URL
+        patch_cache_control(
+            response, max_age=60 * 60 * 24 * 365, immutable=True, private=True
+        )
+    return response
 
 
 def _view_single_photo(
@@ -185,13 +337,16 @@ def _view_single_photo(
         album_queryset_list.append(
             Album.objects.filter(
                 photos=photo,
-                id=get_object_or_404(AlbumShareLink, id=album_share_id).album.id,
+                id=get_object_or_404(AlbumShareLink, id=album_share_id).album_id,
             )
         )
 
-    albums = Album.objects.filter(photos=photo, publicly_accessible=True).union(
-        *album_queryset_list
-    )
+    # Photos that can't be seen without authentication aren't in public albums
+    if photo.effectively_public:
+        public_albums = Album.objects.filter(photos=photo, publicly_accessible=True)
+    else:
+        public_albums = Album.objects.none()
+    albums = public_albums.union(*album_queryset_list)
 
     context = {
         "photo": photo,
@@ -219,14 +374,13 @@ def view_single_photo(request, image_id: str) -> HttpResponse:
     """
     photo = get_object_or_404(Photo, id=image_id)
 
-    if not photo.publicly_accessible:
-        # Check if this photo is a part of any publicly visible albums.
-        if Album.objects.filter(photos=photo, publicly_accessible=True).count() == 0:
-            if not request.user.is_authenticated:
-                return redirect(settings.LOGIN_URL)
+    # Publicly accessible, or in a publicly accessible album
+    if not photo.effectively_public:
+        if not request.user.is_authenticated:
+            return redirect(settings.LOGIN_URL)
 
-            if photo.user != request.user:
-                return HttpResponseForbidden()
+        if photo.user_id != request.user.id:
+            return HttpResponseForbidden()
 
     return _view_single_photo(request, photo)
 
@@ -243,7 +397,7 @@ def view_single_photo_album_share(request, image_id, album_share_id):
     photo = get_object_or_404(Photo, id=image_id)
     album_share_link = get_object_or_404(AlbumShareLink, id=album_share_id)
 
-    if photo not in album_share_link.album.photos.all():
+    if not _in_album(photo, album_share_link.album_id):
         return HttpResponseForbidden()
 
     return _view_single_photo(request, photo, album_share_id=album_share_id)
@@ -280,9 +434,10 @@ class IndexView(ListView):
     paginate_by = 100
 
     def get_queryset(self):
-        # If the user isn't authenticated, return all the publicly accessible images
+        # If the user isn't authenticated, return all the images that can be
+        # seen without authentication
         if not self.request.user.is_authenticated:
-            return Photo.objects.filter(publicly_accessible=True).order_by(
+            return Photo.objects.filter(effectively_public=True).order_by(
                 "-photo_taken_time"
             )
         else:
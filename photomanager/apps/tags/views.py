@@ -36,7 +36,7 @@ class ListTagView(ListView):
     def get_queryset(self):
         if not self.request.user.is_authenticated:
             # If the user is not authenticated, they can only see publicly accessible images
-            return PhotoTag.objects.filter(photo__publicly_accessible=True).order_by(
+            return PhotoTag.objects.filter(photo__effectively_public=True).order_by(
                 Lower("tag")
             )
         else:
@@ -58,12 +58,12 @@ class DetailTagView(DetailView):
             context["photos"] = self.object.photo_set.filter(user=self.request.user)
         else:
             # If there are no publicly accessible images for this tag, we 404
-            if self.object.photo_set.filter(publicly_accessible=True).count() == 0:
+            if self.object.photo_set.filter(effectively_public=True).count() == 0:
                 raise Http404(
                     "No publicly accessible images exist for this tag. Are you logged in?"
                 )
 
             # Otherwise, we show the publicly accessible images
-            context["photos"] = self.object.photo_set.filter(publicly_accessible=True)
+            context["photos"] = self.object.photo_set.filter(effectively_public=True)
 
         return context
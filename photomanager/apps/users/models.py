@@ -1,3 +1,5 @@
+import os
+
 from django.contrib.auth.models import AbstractUser
 from django.db.models.fields import FilePathField
 
@@ -20,3 +22,13 @@ class User(AbstractUser):
         allow_folders=True,
         allow_files=False,
     )
+
+    @property
+    def root_directory(self) -> str:
+        """
+        Absolute path to this user's subdirectory.
+        Paths of this user's photos are relative to this directory.
+
+        :return: A path, like "/data/jdoe"
+        """
+        return os.path.normpath(os.path.join("/data", str(self.subdirectory)))
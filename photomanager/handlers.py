@@ -0,0 +1,58 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """
+    Django's ASGI handler, reading streaming responses in worker threads.
+
+    Django 3.2 iterates over streaming responses on the event loop, so
+    every chunk read from a photo being streamed (see photos.media) would
+    block every other request served by the process until it was read.
+    """
+
+    async def send_response(self, response, send):
+        """
+        Encodes and sends a response over ASGI, like Django's handler,
+        but gets each part of a streaming response from a worker thread.
+
+        :param response: HttpResponse
+        :param send: The ASGI send callable
+        :return: None
+        """
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            response_headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            response_headers.append(
+                (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": response_headers,
+            }
+        )
+
+        # Access __iter__ and not streaming_content, like Django does
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=False)
+        while True:
+            part = await next_part(parts, None)
+            if part is None:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,35 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.utils.decorators import sync_and_async_middleware
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+@sync_and_async_middleware
+def whitenoise_middleware(get_response):
+    """
+    WhiteNoise's middleware, which can also be used when serving requests
+    asynchronously. WhiteNoise itself only supports synchronous requests,
+    which makes Django run every view in a thread of its own, even async
+    ones like the media views.
+
+    :param get_response: The next middleware or view, sync or async
+    :return: WhiteNoise's middleware, or an async function wrapping it
+    """
+    whitenoise = WhiteNoiseMiddleware(get_response)
+    if not asyncio.iscoroutinefunction(get_response):
+        return whitenoise
+
+    async def middleware(request):
+        if whitenoise.autorefresh:
+            static_file = await sync_to_async(whitenoise.find_file)(request.path_info)
+        else:
+            static_file = whitenoise.files.get(request.path_info)
+
+        if static_file is not None:
+            return await sync_to_async(whitenoise.serve, thread_sensitive=False)(
+                static_file, request
+            )
+        return await get_response(request)
+
+    return middleware
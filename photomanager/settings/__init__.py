@@ -62,7 +62,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "photomanager.middleware.whitenoise_middleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -157,10 +157,22 @@ CELERY_BROKER_URL = "redis://localhost:6379/1"
 CELERY_TIMEZONE = "America/New_York"  # Change maybe?
 CELERY_TASK_RESULT_EXPIRES = 86400  # Clear after one day
 
+# Photos are processed in stages, each on a queue of its own, so that
+# workers can be scaled or paused separately. Scans use the default
+# "celery" queue. The entrypoint's "celery" command works on scans,
+# process_image and thumbnails; "celery-ml" works on tagging and faces.
+CELERY_TASK_ROUTES = {
+    "photomanager.apps.photos.tasks.process_image": {"queue": "ingest"},
+    "photomanager.apps.photos.tasks.process_images": {"queue": "ingest"},
+    "photomanager.apps.photos.tasks.generate_thumbnail": {"queue": "thumbnails"},
+    "photomanager.apps.photos.tasks.tag_image": {"queue": "tagging"},
+    "photomanager.apps.photos.tasks.detect_faces": {"queue": "faces"},
+}
+
 CELERY_BEAT_SCHEDULE = {
     "rescan-directory": {
         "task": "photomanager.apps.photos.tasks.scan_all_dirs_for_changes",
-        "schedule": 60,
+        "schedule": 60 * 60,  # Set from DIRECTORY_SCAN_INTERVAL below
     }
 }
 
@@ -201,8 +213,82 @@ TESTING = "test" in sys.argv
 if TESTING:
     DATABASES["default"]["ENGINE"] = "django.db.backends.sqlite3"
     DATABASES["default"]["NAME"] = ":memory:"
+    CACHES["default"] = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
 
 IMAGE_THUMBS_DIR = "/thumbs"
+# Besides a 1024px JPEG thumbnail, every photo has renditions this large
+# (in pixels, on their longest side) in each of these formats. Pages list
+# the sizes in srcset, and browsers get the smallest one that is large
+# enough, in the first format they accept (see photos.media.pick_rendition).
+# Formats that Pillow can't save are skipped.
+THUMBNAIL_SIZES = (256, 512, 1024, 2048)
+THUMBNAIL_FORMATS = ("avif", "webp")
+# Renditions made while photos are processed, for the photo grids. The
+# others (and thumbnails that are missing) are made by the web server the
+# first time they are asked for, and saved.
+THUMBNAIL_EAGER_SIZES = (256, 512)
+
+# Files are read as root by utils/files/read_file_server.py, listening on
+# this socket. If it's None or the server isn't running, read_file.py is
+# run for every file instead.
+FILE_READER_SOCKET = "/run/photomanager/read_file.sock"
+
+# How photos and thumbnails are sent to clients. With "file", they are
+# streamed by photomanager itself. With "x-accel-redirect" (nginx) or
+# "x-sendfile" (Apache with mod_xsendfile, lighttpd), the web server in
+# front of photomanager sends them instead, once photomanager has checked
+# permissions. Symlinks must then be refused by the web server; for nginx,
+# use "disable_symlinks on;" in internal locations for the directories in
+# MEDIA_ACCEL_REDIRECT_LOCATIONS.
+MEDIA_SERVE_MODE = "file"
+MEDIA_ACCEL_REDIRECT_LOCATIONS = {
+    "/data": "/protected/data",
+    "/thumbs": "/protected/thumbs",
+}
+
+# Media views are async. Each process opens and reads at most
+# MEDIA_MAX_CONCURRENT_READS files at once, in worker threads; files of
+# up to MEDIA_BUFFER_SIZE bytes are read into memory there, and larger
+# ones are streamed a chunk at a time from worker threads (see
+# photomanager.handlers), or sent by the web server.
+MEDIA_MAX_CONCURRENT_READS = 32
+MEDIA_BUFFER_SIZE = 1024 * 1024
+
+# Thumbnails on pages are linked with signed URLs, which can be checked
+# without the database (see photos.media.sign_media_url). They expire
+# between SIGNED_MEDIA_URL_LIFETIME and twice that many seconds after
+# the page is rendered.
+SIGNED_MEDIA_URL_LIFETIME = 60 * 60 * 24
+
+# New and changed files are normally found by the directory watcher
+# (./manage.py watch_directories). Every DIRECTORY_SCAN_INTERVAL seconds,
+# all directories are also scanned, to pick up anything it missed.
+# Directories that don't change are scanned less and less often,
+# down to once every DIRECTORY_SCAN_MAX_INTERVAL seconds.
+# Before the watcher, scans were the only way changes were found, every
+# 60 seconds; without the watcher running, set this back to 60 so that
+# new photos still show up within a minute or so.
+DIRECTORY_SCAN_INTERVAL = 60 * 60
+DIRECTORY_SCAN_MAX_INTERVAL = 60 * 60 * 24
+# Scans only list directories whose modification time has changed, which
+# misses files modified in place when the watcher isn't running. Every
+# DIRECTORY_FULL_SCAN_INTERVAL seconds, a scan lists every directory.
+DIRECTORY_FULL_SCAN_INTERVAL = 60 * 60 * 24 * 7
+# Seconds to wait for changes to settle before the watcher queues them.
+DIRECTORY_WATCHER_DEBOUNCE = 2
+# Whether to scan directories in-process, with a symlink-safe walker.
+# If False, directories are scanned by running utils/files/list_dir.py
+# as root in a chroot, which requires passwordless sudo.
+DIRECTORY_SCAN_IN_PROCESS = True
+# Which directories and files are scanned. With the "nextcloud" preset,
+# the directories Nextcloud keeps for itself (trash, versions, caches,
+# uploads and appdata_*, including previews) are skipped. Globs are
+# matched relative to each user's subdirectory, where "*" doesn't cross
+# directories and "**" does; for instance, "*/Backups" or "**/.thumbnails".
+# If any include globs are given, only files matching one of them are scanned.
+DIRECTORY_SCAN_PRESET = "nextcloud"
+DIRECTORY_SCAN_INCLUDE_GLOBS = []
+DIRECTORY_SCAN_EXCLUDE_GLOBS = []
 
 ##########################################
 # These values are defined in secret.py  #
@@ -218,3 +304,5 @@ try:
     from .secret import *
 except ImportError:
     pass
+
+CELERY_BEAT_SCHEDULE["rescan-directory"]["schedule"] = DIRECTORY_SCAN_INTERVAL
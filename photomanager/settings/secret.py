@@ -0,0 +1,3 @@
+ENABLE_TENSORFLOW_TAGGING = False
+ENABLE_FACE_RECOGNITION = False
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
@@ -22,6 +22,46 @@ ENABLE_TENSORFLOW_TAGGING = True
 # Same for face recognition.
 ENABLE_FACE_RECOGNITION = True
 
+# How often, in seconds, to scan all directories for changes.
+# New files are normally picked up within seconds by the directory
+# watcher; if you do not run the watcher (for instance, because your
+# /data mount does not support inotify), lower this to something like 60.
+DIRECTORY_SCAN_INTERVAL = 60 * 60
+
+# Scans skip directories whose modification time hasn't changed, so
+# without the watcher, a file edited in place is only noticed by the
+# periodic full scan. If that happens often, lower this as well.
+DIRECTORY_FULL_SCAN_INTERVAL = 60 * 60 * 24 * 7
+
+# Directories and files to skip when scanning, as globs relative to each
+# user's subdirectory. The "nextcloud" preset skips Nextcloud's trash,
+# versions, caches, uploads and appdata_* (previews) directories; set it
+# to None if /data is not a Nextcloud data directory.
+DIRECTORY_SCAN_PRESET = "nextcloud"
+DIRECTORY_SCAN_INCLUDE_GLOBS = []
+DIRECTORY_SCAN_EXCLUDE_GLOBS = []
+
+
+# If photomanager runs behind nginx, let nginx send photos and thumbnails
+# itself, once photomanager has checked permissions, with something like:
+#
+#   location /protected/data/ {
+#       internal;
+#       disable_symlinks on;
+#       alias /data/;
+#   }
+#   location /protected/thumbs/ {
+#       internal;
+#       alias /thumbs/;
+#   }
+#
+# Use "x-sendfile" instead for Apache with mod_xsendfile, or lighttpd.
+MEDIA_SERVE_MODE = "file"
+MEDIA_ACCEL_REDIRECT_LOCATIONS = {
+    "/data": "/protected/data",
+    "/thumbs": "/protected/thumbs",
+}
+
 
 # Configure your database and cache here.
 DATABASES = {
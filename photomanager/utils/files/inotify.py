@@ -0,0 +1,118 @@
+"""
+A minimal wrapper around the Linux inotify API, using ctypes.
+
+Used by the directory watcher (the watch_directories management
+command) to find out about new and changed files without having
+to walk the entire directory tree.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+from typing import Iterator, NamedTuple
+
+# Flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+_EVENT_STRUCT = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+
+class InotifyEvent(NamedTuple):
+    """A single event read from an inotify file descriptor."""
+
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """
+    An inotify instance.
+
+    Events can be read with read() once the file descriptor
+    (see fileno()) is readable, for instance using select().
+    """
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        Watch a path for events.
+
+        :param path: Path to watch
+        :param mask: Events to watch for, like IN_CREATE | IN_DELETE
+        :raises OSError if the watch could not be added (for instance,
+                ENOSPC if the limit on the number of watches was reached)
+        :return: The watch descriptor for this path
+        """
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        """
+        Stop watching a watch descriptor.
+
+        :param wd: The watch descriptor, as returned by add_watch
+        :return: None
+        """
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> Iterator[InotifyEvent]:
+        """
+        Read all the events that are currently queued.
+
+        :return: An iterator of InotifyEvents
+        """
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = _EVENT_STRUCT.unpack_from(buffer, offset)
+                offset += _EVENT_STRUCT.size
+                name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                yield InotifyEvent(wd, mask, cookie, name)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
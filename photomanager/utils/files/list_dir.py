@@ -6,9 +6,33 @@ vulnerabilities (for instance, if a file is a cleverly
 designed symlink).
 
 The contents are printed to stdout as a JSON dump with
-their MIME types as determined by python-magic, like this:
+their MIME types as determined by python-magic, along with
+their inode numbers, sizes and modification times
+(in nanoseconds), like this:
 
-{"hello.jpeg": "image/jpeg", "hello/hello.txt": "text/plain"}
+{"/hello.jpeg": {"mime": "image/jpeg", "inode": 1234, "size": 5678, "mtime": 1606600000000000000}}
+
+A manifest from a previous scan can be passed with --manifest
+(use "-" to read it from stdin), in the format:
+
+{"/hello.jpeg": [1234, 5678, 1606600000000000000, "image/jpeg"]}
+
+Files whose inode, size and modification time match the manifest
+are not sniffed again; the MIME type from the manifest is reused.
+
+With --ndjson, one JSON record is printed per line as soon as each
+file is found, instead of a single JSON dump at the end, like this:
+
+{"path": "/hello.jpeg", "mime": "image/jpeg", "inode": 1234, "size": 5678, "mtime": 1606600000000000000}
+
+Directories that can't be listed (for instance, because they are
+unreadable) are then reported the same way, so that the files underneath
+them aren't mistaken for removed ones, like this:
+
+{"failed": "/hello"}
+
+Directories and files can be skipped with --preset, --include
+and --exclude; see rules.py.
 """
 
 import argparse
@@ -17,30 +41,113 @@ import os
 
 import magic
 
+# This script is run directly, so rules.py is importable from its directory
+from rules import ScanRules, preset_excludes
+
 argparser = argparse.ArgumentParser()
 argparser.add_argument("directory", help="Directory to list/traverse", type=str)
+argparser.add_argument(
+    "--manifest",
+    help='Manifest from a previous scan ("-" for stdin)',
+    type=argparse.FileType("r"),
+)
+argparser.add_argument(
+    "--ndjson",
+    help="Print one JSON record per file as it is found",
+    action="store_true",
+)
+argparser.add_argument(
+    "--preset", help='Preset of directories to skip, like "nextcloud"', type=str
+)
+argparser.add_argument(
+    "--include",
+    help="Only list files matching this glob (repeatable)",
+    action="append",
+    default=[],
+)
+argparser.add_argument(
+    "--exclude",
+    help="Skip files and directories matching this glob (repeatable)",
+    action="append",
+    default=[],
+)
 args = argparser.parse_args()
 
 if not os.path.isdir(args.directory):
     print(json.dumps({"error": 404, "message": "This directory does not exist"}))
     exit(1)
 
+# The manifest must be read before chrooting
+manifest = json.load(args.manifest) if args.manifest else {}
+
 # This must be created before chrooting
 m = magic.Magic(mime=True)
 
+rules = ScanRules(
+    includes=args.include,
+    excludes=preset_excludes(args.preset, args.directory) + args.exclude,
+)
+
+
+def report_failed(error: OSError) -> None:
+    """
+    Reports a directory that couldn't be listed, with --ndjson.
+
+    :param error: The error raised when listing it
+    :return: None
+    """
+    if args.ndjson and not isinstance(error, FileNotFoundError):
+        print(json.dumps({"failed": error.filename}))
+
+
+def walk_files():
+    """
+    Lists the files in the current root, pruning excluded directories.
+
+    :return: An iterator of paths
+    """
+    # https://stackoverflow.com/questions/19309667/recursive-os-listdir
+    for dp, dn, fn in os.walk("/", onerror=report_failed):
+        dn[:] = [d for d in dn if not rules.excludes_directory(os.path.join(dp, d))]
+        for f in fn:
+            if not rules.excludes_file(os.path.join(dp, f)):
+                yield os.path.join(dp, f)
+
+
 # Chroot into this directory
 os.chdir(args.directory)
 os.chroot(args.directory)
 
 # List the files in this directory
-# https://stackoverflow.com/questions/19309667/recursive-os-listdir
-files = [os.path.join(dp, f) for dp, dn, fn in os.walk("/") for f in fn]
+files = walk_files()
 
-# Get the MIME types of each file in this directory
+# Get the MIME types of each file in this directory,
+# skipping files that have not changed since the last scan
 files_mime_dict = {}
 
 for file in files:
-    if os.path.exists(file):
-        files_mime_dict[file] = m.from_file(file)
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        continue
+
+    stat_list = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    known = manifest.get(file)
+    if known is not None and known[:3] == stat_list:
+        mime = known[3]
+    else:
+        mime = m.from_file(file)
+
+    record = {
+        "mime": mime,
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+    if args.ndjson:
+        print(json.dumps({"path": file, **record}))
+    else:
+        files_mime_dict[file] = record
 
-print(json.dumps(files_mime_dict))
+if not args.ndjson:
+    print(json.dumps(files_mime_dict))
@@ -9,18 +9,46 @@ stdout as a JSON dump along with
 their MIME types, like this:
 
 {"hello.txt": {"data": "[base64 of file contents]", "mime": "text/plain"}}
+
+With --binary, a line of JSON with the MIME type and size is printed
+instead, followed by the raw contents of the file, like this:
+
+{"mime": "text/plain", "size": 5}
+hello
+
+--offset and --length print only part of the contents after the header,
+like the first few kilobytes of a photo for its metadata; the size in
+the header is still that of the whole file.
 """
 
 import argparse
 import base64
 import json
 import os
+import shutil
+import sys
 from pathlib import Path
 
 import magic
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument("file", help="File to read", type=Path)
+argparser.add_argument(
+    "--binary",
+    help="Print the raw contents after a JSON header, instead of base64 in JSON",
+    action="store_true",
+)
+argparser.add_argument(
+    "--offset",
+    help="With --binary, where to start printing the contents, in bytes",
+    type=int,
+    default=0,
+)
+argparser.add_argument(
+    "--length",
+    help="With --binary, the most bytes of the contents to print",
+    type=int,
+)
 args = argparser.parse_args()
 
 # Exit if the file doesn't exist
@@ -40,6 +68,26 @@ m = magic.Magic(mime=True)
 os.chdir(args.file.parent)
 os.chroot(args.file.parent)
 
+if args.binary:
+    with open(args.file.name, "rb") as file:
+        header = {
+            "mime": m.from_file(str(args.file.name)),
+            "size": os.fstat(file.fileno()).st_size,
+        }
+        sys.stdout.buffer.write(json.dumps(header).encode() + b"\n")
+        file.seek(args.offset)
+        if args.length is None:
+            shutil.copyfileobj(file, sys.stdout.buffer)
+        else:
+            remaining = args.length
+            while remaining > 0:
+                data = file.read(min(remaining, 64 * 1024))
+                if not data:
+                    break
+                sys.stdout.buffer.write(data)
+                remaining -= len(data)
+    exit(0)
+
 # Get the content of the file
 with open(args.file.name, "rb") as file:
     contents = file.read()
@@ -0,0 +1,169 @@
+"""
+Opens files for other processes over a Unix socket; a long-lived
+replacement for running read_file.py once per file, shared by
+the web server and the Celery workers.
+
+Like read_file.py, this script must be run as root. It opens each
+directory passed on the command line (typically /data and the
+thumbnails directory), then chroots into the first one. Files are
+opened relative to those directories one component at a time,
+refusing symlinks and ".." (see walker.open_beneath), so nothing
+outside of them can be read.
+
+Each request is a line of JSON with the absolute path of a file:
+
+{"path": "/data/jdoe/hello.jpeg"}
+
+and is answered with a line of JSON with its MIME type and size:
+
+{"mime": "image/jpeg", "size": 1234}
+
+along with a read-only file descriptor for the file, passed as
+SCM_RIGHTS ancillary data; the contents themselves are never sent.
+Errors are answered like {"error": 404, "message": "..."}, without a
+file descriptor. A connection may send any number of requests, and
+connections are handled concurrently.
+"""
+
+import argparse
+import array
+import grp
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+import magic
+
+try:
+    from .walker import open_beneath_fd, sniff_mime
+except ImportError:
+    # Run as a script, as root
+    from walker import open_beneath_fd, sniff_mime
+
+
+class ReadFileHandler(socketserver.StreamRequestHandler):
+    """Handles the requests sent over one connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            fd = None
+            try:
+                fd, response = self.server.read_file(json.loads(line)["path"])
+            except (ValueError, KeyError, TypeError):
+                response = {"error": 400, "message": "Invalid request"}
+
+            try:
+                self.request.sendmsg(
+                    [json.dumps(response).encode() + b"\n"],
+                    []
+                    if fd is None
+                    else [
+                        (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))
+                    ],
+                )
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+
+class ReadFileServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Reads files beneath a set of root directories."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, roots: list):
+        """
+        :param socket_path: Path to the socket to listen on
+        :param roots: Directories that files may be read from. These are
+                      opened now, so this can be called before chrooting.
+        """
+        self.roots = {
+            os.path.normpath(root): os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+            for root in roots
+        }
+        # libmagic can't load its database after chrooting, and isn't thread-safe
+        self.magic = magic.Magic(mime=True)
+        self.magic_lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, ReadFileHandler)
+
+    def open(self, path: str) -> int:
+        """
+        Opens a file beneath one of the root directories.
+
+        :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+        :raises OSError if the file can't be opened
+        :return: A file descriptor, which must be closed by the caller
+        """
+        path = os.path.normpath(path)
+        for root, root_fd in self.roots.items():
+            if path.startswith(root.rstrip("/") + "/"):
+                return open_beneath_fd(root_fd, path[len(root) :])
+        raise FileNotFoundError(path)
+
+    def read_file(self, path: str) -> tuple:
+        """
+        Opens a file beneath one of the root directories.
+
+        :param path: Absolute path to the file, like "/data/jdoe/hello.jpeg"
+        :return: A tuple of (file descriptor, response), where the file
+                 descriptor must be closed by the caller, or is None if
+                 the file couldn't be opened
+        """
+        try:
+            fd = self.open(path)
+        except OSError:
+            # Doesn't exist, goes through a symlink, or is outside of the roots
+            return None, {"error": 404, "message": "This file does not exist"}
+
+        try:
+            file_stat = os.fstat(fd)
+            if not stat.S_ISREG(file_stat.st_mode):
+                os.close(fd)
+                return None, {"error": 404, "message": "This file does not exist"}
+
+            with self.magic_lock:
+                mime = sniff_mime(fd, self.magic)
+        except OSError:
+            os.close(fd)
+            return None, {"error": 500, "message": "This file could not be read"}
+
+        return fd, {"mime": mime, "size": file_stat.st_size}
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "roots", help="Directories that files may be read from", nargs="+"
+    )
+    argparser.add_argument(
+        "--socket",
+        help="Path to the socket to listen on",
+        default="/run/photomanager/read_file.sock",
+    )
+    argparser.add_argument(
+        "--group", help="Group allowed to connect to the socket, besides root"
+    )
+    args = argparser.parse_args()
+
+    # chroot requires root
+    if os.geteuid() != 0:
+        print(json.dumps({"error": 500, "message": "This script must be ran as root"}))
+        exit(1)
+
+    os.makedirs(os.path.dirname(args.socket), exist_ok=True)
+    server = ReadFileServer(args.socket, args.roots)
+    os.chmod(args.socket, 0o660)
+    if args.group:
+        os.chown(args.socket, 0, grp.getgrnam(args.group).gr_gid)
+
+    # Everything else is read through the root directories opened above
+    os.chdir(args.roots[0])
+    os.chroot(args.roots[0])
+
+    server.serve_forever()
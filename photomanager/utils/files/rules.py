@@ -0,0 +1,140 @@
+"""
+Rules deciding which files and directories are scanned.
+
+Paths are matched relative to the directory being scanned, without a
+leading slash, against globs where "*" and "?" match within a single
+path component, and "**" matches across components. For instance,
+"*/cache" matches "jdoe/cache" but not "jdoe/files/cache", and
+"files/**" matches everything underneath "files".
+"""
+
+import os
+import re
+from typing import Iterable, List
+
+# Directories in a Nextcloud data directory that never contain photos
+# a user would want to see: deleted files, old versions, caches,
+# in-progress uploads and previews generated by Nextcloud itself
+NEXTCLOUD_DATA_DIRECTORY_EXCLUDES = [
+    "appdata_*",
+    "updater-*",
+    "files_external",
+    "__groupfolders/trash",
+    "__groupfolders/versions",
+    "*/files_trashbin",
+    "*/files_versions",
+    "*/files_encryption",
+    "*/cache",
+    "*/uploads",
+    "*/thumbnails",
+]
+# The same, but in a single Nextcloud user's directory
+NEXTCLOUD_USER_DIRECTORY_EXCLUDES = [
+    "files_trashbin",
+    "files_versions",
+    "files_encryption",
+    "cache",
+    "uploads",
+    "thumbnails",
+]
+
+
+def _translate(glob: str) -> "re.Pattern":
+    """
+    Translates a glob into a regular expression.
+
+    :param glob: The glob, like "*/cache"
+    :return: A compiled regular expression matching the entire path
+    """
+    regex = ""
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif glob.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif glob[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif glob[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(glob[i])
+            i += 1
+    return re.compile(regex + r"\Z")
+
+
+class ScanRules:
+    """
+    A set of include and exclude globs.
+
+    Excluded directories are pruned before they are descended into, and
+    excluded files are skipped. If any include globs are given, only files
+    matching at least one of them are scanned.
+    """
+
+    def __init__(self, includes: Iterable[str] = (), excludes: Iterable[str] = ()):
+        self.includes: List[str] = list(includes)
+        self.excludes: List[str] = list(excludes)
+        self._includes = [_translate(glob.strip("/")) for glob in self.includes]
+        self._excludes = [_translate(glob.strip("/")) for glob in self.excludes]
+
+    def __bool__(self):
+        return bool(self._includes or self._excludes)
+
+    def excludes_directory(self, path: str) -> bool:
+        """
+        Whether a directory (and everything underneath it) should be skipped.
+
+        :param path: Path of the directory relative to the root, like "/jdoe/cache"
+        :return: True if it should be skipped
+        """
+        path = path.strip("/")
+        return any(regex.match(path) for regex in self._excludes)
+
+    def excludes_file(self, path: str) -> bool:
+        """
+        Whether a file should be skipped, not considering the directories it is in.
+
+        :param path: Path of the file relative to the root, like "/jdoe/files/a.jpg"
+        :return: True if it should be skipped
+        """
+        path = path.strip("/")
+        if any(regex.match(path) for regex in self._excludes):
+            return True
+        return bool(self._includes) and not any(
+            regex.match(path) for regex in self._includes
+        )
+
+    def excludes_path(self, path: str) -> bool:
+        """
+        Whether a file should be skipped, considering the directories it is in.
+
+        :param path: Path of the file relative to the root, like "/jdoe/files/a.jpg"
+        :return: True if it should be skipped
+        """
+        parts = path.strip("/").split("/")
+        return any(
+            self.excludes_directory("/".join(parts[:i])) for i in range(1, len(parts))
+        ) or self.excludes_file(path)
+
+
+def preset_excludes(preset: str, root: str) -> List[str]:
+    """
+    Gets the exclude globs for a preset, for a particular directory.
+
+    :param preset: The name of the preset; either "nextcloud" or None
+    :param root: The directory being scanned
+    :return: A list of globs
+    """
+    if preset == "nextcloud":
+        # Nextcloud marks its data directory with an .ocdata file,
+        # and each user's directory has a "files" directory
+        if os.path.isfile(os.path.join(root, ".ocdata")):
+            return NEXTCLOUD_DATA_DIRECTORY_EXCLUDES
+        if os.path.isdir(os.path.join(root, "files")):
+            return NEXTCLOUD_USER_DIRECTORY_EXCLUDES
+    return []
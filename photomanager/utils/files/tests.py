@@ -0,0 +1,298 @@
+import array
+import json
+import os
+import select
+import socket
+import tempfile
+import threading
+import unittest
+
+from django.test import SimpleTestCase
+
+from .inotify import IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, Inotify
+from .read_file_server import ReadFileServer
+from .rules import NEXTCLOUD_USER_DIRECTORY_EXCLUDES, ScanRules, preset_excludes
+from .walker import DirectoryCache, open_beneath, sniff_mime, walk
+
+
+class InotifyTestCase(SimpleTestCase):
+    def test_inotify(self):
+        """
+        Tests that events are read from an Inotify instance.
+
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as directory, Inotify() as inotify:
+            inotify.add_watch(directory, IN_CREATE | IN_CLOSE_WRITE)
+
+            # Nothing has happened yet
+            self.assertEqual([], list(inotify.read()))
+
+            with open(os.path.join(directory, "hello.txt"), "w") as file:
+                file.write("hello")
+            os.mkdir(os.path.join(directory, "hello"))
+
+            select.select([inotify], [], [], 5)
+            events = [(event.mask, event.name) for event in inotify.read()]
+            self.assertEqual(
+                [
+                    (IN_CREATE, "hello.txt"),
+                    (IN_CLOSE_WRITE, "hello.txt"),
+                    (IN_CREATE | IN_ISDIR, "hello"),
+                ],
+                events,
+            )
+
+    def test_add_watch_nonexistent(self):
+        """
+        Tests that watching a path that doesn't exist raises OSError.
+
+        :return: None
+        """
+        with Inotify() as inotify:
+            with self.assertRaises(OSError):
+                inotify.add_watch("/nonexistent/directory", IN_CREATE)
+
+
+class WalkerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temporary_directory.name, "root")
+        os.makedirs(os.path.join(self.root, "a", "b"))
+        for path in ["top.txt", "a/middle.txt", "a/b/bottom.txt"]:
+            with open(os.path.join(self.root, path), "w") as file:
+                file.write(path)
+
+        # Something outside of the root that symlinks point to
+        self.outside = os.path.join(self.temporary_directory.name, "outside")
+        os.mkdir(self.outside)
+        with open(os.path.join(self.outside, "secret.txt"), "w") as file:
+            file.write("secret")
+
+        os.symlink(self.outside, os.path.join(self.root, "a", "link_dir"))
+        os.symlink(
+            os.path.join(self.outside, "secret.txt"),
+            os.path.join(self.root, "link_file.txt"),
+        )
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_walk(self):
+        """
+        Tests that walk() lists regular files, but never follows symlinks.
+
+        :return: None
+        """
+        entries = {entry.path: entry for entry in walk(self.root)}
+        self.assertSetEqual(
+            {"/top.txt", "/a/middle.txt", "/a/b/bottom.txt"}, set(entries)
+        )
+
+        stat = os.stat(os.path.join(self.root, "a", "middle.txt"))
+        entry = entries["/a/middle.txt"]
+        self.assertEqual(stat.st_ino, entry.inode)
+        self.assertEqual(stat.st_size, entry.size)
+        self.assertEqual(stat.st_mtime_ns, entry.mtime)
+
+    def test_walk_rules(self):
+        """
+        Tests that walk() skips excluded directories and files.
+
+        :return: None
+        """
+        entries = {
+            entry.path
+            for entry in walk(self.root, ScanRules(excludes=["a/b", "top.*"]))
+        }
+        self.assertSetEqual({"/a/middle.txt"}, entries)
+
+    def test_walk_directory_cache(self):
+        """
+        Tests that walk() doesn't list directories that haven't changed
+        since the previous walk, but still descends into them.
+
+        :return: None
+        """
+        # Directories modified just now are always listed again
+        for path in ["", "a", "a/b"]:
+            os.utime(os.path.join(self.root, path), ns=(10 ** 18, 10 ** 18))
+
+        directories = DirectoryCache()
+        entries = {entry.path for entry in walk(self.root, directories=directories)}
+        self.assertSetEqual({"/top.txt", "/a/middle.txt", "/a/b/bottom.txt"}, entries)
+        self.assertEqual((10 ** 18, ["b"]), directories.current["/a"])
+        self.assertSetEqual(set(), directories.unchanged)
+
+        with open(os.path.join(self.root, "a", "b", "new.txt"), "w") as file:
+            file.write("new")
+
+        directories = DirectoryCache(directories.current)
+        entries = {entry.path for entry in walk(self.root, directories=directories)}
+        self.assertSetEqual({"/a/b/bottom.txt", "/a/b/new.txt"}, entries)
+        self.assertSetEqual({"/", "/a"}, directories.unchanged)
+        # a/b was modified just now, so it can't be trusted next time
+        self.assertIsNone(directories.current["/a/b"][0])
+
+    @unittest.skipIf(os.geteuid() == 0, "Root can list unreadable directories")
+    def test_walk_unreadable(self):
+        """
+        Tests that walk() records the directories it couldn't open,
+        but not those that were replaced with symlinks.
+
+        :return: None
+        """
+        os.chmod(os.path.join(self.root, "a", "b"), 0)
+        try:
+            directories = DirectoryCache()
+            entries = {entry.path for entry in walk(self.root, directories=directories)}
+        finally:
+            os.chmod(os.path.join(self.root, "a", "b"), 0o755)
+        self.assertSetEqual({"/top.txt", "/a/middle.txt"}, entries)
+        self.assertSetEqual({"/a/b"}, directories.failed)
+
+    def test_walk_open(self):
+        """
+        Tests opening files while walking.
+
+        :return: None
+        """
+        for entry in walk(self.root):
+            fd = entry.open()
+            try:
+                self.assertEqual(entry.path.lstrip("/").encode(), os.read(fd, 100))
+                self.assertEqual("text/plain", sniff_mime(fd))
+            finally:
+                os.close(fd)
+
+    def test_open_beneath(self):
+        """
+        Tests that open_beneath() refuses to escape the root.
+
+        :return: None
+        """
+        fd = open_beneath(self.root, "/a/b/bottom.txt")
+        try:
+            self.assertEqual(b"a/b/bottom.txt", os.read(fd, 100))
+        finally:
+            os.close(fd)
+
+        with self.assertRaises(FileNotFoundError):
+            open_beneath(self.root, "/nonexistent.txt")
+        with self.assertRaises(PermissionError):
+            open_beneath(self.root, "/a/../../outside/secret.txt")
+        with self.assertRaises(OSError):
+            open_beneath(self.root, "/link_file.txt")
+        with self.assertRaises(OSError):
+            open_beneath(self.root, "/a/link_dir/secret.txt")
+
+
+class ReadFileServerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temporary_directory.name, "root")
+        os.mkdir(self.root)
+        with open(os.path.join(self.root, "hello.txt"), "w") as file:
+            file.write("hello")
+        with open(
+            os.path.join(self.temporary_directory.name, "secret.txt"), "w"
+        ) as file:
+            file.write("secret")
+        os.symlink(
+            os.path.join(self.temporary_directory.name, "secret.txt"),
+            os.path.join(self.root, "link.txt"),
+        )
+
+        self.socket_path = os.path.join(self.temporary_directory.name, "read_file.sock")
+        self.server = ReadFileServer(self.socket_path, [self.root])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temporary_directory.cleanup()
+
+    def test_read_file(self):
+        """
+        Tests that files beneath the roots are passed back as file descriptors
+        over the socket, but nothing else, and that a connection can send
+        many requests.
+
+        :return: None
+        """
+        path = os.path.join(self.root, "hello.txt")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.socket_path)
+
+            def request(body: bytes) -> tuple:
+                connection.sendall(body + b"\n")
+                data, ancillary, _, _ = connection.recvmsg(
+                    4096, socket.CMSG_SPACE(array.array("i").itemsize)
+                )
+                fds = array.array("i")
+                for _, _, fd_data in ancillary:
+                    fds.frombytes(fd_data)
+                return json.loads(data), list(fds)
+
+            response, fds = request(json.dumps({"path": path}).encode())
+            self.assertEqual({"mime": "text/plain", "size": 5}, response)
+            self.assertEqual(1, len(fds))
+            with os.fdopen(fds[0], "rb") as file:
+                self.assertEqual(b"hello", file.read())
+
+            for path in [
+                os.path.join(self.root, "link.txt"),
+                os.path.join(self.root, "..", "secret.txt"),
+                os.path.join(self.temporary_directory.name, "secret.txt"),
+                os.path.join(self.root, "nonexistent.txt"),
+                self.root,
+            ]:
+                response, fds = request(json.dumps({"path": path}).encode())
+                self.assertEqual(404, response["error"])
+                self.assertEqual([], fds)
+
+            self.assertEqual(400, request(b"hello")[0]["error"])
+
+
+class ScanRulesTestCase(SimpleTestCase):
+    def test_globs(self):
+        """
+        Tests matching paths against include and exclude globs.
+
+        :return: None
+        """
+        rules = ScanRules(excludes=["*/cache", "appdata_*", "**/.thumbnails"])
+        self.assertTrue(rules.excludes_directory("/jdoe/cache"))
+        self.assertFalse(rules.excludes_directory("/jdoe/files/cache"))
+        self.assertTrue(rules.excludes_directory("/appdata_oc123"))
+        self.assertFalse(rules.excludes_directory("/jdoe/appdata_oc123"))
+        self.assertTrue(rules.excludes_directory("/.thumbnails"))
+        self.assertTrue(rules.excludes_directory("/jdoe/files/a/.thumbnails"))
+
+        self.assertTrue(rules.excludes_path("/jdoe/cache/a.jpg"))
+        self.assertFalse(rules.excludes_path("/jdoe/files/cache/a.jpg"))
+
+        rules = ScanRules(includes=["**/*.jpg"], excludes=["private"])
+        self.assertFalse(rules.excludes_file("/a.jpg"))
+        self.assertFalse(rules.excludes_file("/a/b/c.jpg"))
+        self.assertTrue(rules.excludes_file("/a/b/c.png"))
+        self.assertTrue(rules.excludes_path("/private/a.jpg"))
+
+    def test_nextcloud_preset(self):
+        """
+        Tests that the Nextcloud preset matches the layout of the directory.
+
+        :return: None
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual([], preset_excludes("nextcloud", directory))
+
+            os.mkdir(os.path.join(directory, "files"))
+            self.assertEqual(
+                NEXTCLOUD_USER_DIRECTORY_EXCLUDES,
+                preset_excludes("nextcloud", directory),
+            )
+
+            open(os.path.join(directory, ".ocdata"), "w").close()
+            self.assertIn("appdata_*", preset_excludes("nextcloud", directory))
+            self.assertEqual([], preset_excludes(None, directory))
@@ -0,0 +1,292 @@
+"""
+In-process, symlink-safe directory walking and file opening.
+
+Everything here resolves paths one component at a time, relative to
+an open file descriptor for the root directory, refusing to follow
+symlinks (O_NOFOLLOW) or ".." components. This gives the same
+guarantee as chrooting into the root directory (nothing outside of it
+can be reached, no matter how cleverly a symlink is designed), but
+without needing root or spawning a separate process.
+"""
+
+import errno
+import os
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import magic
+
+try:
+    from .rules import ScanRules
+except ImportError:
+    # Imported by a script in this directory, like read_file_server.py
+    from rules import ScanRules
+
+# Number of bytes read from the start of a file to determine its MIME type
+MAGIC_BUFFER_SIZE = 64 * 1024
+
+# Directories modified less than this many nanoseconds before a walk
+# started may be modified again within the same timestamp tick without
+# their modification time changing, so they are always listed again
+RACY_MTIME_MARGIN = 2 * 10 ** 9
+
+_DIRECTORY_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+_FILE_FLAGS = os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_CLOEXEC
+# Errors opening a directory that mean it's no longer there: it was removed,
+# or replaced with a file or a symlink. Others (EACCES, EIO, ESTALE...) may
+# only last for a while, and the directory's contents still exist.
+_GONE_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.ELOOP)
+
+
+class WalkEntry(NamedTuple):
+    """A regular file found while walking a directory."""
+
+    path: str  # Relative to the root, with a leading slash, like "/hello/hello.jpeg"
+    inode: int
+    size: int
+    mtime: int  # In nanoseconds since the epoch
+    dir_fd: int  # Only valid until the walk moves on to the next directory
+    name: str
+
+    def open(self) -> int:
+        """
+        Opens this file for reading, without following symlinks.
+        Only valid while the walk is still in this file's directory.
+
+        :return: A file descriptor, which must be closed by the caller
+        """
+        return os.open(self.name, _FILE_FLAGS, dir_fd=self.dir_fd)
+
+
+class DirectoryCache:
+    """
+    The modification time and subdirectories of each directory seen
+    during a walk, as (mtime, [names]) tuples keyed by the directory's
+    path relative to the root ("/" for the root itself).
+
+    Adding, removing or renaming anything within a directory changes its
+    modification time, so a directory whose modification time is the
+    same as in the previous walk does not need to be listed again;
+    the walk only descends into the subdirectories recorded for it.
+    Files modified in place are missed in those directories.
+    """
+
+    def __init__(self, previous: Dict[str, Tuple[Optional[int], List[str]]] = None):
+        """
+        :param previous: The directories seen during the previous walk,
+                         as in ``current``; if not given, every directory is listed
+        """
+        self.previous = previous or {}
+        self.current: Dict[str, Tuple[Optional[int], List[str]]] = {}
+        # Directories that were not listed, because they haven't changed
+        self.unchanged = set()
+        # Directories that could not be opened or listed; nothing underneath
+        # them was seen, but it may well still exist
+        self.failed = set()
+        self.started = time.time_ns()
+
+    def lookup(self, path: str, mtime: int) -> Optional[List[str]]:
+        """
+        Records a directory as seen during this walk.
+
+        :param path: Path of the directory relative to the root
+        :param mtime: The directory's current modification time, in nanoseconds
+        :return: The directory's subdirectories, if it hasn't changed since
+                 the previous walk; otherwise, None, and the directory must be
+                 listed and passed to ``record``
+        """
+        known_mtime, subdirectories = self.previous.get(path, (None, None))
+        if known_mtime is None or known_mtime != mtime:
+            return None
+
+        self.current[path] = (mtime, subdirectories)
+        self.unchanged.add(path)
+        return subdirectories
+
+    def record(self, path: str, mtime: int, subdirectories: List[str]) -> None:
+        """
+        Records a directory listed during this walk.
+
+        :param path: Path of the directory relative to the root
+        :param mtime: The directory's modification time, in nanoseconds
+        :param subdirectories: Names of the directories within it
+        :return: None
+        """
+        if mtime >= self.started - RACY_MTIME_MARGIN:
+            mtime = None
+        self.current[path] = (mtime, subdirectories)
+
+
+def _split(path: str) -> list:
+    """
+    Splits a path relative to a root into its components.
+
+    :param path: The path, like "/hello/hello.jpeg"
+    :raises PermissionError if the path tries to escape the root with ".."
+    :return: A list of components, like ["hello", "hello.jpeg"]
+    """
+    parts = [part for part in path.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise PermissionError(f"{path} is not beneath the root directory")
+    return parts
+
+
+def open_beneath(root: str, path: str) -> int:
+    """
+    Opens a path beneath root for reading, without following symlinks
+    or otherwise escaping root.
+
+    :param root: The root directory
+    :param path: Path relative to root, like "/hello/hello.jpeg"
+    :raises OSError if the path does not exist or goes through a symlink
+            (ELOOP or ENOTDIR), or PermissionError if it tries to escape root
+    :return: A file descriptor, which must be closed by the caller
+    """
+    root_fd = os.open(root, _DIRECTORY_FLAGS & ~os.O_NOFOLLOW)
+    try:
+        return open_beneath_fd(root_fd, path)
+    finally:
+        os.close(root_fd)
+
+
+def open_beneath_fd(root_fd: int, path: str) -> int:
+    """
+    Same as open_beneath, but with root given as an open file descriptor.
+
+    :param root_fd: File descriptor of the root directory, which is not closed
+    :param path: Path relative to root, like "/hello/hello.jpeg"
+    :raises OSError if the path does not exist or goes through a symlink
+            (ELOOP or ENOTDIR), or PermissionError if it tries to escape root
+    :return: A file descriptor, which must be closed by the caller
+    """
+    parts = _split(path)
+    fd = os.dup(root_fd)
+    try:
+        for part in parts[:-1]:
+            next_fd = os.open(part, _DIRECTORY_FLAGS, dir_fd=fd)
+            os.close(fd)
+            fd = next_fd
+        if not parts:
+            return fd
+        file_fd = os.open(parts[-1], _FILE_FLAGS, dir_fd=fd)
+    except BaseException:
+        os.close(fd)
+        raise
+    os.close(fd)
+    return file_fd
+
+
+def sniff_mime(fd: int, m: magic.Magic = None) -> str:
+    """
+    Determines the MIME type of an open file from its first few bytes.
+
+    :param fd: An open file descriptor
+    :param m: A magic.Magic(mime=True) instance to use; one is created if not given
+    :return: The MIME type, like "image/jpeg"
+    """
+    if m is None:
+        m = magic.Magic(mime=True)
+    return m.from_buffer(os.pread(fd, MAGIC_BUFFER_SIZE, 0))
+
+
+def walk(
+    root: str, rules: ScanRules = None, directories: DirectoryCache = None
+) -> Iterator[WalkEntry]:
+    """
+    Recursively walks a directory, yielding the regular files within it.
+    Symlinks are never followed, and other special files are skipped.
+
+    Directories are walked depth-first, and at most one file descriptor
+    is held open per level of depth.
+
+    :param root: The directory to walk
+    :param rules: If given, directories and files excluded by these
+                  rules are skipped; excluded directories are not listed
+    :param directories: If given, directories that haven't changed since the
+                        previous walk are not listed (see DirectoryCache),
+                        and every directory seen is recorded in it, along
+                        with those that couldn't be opened or listed
+    :return: An iterator of WalkEntry, in no particular order
+    """
+    root_fd = os.open(root, _DIRECTORY_FLAGS & ~os.O_NOFOLLOW)
+    yield from _walk_fd(root_fd, "", rules or ScanRules(), directories)
+
+
+def _walk_fd(
+    fd: int, path: str, rules: ScanRules, directories: Optional[DirectoryCache]
+) -> Iterator[WalkEntry]:
+    """
+    Walks the directory open at fd, then closes fd.
+
+    :param fd: File descriptor of the directory
+    :param path: Path of the directory relative to the root, without a trailing slash
+    :param rules: Rules deciding which files and directories are skipped
+    :param directories: Directories seen during the previous walk, or None
+    :return: An iterator of WalkEntry
+    """
+    try:
+        mtime = os.fstat(fd).st_mtime_ns
+        subdirectories = None
+        if directories is not None:
+            subdirectories = directories.lookup(path or "/", mtime)
+
+        if subdirectories is None:
+            try:
+                subdirectories = yield from _list_fd(fd, path, rules)
+            except OSError:
+                if directories is not None:
+                    directories.failed.add(path or "/")
+                return
+            if directories is not None:
+                directories.record(path or "/", mtime, subdirectories)
+
+        for name in subdirectories:
+            if rules.excludes_directory(f"{path}/{name}"):
+                continue
+            try:
+                subdirectory_fd = os.open(name, _DIRECTORY_FLAGS, dir_fd=fd)
+            except OSError as e:
+                # Removed, replaced with a symlink, or unreadable
+                if directories is not None and e.errno not in _GONE_ERRNOS:
+                    directories.failed.add(f"{path}/{name}")
+                continue
+            yield from _walk_fd(subdirectory_fd, f"{path}/{name}", rules, directories)
+    finally:
+        os.close(fd)
+
+
+def _list_fd(fd: int, path: str, rules: ScanRules) -> Iterator[WalkEntry]:
+    """
+    Lists the directory open at fd, yielding the files within it.
+
+    :param fd: File descriptor of the directory
+    :param path: Path of the directory relative to the root, without a trailing slash
+    :param rules: Rules deciding which files are skipped
+    :return: An iterator of WalkEntry, returning the names of all
+             directories within this one once it is exhausted
+    """
+    subdirectories = []
+    with os.scandir(fd) as entries:
+        for entry in entries:
+            entry_path = f"{path}/{entry.name}"
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    # Recorded even if excluded, in case the rules change
+                    subdirectories.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    if rules.excludes_file(entry_path):
+                        continue
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    yield WalkEntry(
+                        path=entry_path,
+                        inode=entry_stat.st_ino,
+                        size=entry_stat.st_size,
+                        mtime=entry_stat.st_mtime_ns,
+                        dir_fd=fd,
+                        name=entry.name,
+                    )
+            except FileNotFoundError:
+                # Removed while we were walking
+                continue
+
+    return subdirectories
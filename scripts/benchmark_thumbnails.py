@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Compares how long making a thumbnail takes, and how much memory it uses,
+with the old way (decoding and rotating the whole image, then shrinking it)
+and photomanager.apps.photos.thumbnails.make_thumbnail.
+
+Each image is thumbnailed in a new process for each method, so that the
+peak resident set size (RSS) of one doesn't hide the other's.
+
+Usage: scripts/benchmark_thumbnails.py [image ...]
+With no images, a 24 megapixel JPEG photo is generated to test with.
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageOps  # noqa: E402
+
+from photomanager.apps.photos.thumbnails import make_thumbnail  # noqa: E402
+
+# Times to thumbnail each image with each method; the fastest time is kept
+REPEATS = 3
+
+
+def old_thumbnail(data: bytes) -> Image.Image:
+    """
+    Makes a thumbnail the way generate_thumbnail used to.
+
+    :param data: The image file's contents
+    :return: The thumbnail
+    """
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((1024, 1024))
+    return image
+
+
+METHODS = {"old": old_thumbnail, "new": make_thumbnail}
+
+
+def run(method: str, path: str) -> None:
+    """
+    Thumbnails an image, printing the time taken and peak RSS as JSON.
+
+    :param method: A key of METHODS
+    :param path: Path to the image
+    :return: None
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        METHODS[method](data).tobytes()
+        times.append(time.perf_counter() - start)
+
+    # In KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": min(times), "peak_rss": peak_rss}))
+
+
+def measure(method: str, path: str) -> dict:
+    """
+    Runs this script in a new process to thumbnail an image.
+
+    :param method: A key of METHODS
+    :param path: Path to the image
+    :return: A dict with "seconds" and "peak_rss" keys
+    """
+    output = subprocess.run(
+        [sys.executable, __file__, "--method", method, path],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    return json.loads(output)
+
+
+def generate_image(path: str) -> None:
+    """
+    Generates a 6000x4000 JPEG photo, rotated by 90 degrees with its EXIF orientation.
+
+    :param path: Where to save it
+    :return: None
+    """
+    image = Image.radial_gradient("L").resize((6000, 4000))
+    image = Image.merge("RGB", (image, image.transpose(Image.FLIP_LEFT_RIGHT), image))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    image.save(path, "JPEG", quality=90, exif=exif.tobytes())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="*", help="Images to thumbnail")
+    parser.add_argument("--method", choices=METHODS, help=argparse.SUPPRESS)
+    parser.add_argument("--generate", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_image(args.generate)
+        return
+
+    if args.method:
+        run(args.method, args.images[0])
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = args.images
+        if not images:
+            # In another process too, since peak RSS is kept across fork and exec
+            images = [os.path.join(directory, "generated.jpeg")]
+            subprocess.run(
+                [sys.executable, __file__, "--generate", images[0]], check=True
+            )
+
+        print(f"{'image':<30} {'method':<6} {'ms':>8} {'peak RSS (MiB)':>15}")
+        for path in images:
+            for method in METHODS:
+                result = measure(method, path)
+                print(
+                    f"{os.path.basename(path)[:30]:<30} {method:<6} "
+                    f"{result['seconds'] * 1000:>8.1f} {result['peak_rss'] / 1024:>15.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,20 @@ then
   daphne -b 0.0.0.0 -p 8000 photomanager.asgi:application
 elif [[ "$1" == "celery" ]]
 then
-  celery -A photomanager worker
+  celery -A photomanager worker -Q celery,ingest,thumbnails
+elif [[ "$1" == "celery-ml" ]]
+then
+  # Tagging and face recognition need a lot of memory, so one at a time
+  celery -A photomanager worker -Q tagging,faces --concurrency 1
 elif [[ "$1" == "celerybeat" ]]
 then
   celery -A photomanager beat
+elif [[ "$1" == "watcher" ]]
+then
+  ./manage.py watch_directories
+elif [[ "$1" == "reader" ]]
+then
+  python3 photomanager/utils/files/read_file_server.py /data /thumbs
 else
   exec "$@"
 fi
\ No newline at end of file
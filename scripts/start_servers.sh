@@ -2,8 +2,10 @@
 
 cd /home/vagrant/photomanager
 
-tmux new-session -s servers "bash --init-file <(cd /home/vagrant/photomanager && sudo pipenv run celery -A photomanager worker -l DEBUG)" \; \
+tmux new-session -s servers "bash --init-file <(cd /home/vagrant/photomanager && sudo pipenv run celery -A photomanager worker -Q celery,ingest,thumbnails,tagging,faces -l DEBUG)" \; \
   split-window -h "bash --init-file <(cd /home/vagrant/photomanager && pipenv run ./manage.py runserver 0.0.0.0:8000)" \; \
   selectp -t 0 \; \
   split-window -v "bash --init-file <(cd /home/vagrant/photomanager && pipenv run celery -A photomanager beat -l DEBUG)" \; \
+  split-window -v "bash --init-file <(cd /home/vagrant/photomanager && sudo pipenv run ./manage.py watch_directories)" \; \
+  split-window -v "bash --init-file <(cd /home/vagrant/photomanager && sudo pipenv run python3 photomanager/utils/files/read_file_server.py /data /thumbs --group vagrant)" \; \
   selectp -t 0